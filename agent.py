@@ -1,33 +1,83 @@
 import asyncio
+import importlib
 import json
 import os
+import time
+from contextlib import aclosing
 from pprint import pprint
 from typing import List, Dict
 
-import aiohttp
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import AIMessage, HumanMessage
-from langchain_core.output_parsers import StrOutputParser
-
+from sanic.log import logger
+
+from cassette import Cassette, CassetteChatModel
+from history import history_compactor, load_encoding
+from llm_cache import cached, cached_stream
+from metrics import (
+    llm_duration,
+    llm_errors,
+    llm_first_token,
+    llm_tokens,
+    search_duration,
+    search_requests,
+)
+from singleflight import coalesced, coalesced_stream
+from tracing import record
 from message import Message, Sender
+from streaming import JSONArrayParser
+
+# The LLM and search client libraries take over a second to import, so they
+# are loaded on first use; this loads them (and opens connections) at startup
+AGENT_WARMUP = os.environ.get("AGENT_WARMUP", "0") == "1"
+CLIENT_MODULES = (
+    "httpx",
+    "aiohttp",
+    "langchain_openai",
+    "langchain_core.messages",
+    "langchain_core.output_parsers",
+)
+
+
+def _import_clients():
+    for name in CLIENT_MODULES:
+        importlib.import_module(name)
+
+
+# Record or replay every model and search call (AGENT_CASSETTE_MODE)
+cassette = Cassette.from_env()
+
+
+def _with_cassette(create_model):
+    if cassette is None:
+        return create_model()
+    if cassette.replaying:
+        # Nothing reaches Azure, so no model (or credentials) is needed
+        return CassetteChatModel(cassette)
+    return CassetteChatModel(cassette, create_model())
 
 
 class ChatGPTAgent:
-    def __init__(self):
-        self.model = AzureChatOpenAI(
-            azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-            azure_deployment=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
-            openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
-        )
+    def __init__(self, model=None):
+        if model is None:
+            from langchain_openai import AzureChatOpenAI
+
+            model = _with_cassette(
+                lambda: AzureChatOpenAI(
+                    azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+                    azure_deployment=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
+                    openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
+                )
+            )
+        self.model = model
 
-    def invoke(self, messages: List[Message] = None) -> Message:
-        if messages is None:
-            messages = []
-        _messages = [
+    @staticmethod
+    def _to_langchain_messages(messages: List[Message]) -> List:
+        from langchain_core.messages import AIMessage, HumanMessage
+
+        return [
             (
                 HumanMessage(content=msg.content)
                 if msg.sender == Sender.HUMAN
@@ -35,12 +85,42 @@ class ChatGPTAgent:
             )
             for msg in messages
         ]
+
+    def invoke(self, messages: List[Message] = None) -> Message:
+        if messages is None:
+            messages = []
+        _messages = self._to_langchain_messages(messages)
+        from langchain_core.output_parsers import StrOutputParser
+
         parser = StrOutputParser()
         result = parser.invoke(self.model.invoke(_messages))
         result_message = Message(content=result, sender=Sender.CHATGPT)
 
         return result_message
 
+    async def ainvoke(
+        self, messages: List[Message] = None, operation: str = "chat"
+    ) -> Message:
+        if messages is None:
+            messages = []
+        _messages = self._to_langchain_messages(messages)
+        from langchain_core.output_parsers import StrOutputParser
+
+        parser = StrOutputParser()
+        started = time.perf_counter()
+        try:
+            reply = await self.model.ainvoke(_messages)
+        except Exception:
+            llm_errors.labels(operation).inc()
+            raise
+        llm_duration.labels(operation, "invoke").observe(time.perf_counter() - started)
+        record(f"llm.{operation}", started)
+        _count_tokens(operation, getattr(reply, "usage_metadata", None))
+        result = parser.invoke(reply)
+        result_message = Message(content=result, sender=Sender.CHATGPT)
+
+        return result_message
+
     def chat(self, messages: List[Dict]):
         messages = [
             Message(content=msg["content"], sender=msg["sender"]) for msg in messages
@@ -48,7 +128,22 @@ class ChatGPTAgent:
         reply = self.invoke(messages)
         return reply.content
 
-    async def chat_streaming(self, messages: List[Dict]):
+    async def achat(self, messages: List[Dict], operation: str = "chat"):
+        messages = [
+            Message(content=msg["content"], sender=msg["sender"]) for msg in messages
+        ]
+        reply = await self.ainvoke(messages, operation)
+        return reply.content
+
+    async def chat_streaming(
+        self, messages: List[Dict], usage: Dict = None, operation: str = "chat"
+    ):
+        """Yield the reply text as it is generated.
+
+        If given, ``usage`` is filled with the token usage the model reports
+        at the end of the stream (see ``AZURE_OPENAI_STREAM_USAGE``).
+        ``operation`` labels the call in the LLM metrics.
+        """
         if messages is None:
             messages = []
         else:
@@ -56,20 +151,41 @@ class ChatGPTAgent:
                 Message(content=msg["content"], sender=Sender.HUMAN) for msg in messages
             ]
 
-        _messages = [
-            (
-                HumanMessage(content=msg.content)
-                if msg.sender == Sender.HUMAN
-                else AIMessage(content=msg.content)
-            )
-            for msg in messages
-        ]
-        async for chunk in self.model.astream(_messages):
-            yield chunk.content
+        _messages = self._to_langchain_messages(messages)
+        started = time.perf_counter()
+        first_token = True
+        stream_usage = {}
+        try:
+            async for chunk in self.model.astream(_messages):
+                if getattr(chunk, "usage_metadata", None):
+                    stream_usage.update(chunk.usage_metadata)
+                    if usage is not None:
+                        usage.update(chunk.usage_metadata)
+                if first_token and chunk.content:
+                    first_token = False
+                    llm_first_token.labels(operation).observe(
+                        time.perf_counter() - started
+                    )
+                yield chunk.content
+        except Exception:
+            llm_errors.labels(operation).inc()
+            raise
+        finally:
+            # Also covers streams closed early by the consumer
+            elapsed = time.perf_counter() - started
+            llm_duration.labels(operation, "stream").observe(elapsed)
+            record(f"llm.{operation}", started)
+            _count_tokens(operation, stream_usage)
+
+
+def _count_tokens(operation: str, usage: Dict):
+    if usage:
+        llm_tokens.labels(operation, "input").inc(usage.get("input_tokens", 0))
+        llm_tokens.labels(operation, "output").inc(usage.get("output_tokens", 0))
 
 
 class SearchAgent:
-    def __init__(self):
+    def __init__(self, session=None):
         # DOC: https://www.microsoft.com/en-us/bing/apis/bing-web-search-api
         # https://learn.microsoft.com/en-us/bing/search-apis/bing-web-search/overview
         # https://learn.microsoft.com/en-us/bing/search-apis/bing-web-search/reference/response-objects
@@ -78,42 +194,234 @@ class SearchAgent:
         # Image: https://learn.microsoft.com/en-us/bing/search-apis/bing-entity-search/reference/response-objects#localentityanswer
         # Video: https://learn.microsoft.com/en-us/bing/search-apis/bing-video-search/reference/response-objects#videosanswer
 
-        self.subscription_key = os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"]
-        self.endpoint = os.environ["BING_SEARCH_V7_ENDPOINT"] + "v7.0/search"
+        if cassette is not None and cassette.replaying:
+            self.subscription_key = self.endpoint = None
+        else:
+            self.subscription_key = os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"]
+            self.endpoint = os.environ["BING_SEARCH_V7_ENDPOINT"] + "v7.0/search"
+        self.concurrency = int(os.environ.get("BING_SEARCH_CONCURRENCY", 5))
+        self.timeout = float(os.environ.get("BING_SEARCH_TIMEOUT", 10))
+
+        self.session = session
 
     async def search(self, query: str):
+        if cassette is not None:
+            return await cassette.search(query, lambda: self._search(query))
+        return await self._search(query)
+
+    async def _search(self, query: str):
         # Construct a request
         mkt = "en-US"
         params = {"q": query, "mkt": mkt}
         headers = {"Ocp-Apim-Subscription-Key": self.subscription_key}
 
         # Call the API
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(
-                    self.endpoint, headers=headers, params=params
-                ) as response:
-                    response.raise_for_status()
-                    result = await response.json()
-            except Exception as ex:
-                raise ex
+        if self.session is None:
+            import aiohttp
+
+            async with aiohttp.ClientSession() as session:
+                return await self._get(session, headers, params)
+
+        return await self._get(self.session, headers, params)
+
+    async def _get(self, session, headers, params):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with session.get(
+                self.endpoint, headers=headers, params=params
+            ) as response:
+                response.raise_for_status()
+                result = await response.json()
+            outcome = "ok"
+            return result
+        except asyncio.CancelledError:
+            # Timed out in search_many or abandoned by the client
+            outcome = "cancelled"
+            raise
+        finally:
+            search_requests.labels(outcome).inc()
+            search_duration.labels(outcome).observe(time.perf_counter() - started)
+            record("bing", started)
+
+    async def search_many(self, queries: List[str]):
+        """Run ``queries`` concurrently and yield each response as it arrives.
+
+        At most ``concurrency`` requests are in flight at once, each bounded by
+        ``timeout``; failed or timed-out queries are logged and skipped. Closing
+        the generator early cancels the queries that are still pending.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _search(query):
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(self.search(query), self.timeout)
+                except Exception as ex:
+                    logger.warning(f"Search failed for {query!r}: {ex!r}")
+                    return None
+
+        tasks = [asyncio.ensure_future(_search(query)) for query in queries]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                if result is not None:
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class AgentRegistry:
+    """Process-wide LLM and search clients shared by every agent function.
+
+    Starts lazily on first use, or from ``warm_up`` when the app is run with
+    ``AGENT_WARMUP=1``, and is closed on shutdown.
+    """
 
-        return result
+    def __init__(self):
+        self.max_connections = int(os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", 100))
+        self.max_keepalive_connections = int(
+            os.environ.get("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20)
+        )
+        self.keepalive_expiry = float(
+            os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", 30)
+        )
+        self.timeout = float(os.environ.get("AZURE_OPENAI_TIMEOUT", 60))
+        self.connect_timeout = float(os.environ.get("AZURE_OPENAI_CONNECT_TIMEOUT", 5))
+        self.max_retries = int(os.environ.get("AZURE_OPENAI_MAX_RETRIES", 2))
+        self.search_max_connections = int(
+            os.environ.get("BING_SEARCH_MAX_CONNECTIONS", 20)
+        )
+
+        self.http_client = None
+        self.http_async_client = None
+        self.chatgpt_agent = None
+        self.search_agent = None
+        # Set once warm_up has finished; reported by the app's /ready route
+        self.warm = False
 
+    def start(self):
+        if self.chatgpt_agent is not None:
+            return
 
-def get_related_questions(chat_history_text: str) -> List[Dict]:
-    prompt = """Based on the provided chat history, generate a list of the most relevant questions to gather necessary information from the user that will directly enhance the quality of the agent’s future responses and services, avoiding questions that repeat information already known from the chat history. Focus on identifying gaps in understanding, clarifying user preferences, or obtaining specific details that will enable the agent to provide more personalized and effective assistance. The questions should be formatted as a JSON object suitable for front-end rendering, and the language of the questions should match the main language used in the chat history. Only output the JSON object with the questions.
+        import httpx
+        from langchain_openai import AzureChatOpenAI
+
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        timeout = httpx.Timeout(self.timeout, connect=self.connect_timeout)
+        self.http_client = httpx.Client(limits=limits, timeout=timeout)
+        self.http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+        model = _with_cassette(
+            lambda: AzureChatOpenAI(
+                azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+                azure_deployment=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
+                openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
+                timeout=timeout,
+                max_retries=self.max_retries,
+                http_client=self.http_client,
+                http_async_client=self.http_async_client,
+                # Needs an API version that supports stream_options
+                stream_usage=os.environ.get(
+                    "AZURE_OPENAI_STREAM_USAGE", "false"
+                ).lower()
+                == "true",
+            )
+        )
+        self.chatgpt_agent = ChatGPTAgent(model)
+
+    async def warm_up(self):
+        """Import the client libraries, load the tokenizer, create the
+        clients and open a connection to Azure OpenAI and Bing so the first
+        requests don't pay for it. Failures are logged, leave ``warm`` unset and are retried on
+        first use.
+        """
+        started = time.perf_counter()
+        try:
+            await self._start()
+            await load_encoding()
+            if cassette is None or not cassette.replaying:
+                await asyncio.gather(
+                    self._preconnect("Azure OpenAI", self._connect_azure()),
+                    self._preconnect("Bing search", self._connect_search()),
+                )
+        except Exception:
+            logger.exception("Agent warm-up failed")
+            return
+        self.warm = True
+        logger.info(f"Agent clients warmed up in {time.perf_counter() - started:.2f}s")
+
+    async def _start(self):
+        if self.chatgpt_agent is None:
+            # In a thread so the server keeps answering requests meanwhile
+            await asyncio.to_thread(_import_clients)
+            self.start()
+
+    @staticmethod
+    async def _preconnect(name: str, connect):
+        try:
+            await asyncio.wait_for(connect, 10)
+        except Exception as ex:
+            logger.warning(f"Could not pre-open a connection to {name}: {ex!r}")
+
+    async def _connect_azure(self):
+        # Any response leaves the connection in the pool the model client uses
+        await self.http_async_client.head(os.environ["AZURE_OPENAI_ENDPOINT"])
+
+    async def _connect_search(self):
+        search_agent = await self.get_search_agent()
+        async with search_agent.session.head(search_agent.endpoint) as response:
+            await response.read()
+
+    async def close(self):
+        if self.http_async_client is not None:
+            await self.http_async_client.aclose()
+        if self.http_client is not None:
+            self.http_client.close()
+        if self.search_agent is not None:
+            await self.search_agent.session.close()
+
+        self.http_client = None
+        self.http_async_client = None
+        self.chatgpt_agent = None
+        self.search_agent = None
+
+    async def get_chatgpt_agent(self) -> ChatGPTAgent:
+        await self._start()
+        return self.chatgpt_agent
+
+    async def get_search_agent(self) -> SearchAgent:
+        if self.search_agent is not None:
+            return self.search_agent
+
+        aiohttp = await asyncio.to_thread(importlib.import_module, "aiohttp")
+        # Another caller may have created the agent while we awaited the
+        # import; aiohttp sessions must be created inside the running loop
+        if self.search_agent is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.search_max_connections,
+                keepalive_timeout=self.keepalive_expiry,
+            )
+            self.search_agent = SearchAgent(aiohttp.ClientSession(connector=connector))
+        return self.search_agent
+
+
+registry = AgentRegistry()
+
+
+RELATED_QUESTIONS_PROMPT = """Based on the provided chat history, generate a list of the most relevant questions to gather necessary information from the user that will directly enhance the quality of the agent’s future responses and services, avoiding questions that repeat information already known from the chat history. Focus on identifying gaps in understanding, clarifying user preferences, or obtaining specific details that will enable the agent to provide more personalized and effective assistance. The questions should be formatted as a JSON object suitable for front-end rendering, and the language of the questions should match the main language used in the chat history. Only output the JSON object with the questions.
         
 Chat History:
 {0}
 
-""".format(
-        chat_history_text
-    )
+"""
 
-    prompt = (
-        prompt
-        + """
+RELATED_QUESTIONS_OUTPUT_FORMAT = """
 Output Format (JSON):
 [
     {
@@ -130,29 +438,15 @@ Output Format (JSON):
 ]
 
 """
-    )
-
-    chatgpt_agent = ChatGPTAgent()
-    questions_text = chatgpt_agent.chat([{"sender": "user", "content": prompt}])
-    questions_text = questions_text.replace("```json\n", "").replace("```", "")
-    questions = json.loads(questions_text)
 
-    return questions
-
-
-def get_related_insights(chat_history_text: str) -> List[Dict]:
-    prompt = """Based on the provided chat history, generate a mix of high-quality insights and actionable suggestions that reflect different perspectives and directions. The insights should be thought-provoking, concise, and unique, while the suggestions should be practical, specific, and directly applicable. Avoid redundancy, irrelevant information, and focus on providing value. The language of the insights and suggestions should match the language of the chat history. Please output the insights and suggestions in a JSON format, where each item is a separate entry in the list. The response should only include the JSON output, and the language of the insights and suggestions should be the same as the chat history.
+RELATED_INSIGHTS_PROMPT = """Based on the provided chat history, generate a mix of high-quality insights and actionable suggestions that reflect different perspectives and directions. The insights should be thought-provoking, concise, and unique, while the suggestions should be practical, specific, and directly applicable. Avoid redundancy, irrelevant information, and focus on providing value. The language of the insights and suggestions should match the language of the chat history. Please output the insights and suggestions in a JSON format, where each item is a separate entry in the list. The response should only include the JSON output, and the language of the insights and suggestions should be the same as the chat history.
     
 Chat History:
 {0}
 
-""".format(
-        chat_history_text
-    )
+"""
 
-    prompt = (
-        prompt
-        + """
+RELATED_INSIGHTS_OUTPUT_FORMAT = """
 Output Format (JSON):
 [
 "insight1",
@@ -163,41 +457,139 @@ Output Format (JSON):
 ]
 
 """
+
+ANSWER_PROMPT = """Based on the provided chat history, infer the user's intent and purpose behind the conversation. Determine the most likely desired output or result that the user is seeking, such as a travel plan for travel-related discussions or an analysis report for product analysis conversations. Use the inferred intent to produce the specific high-quality output that best meets the user's needs and goals. The language of the output should match the language of the chat history. The response should directly address the inferred user intent with a complete and relevant output.
+
+Chat History:
+{history}
+
+Output:
+[Insert the inferred output here based on the user's intent]
+"""
+
+SEARCH_RESULTS_SUMMARY_PROMPT = """Based on the search results provided, generate a suitable response that addresses the user's query. The response should be relevant, concise, and informative, incorporating key points from the retrieved information. Aim to present the most important insights in a clear and accessible manner, and consider the user's potential needs or interests when crafting your reply. The language of the output should match the language of the search results.\n\nSearch Results:\n{0}"""
+
+SEARCH_KEYWORDS_PROMPT = """Based on the provided chat history, infer the user's intent and purpose behind the conversation. While you are unable to access real-time or specific internet information directly, you can assist the user by generating relevant search keywords that can be used to find the necessary information via a search engine. Please output the queies in a JSON format, where each item is a separate entry in the list. The response should only include the JSON output, and the language of the queries should be the same as the chat history
+
+Chat History:
+{history}
+
+Output Format (JSON):
+[
+"query1",
+"query2",
+"query3"
+]
+
+"""
+
+HISTORY_SUMMARY_PROMPT = """Update the summary of the earlier part of a conversation with the new messages below. Keep every fact, preference, decision and open question that later replies may depend on, drop greetings and repetition, and write it as a concise paragraph in the main language of the conversation. Only output the updated summary.
+
+Current summary:
+{summary}
+
+New messages:
+{history}"""
+
+
+@cached("related_questions", RELATED_QUESTIONS_PROMPT + RELATED_QUESTIONS_OUTPUT_FORMAT)
+@coalesced("related_questions")
+async def get_related_questions(chat_history_text: str) -> List[Dict]:
+    prompt = (
+        RELATED_QUESTIONS_PROMPT.format(chat_history_text)
+        + RELATED_QUESTIONS_OUTPUT_FORMAT
+    )
+
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    questions_text = await chatgpt_agent.achat(
+        [{"sender": "user", "content": prompt}], operation="get_related_questions"
+    )
+    questions_text = questions_text.replace("```json\n", "").replace("```", "")
+    questions = json.loads(questions_text)
+
+    return questions
+
+
+@cached("related_insights", RELATED_INSIGHTS_PROMPT + RELATED_INSIGHTS_OUTPUT_FORMAT)
+@coalesced("related_insights")
+async def get_related_insights(chat_history_text: str) -> List[Dict]:
+    prompt = (
+        RELATED_INSIGHTS_PROMPT.format(chat_history_text)
+        + RELATED_INSIGHTS_OUTPUT_FORMAT
     )
 
-    chatgpt_agent = ChatGPTAgent()
-    answers_text = chatgpt_agent.chat([{"sender": "user", "content": prompt}])
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    answers_text = await chatgpt_agent.achat(
+        [{"sender": "user", "content": prompt}], operation="get_related_insights"
+    )
     answers_text = answers_text.replace("```json\n", "").replace("```", "")
     answers = json.loads(answers_text)
 
     return answers
 
 
-def get_answer(chat_history_text: str) -> str:
-    prompt = """Based on the provided chat history, infer the user's intent and purpose behind the conversation. Determine the most likely desired output or result that the user is seeking, such as a travel plan for travel-related discussions or an analysis report for product analysis conversations. Use the inferred intent to produce the specific high-quality output that best meets the user's needs and goals. The language of the output should match the language of the chat history. The response should directly address the inferred user intent with a complete and relevant output.
+async def _stream_json_items(prompt: str, usage: Dict = None, operation: str = "chat"):
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    parser = JSONArrayParser()
+    chunks = chatgpt_agent.chat_streaming(
+        [{"sender": "user", "content": prompt}], usage=usage, operation=operation
+    )
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            for item in parser.feed(chunk):
+                yield item
+            if parser.done:
+                break
+
+
+@cached_stream(
+    "related_questions", RELATED_QUESTIONS_PROMPT + RELATED_QUESTIONS_OUTPUT_FORMAT
+)
+@coalesced_stream("related_questions")
+async def stream_related_questions(chat_history_text: str, usage: Dict = None):
+    prompt = (
+        RELATED_QUESTIONS_PROMPT.format(chat_history_text)
+        + RELATED_QUESTIONS_OUTPUT_FORMAT
+    )
 
-Chat History:
-{history}
+    async for question in _stream_json_items(prompt, usage, "stream_related_questions"):
+        yield question
 
-Output:
-[Insert the inferred output here based on the user's intent]
-""".format(
-        history=chat_history_text
+
+@cached_stream(
+    "related_insights", RELATED_INSIGHTS_PROMPT + RELATED_INSIGHTS_OUTPUT_FORMAT
+)
+@coalesced_stream("related_insights")
+async def stream_related_insights(chat_history_text: str, usage: Dict = None):
+    prompt = (
+        RELATED_INSIGHTS_PROMPT.format(chat_history_text)
+        + RELATED_INSIGHTS_OUTPUT_FORMAT
     )
 
-    chatgpt_agent = ChatGPTAgent()
-    answer = chatgpt_agent.chat([{"sender": "user", "content": prompt}])
+    async for insight in _stream_json_items(prompt, usage, "stream_related_insights"):
+        yield insight
+
+
+@cached("answer", ANSWER_PROMPT)
+@coalesced("answer")
+async def get_answer(chat_history_text: str) -> str:
+    prompt = ANSWER_PROMPT.format(history=chat_history_text)
+
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    answer = await chatgpt_agent.achat(
+        [{"sender": "user", "content": prompt}], operation="get_answer"
+    )
     return answer
 
 
 # 和Summary的内容上看是会撞车的
-def get_ai_response(chat_history: List) -> str:
-    chatgpt_agent = ChatGPTAgent()
-    answer = chatgpt_agent.chat(chat_history)
+async def get_ai_response(chat_history: List) -> str:
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    answer = await chatgpt_agent.achat(chat_history, operation="get_ai_response")
     return answer
 
 
-def get_search_results_summary(search_results: List[Dict], top_n=5) -> str:
+def _search_results_summary_prompt(search_results: List[Dict], top_n=5) -> str:
     summary = ""
     for i, result in enumerate(search_results):
         if i >= top_n:
@@ -211,95 +603,144 @@ def get_search_results_summary(search_results: List[Dict], top_n=5) -> str:
             summary += f"URL: {result['url']}\n"
             summary += f"Description: {result['description']}\n"
 
-    prompt = """Based on the search results provided, generate a suitable response that addresses the user's query. The response should be relevant, concise, and informative, incorporating key points from the retrieved information. Aim to present the most important insights in a clear and accessible manner, and consider the user's potential needs or interests when crafting your reply. The language of the output should match the language of the search results.\n\nSearch Results:\n{0}""".format(
-        summary
-    )
+    return SEARCH_RESULTS_SUMMARY_PROMPT.format(summary)
+
+
+async def get_search_results_summary(search_results: List[Dict], top_n=5) -> str:
+    prompt = _search_results_summary_prompt(search_results, top_n)
 
-    chatgpt_agent = ChatGPTAgent()
-    summary = chatgpt_agent.chat([{"sender": "user", "content": prompt}])
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    summary = await chatgpt_agent.achat(
+        [{"sender": "user", "content": prompt}], operation="get_search_results_summary"
+    )
 
     return summary
 
 
-async def get_answer_steaming(chat_history_text: str, response) -> str:
-    prompt = """Based on the provided chat history, infer the user's intent and purpose behind the conversation. Determine the most likely desired output or result that the user is seeking, such as a travel plan for travel-related discussions or an analysis report for product analysis conversations. Use the inferred intent to produce the specific high-quality output that best meets the user's needs and goals. The language of the output should match the language of the chat history. The response should directly address the inferred user intent with a complete and relevant output.
+async def stream_search_results_summary(search_results: List[Dict], top_n=5):
+    prompt = _search_results_summary_prompt(search_results, top_n)
 
-Chat History:
-{history}
+    chatgpt_agent = await registry.get_chatgpt_agent()
 
-Output:
-[Insert the inferred output here based on the user's intent]
-""".format(
-        history=chat_history_text
+    chunks = chatgpt_agent.chat_streaming(
+        [{"sender": "user", "content": prompt}],
+        operation="stream_search_results_summary",
     )
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            yield chunk
 
-    chatgpt_agent = ChatGPTAgent()
 
-    async for chunk in chatgpt_agent.chat_streaming(
-        [{"sender": "user", "content": prompt}]
-    ):
-        await response.send(chunk)
+@coalesced_stream("answer")
+async def stream_answer(chat_history_text: str, usage: Dict = None):
+    prompt = ANSWER_PROMPT.format(history=chat_history_text)
 
-    await response.eof()
+    chatgpt_agent = await registry.get_chatgpt_agent()
 
+    chunks = chatgpt_agent.chat_streaming(
+        [{"sender": "user", "content": prompt}], usage=usage, operation="stream_answer"
+    )
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            yield chunk
 
-def get_search_keywords(chat_history_text: str) -> str:
-    prompt = """Based on the provided chat history, infer the user's intent and purpose behind the conversation. While you are unable to access real-time or specific internet information directly, you can assist the user by generating relevant search keywords that can be used to find the necessary information via a search engine. Please output the queies in a JSON format, where each item is a separate entry in the list. The response should only include the JSON output, and the language of the queries should be the same as the chat history
 
-Chat History:
-{history}
+async def summarize_history(summary: str, history: str) -> str:
+    prompt = HISTORY_SUMMARY_PROMPT.format(summary=summary or "(none)", history=history)
 
-Output Format (JSON):
-[
-"query1",
-"query2",
-"query3"
-]
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    return await chatgpt_agent.achat(
+        [{"sender": "user", "content": prompt}], operation="summarize_history"
+    )
 
-""".format(
-        history=chat_history_text
+
+async def get_prompt_history(whiteboard_id: str, chat_history: List[Dict]) -> str:
+    return await history_compactor.compact(
+        whiteboard_id, chat_history, summarize_history
     )
 
-    chatgpt_agent = ChatGPTAgent()
-    answers_text = chatgpt_agent.chat([{"sender": "user", "content": prompt}])
+
+@cached("search_keywords", SEARCH_KEYWORDS_PROMPT)
+@coalesced("search_keywords")
+async def get_search_keywords(chat_history_text: str) -> str:
+    prompt = SEARCH_KEYWORDS_PROMPT.format(history=chat_history_text)
+
+    chatgpt_agent = await registry.get_chatgpt_agent()
+    answers_text = await chatgpt_agent.achat(
+        [{"sender": "user", "content": prompt}], operation="get_search_keywords"
+    )
     answers_text = answers_text.replace("```json\n", "").replace("```", "")
     answers = json.loads(answers_text)
 
     return answers
 
 
-async def get_search_results(chat_history_text: str, limit: int = 5) -> List[Dict]:
-    queries = get_search_keywords(chat_history_text)
-    search_agent = SearchAgent()
+# Generators behind POST /whiteboard/<id>/suggestions, by response key
+SUGGESTION_SECTIONS = {
+    "related_questions": get_related_questions,
+    "related_insights": get_related_insights,
+    "search_keywords": get_search_keywords,
+}
+
+
+async def get_suggestions(chat_history_text: str, sections: List[str] = None) -> Dict:
+    if sections is None:
+        sections = list(SUGGESTION_SECTIONS)
+
+    results = await asyncio.gather(
+        *[SUGGESTION_SECTIONS[section](chat_history_text) for section in sections]
+    )
+    return dict(zip(sections, results))
+
+
+def parse_search_response(response: Dict) -> List[Dict]:
     results = []
-    for query in queries:
-        r = await search_agent.search(query)
-        if "webPages" in r:
-            webPages = r["webPages"]["value"]
-            for webPage in webPages:
-                results.append(
-                    {
-                        "type": "search-webPage",
-                        "name": webPage["name"],
-                        "url": webPage["url"],
-                        "snippet": webPage["snippet"],
-                    }
-                )
+    if "webPages" in response:
+        webPages = response["webPages"]["value"]
+        for webPage in webPages:
+            results.append(
+                {
+                    "type": "search-webPage",
+                    "name": webPage["name"],
+                    "url": webPage["url"],
+                    "snippet": webPage["snippet"],
+                }
+            )
 
-        if "videos" in r:
-            videos = r["videos"]["value"]
-            for video in videos:
-                results.append(
-                    {
-                        "type": "search-video",
-                        "name": video["name"],
-                        "url": video["contentUrl"],
-                        "description": video["description"],
-                    }
-                )
+    if "videos" in response:
+        videos = response["videos"]["value"]
+        for video in videos:
+            results.append(
+                {
+                    "type": "search-video",
+                    "name": video["name"],
+                    "url": video["contentUrl"],
+                    "description": video["description"],
+                }
+            )
 
-        if len(results) >= limit:
-            break
+    return results
+
+
+async def stream_search_results(chat_history_text: str, limit: int = 5):
+    """Yield search results as each query's response arrives."""
+    queries = await get_search_keywords(chat_history_text)
+    search_agent = await registry.get_search_agent()
+    count = 0
+    async with aclosing(search_agent.search_many(queries)) as responses:
+        async for r in responses:
+            for result in parse_search_response(r):
+                yield result
+                count += 1
+            if count >= limit:
+                break
+
+
+async def get_search_results(chat_history_text: str, limit: int = 5) -> List[Dict]:
+    results = []
+    async with aclosing(stream_search_results(chat_history_text, limit)) as stream:
+        async for result in stream:
+            results.append(result)
 
     return results
 
@@ -310,7 +751,7 @@ async def try_related_insights():
     whiteboard_id = WhiteboardData("aeSo4yq9ERU9pKGdX3cGEb")
     chat_history_text = await whiteboard_id.load_as_chat_history_text()
 
-    result = get_related_insights(chat_history_text)
+    result = await get_related_insights(chat_history_text)
     print(result)
 
 
@@ -320,7 +761,7 @@ async def try_related_questions():
     whiteboard_id = WhiteboardData("aeSo4yq9ERU9pKGdX3cGEb")
     chat_history_text = await whiteboard_id.load_as_chat_history_text()
 
-    result = get_related_questions(chat_history_text)
+    result = await get_related_questions(chat_history_text)
     print(result)
 
 
@@ -330,7 +771,7 @@ async def try_get_answer():
     whiteboard_id = WhiteboardData("aeSo4yq9ERU9pKGdX3cGEb")
     chat_history_text = await whiteboard_id.load_as_chat_history_text()
 
-    result = get_answer(chat_history_text)
+    result = await get_answer(chat_history_text)
     print(result)
 
 
@@ -340,12 +781,12 @@ async def try_get_search_keywords():
     whiteboard_id = WhiteboardData("aeSo4yq9ERU9pKGdX3cGEb")
     chat_history_text = await whiteboard_id.load_as_chat_history_text()
 
-    result = get_search_keywords(chat_history_text)
+    result = await get_search_keywords(chat_history_text)
     print(result)
 
 
 async def try_search_engine():
-    search_agent = SearchAgent()
+    search_agent = await registry.get_search_agent()
     result = await search_agent.search("苏州未来十天的天气")
     return result
 
@@ -369,7 +810,7 @@ async def try_get_search_with_ai_summary():
 
     result = await get_search_results(chat_history_text, limit=5)
 
-    summary = get_search_results_summary(result)
+    summary = await get_search_results_summary(result)
 
     print(summary)
 
@@ -380,7 +821,7 @@ async def try_ai_response():
     whiteboard_id = WhiteboardData("aeSo4yq9ERU9pKGdX3cGEb")
     chat_history = await whiteboard_id.load_as_chat_history()
 
-    result = get_ai_response(chat_history)
+    result = await get_ai_response(chat_history)
     print(result)
 
 
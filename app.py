@@ -4,26 +4,50 @@ from sanic import Sanic, response
 from sanic.log import logger
 from sanic.request import Request
 from sanic_cors import CORS
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
 
+from agent import AGENT_WARMUP, registry
 from blueprints.whiteboard import bp as whiteboard_bp
-from models import Whiteboard
+from data_helper import WhiteboardData, document_cache, history_cache
+from db import async_session, bind
+from http_cache import compress_response
+from llm_cache import cache_bypass_ctx, llm_cache
+from metrics import (
+    CONTENT_TYPE,
+    FunctionMetric,
+    metrics_registry,
+    observe_request,
+    start_request_timer,
+)
+from models import create_schema
+from singleflight import single_flight
+from tracing import add_server_timing, finish_trace, start_trace
 
 app = Sanic(__name__)
 CORS(app)
 
-bind = create_async_engine("sqlite+aiosqlite:///local.db", echo=True)
-_sessionmaker = sessionmaker(bind, class_=AsyncSession, expire_on_commit=False)
 _base_model_session_ctx = ContextVar("session")
 
+# Registered first so the timer covers the other middleware too
+app.register_middleware(start_request_timer, "request")
+# Opt-in spans and sampled profiles, see tracing.py
+app.register_middleware(start_trace, "request")
+
 
 @app.middleware("request")
 async def inject_session(request):
-    request.ctx.session = _sessionmaker()
+    request.ctx.session = async_session()
     request.ctx.session_ctx_token = _base_model_session_ctx.set(request.ctx.session)
 
 
+# Let clients skip cached LLM results with "Cache-Control: no-cache"
+# or "X-LLM-Cache: bypass"
+@app.middleware("request")
+async def inject_llm_cache_bypass(request):
+    cache_control = request.headers.get("cache-control", "").lower()
+    bypass = request.headers.get("x-llm-cache", "").lower() == "bypass"
+    cache_bypass_ctx.set(bypass or "no-cache" in cache_control)
+
+
 @app.middleware("response")
 async def close_session(request, response):
     if hasattr(request.ctx, "session_ctx_token"):
@@ -31,11 +55,75 @@ async def close_session(request, response):
         await request.ctx.session.close()
 
 
+# gzip/brotli for large JSON bodies when the client accepts it
+app.register_middleware(compress_response, "response")
+app.register_middleware(observe_request, "response")
+app.register_middleware(add_server_timing, "response")
+
+
+@app.signal("http.lifecycle.response")
+async def finish_request_trace(request, response):
+    await finish_trace(request)
+
+
+def _cache_counts() -> dict:
+    llm = llm_cache.stats()
+    return {
+        ("llm", "hit"): llm["hits"],
+        ("llm", "miss"): llm["misses"],
+        ("document", "hit"): document_cache.hits,
+        ("document", "miss"): document_cache.misses,
+        ("history", "hit"): history_cache.hits,
+        ("history", "miss"): history_cache.misses,
+        # Callers that joined an identical in-flight call
+        ("single_flight", "hit"): single_flight.shared,
+        ("single_flight", "miss"): single_flight.calls,
+    }
+
+
+def _cache_hit_ratios() -> dict:
+    counts = _cache_counts()
+    ratios = {}
+    for cache in ("llm", "document", "history", "single_flight"):
+        lookups = counts[(cache, "hit")] + counts[(cache, "miss")]
+        ratios[(cache,)] = counts[(cache, "hit")] / lookups if lookups else 0.0
+    return ratios
+
+
+metrics_registry.register(
+    FunctionMetric(
+        "cache_lookups",
+        "Cache lookups by cache and result",
+        "counter",
+        ("cache", "result"),
+        _cache_counts,
+    )
+)
+metrics_registry.register(
+    FunctionMetric(
+        "cache_hit_ratio",
+        "Share of lookups answered by each cache",
+        "gauge",
+        ("cache",),
+        _cache_hit_ratios,
+    )
+)
+metrics_registry.register(
+    FunctionMetric(
+        "document_cache_bytes",
+        "Estimated size of the parsed whiteboards held in memory",
+        "gauge",
+        (),
+        lambda: {(): document_cache.total_bytes},
+    )
+)
+
+
 # Initialize the database
 @app.listener("before_server_start")
 async def setup_db(app, loop):
     async with bind.begin() as conn:
-        await conn.run_sync(Whiteboard.metadata.create_all)
+        await conn.run_sync(create_schema)
 
 
 @app.listener("before_server_start")
@@ -46,6 +134,26 @@ async def init_whiteboard_data_folder(app, loop):
         os.makedirs("whiteboard_data")
 
 
+# Write out whiteboard updates still held by the write-behind buffer
+@app.listener("before_server_stop")
+async def flush_whiteboard_data(app, loop):
+    await WhiteboardData.flush_all()
+
+
+# The shared LLM and search clients start on first use, or in the background
+# at startup with AGENT_WARMUP=1 while /ready reports 503
+@app.listener("before_server_start")
+async def warm_up_agent_registry(app, loop):
+    if AGENT_WARMUP:
+        app.add_task(registry.warm_up(), name="agent_warm_up")
+
+
+@app.listener("after_server_stop")
+async def close_agent_registry(app, loop):
+    await registry.close()
+    await llm_cache.close()
+
+
 app.blueprint(whiteboard_bp)
 
 
@@ -55,5 +163,19 @@ async def health(request: Request):
     return response.json({"status": "ok"})
 
 
+# Liveness is /health; load balancers should route to a worker once this is 200
+@app.route("/ready", methods=["GET"])
+async def ready(request: Request):
+    if AGENT_WARMUP and not registry.warm:
+        return response.json({"status": "warming up"}, status=503)
+    return response.json({"status": "ready"})
+
+
+# Prometheus text exposition
+@app.route("/metrics", methods=["GET"])
+async def metrics(request: Request):
+    return response.text(metrics_registry.render(), content_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,133 @@
+"""Measure GET /whiteboard/<id> for full, compressed and 304 responses.
+
+    python benchmarks/bench_conditional.py [--nodes 5000] [--repeat 50]
+
+Runs the real app against a temporary database and data folder. "identity"
+sends no Accept-Encoding, "gzip"/"br" ask for that encoding and
+"not modified" polls with the ETag of the previous response.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+from db import create_engine  # noqa: E402
+from http_cache import ENCODINGS  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_graph(nodes: int) -> dict:
+    return {
+        "graph": {
+            "nodes": [
+                {
+                    "id": f"n{i}",
+                    "type": "text",
+                    "content": f"Note {i} about the trip itinerary and budget",
+                    "created_by": "user" if i % 2 else "bot",
+                    "ui_attributes": {"position": {"x": i % 100, "y": i // 100}},
+                }
+                for i in range(nodes)
+            ],
+            "edges": [{"source": f"n{i}", "target": f"n{i + 1}"} for i in range(nodes)],
+        }
+    }
+
+
+async def measure(session, url, headers, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        async with session.get(url, headers=headers, auto_decompress=False) as resp:
+            body = await resp.read()
+            status = resp.status
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(body), status
+
+
+async def run(nodes: int, repeat: int) -> list:
+    app = app_module.app
+    engine = create_engine(f"sqlite+aiosqlite:///{os.getcwd()}/local.db")
+    app_module.bind = engine
+    app_module.async_session = sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    port = _free_port()
+    server = await app.create_server(
+        host="127.0.0.1", port=port, return_asyncio_server=True, debug=False
+    )
+    await server.startup()
+    await server.before_start()
+    await server.after_start()
+
+    base = f"http://127.0.0.1:{port}/whiteboard"
+    rows = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            await session.post(f"{base}/create", json={"id": "bench", "name": "B"})
+            await session.post(f"{base}/bench/update", json={"data": make_graph(nodes)})
+            async with session.get(f"{base}/bench") as resp:
+                etag = resp.headers["ETag"]
+
+            variants = [("identity", {"Accept-Encoding": "identity"})]
+            variants += [(name, {"Accept-Encoding": name}) for name in ENCODINGS]
+            variants.append(("not modified", {"If-None-Match": etag}))
+            for name, headers in variants:
+                ms, size, status = await measure(
+                    session, f"{base}/bench", headers, repeat
+                )
+                rows.append((name, status, ms, size))
+    finally:
+        await server.before_stop()
+        await server.close()
+        await server.after_stop()
+        await engine.dispose()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+
+    # The LLM client is created at startup but never called here
+    os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1")
+    os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT_NAME", "bench")
+    os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-02-01")
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "bench")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        rows = asyncio.run(run(args.nodes, args.repeat))
+    if args.json:
+        keys = ("response", "status", "ms", "bytes")
+        print(json.dumps([dict(zip(keys, row)) for row in rows], indent=2))
+        return
+
+    print(f"{'response':<13} {'status':>6} {'ms':>8} {'bytes':>9}")
+    for name, status, ms, size in rows:
+        print(f"{name:<13} {status:>6} {ms:>8.2f} {size:>9}")
+
+
+if __name__ == "__main__":
+    main()
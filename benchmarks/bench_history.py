@@ -0,0 +1,77 @@
+"""Compare prompt history size with and without token-budgeted compaction.
+
+    python benchmarks/bench_history.py [--turns 50 500 5000] [--budget 3000]
+
+The summarizer is a stub returning a fixed ~150-token paragraph, so this
+measures prompt size and the local cost of compaction, not the model call.
+"compact ms" is a warm request that reuses the cached summary.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history import HistoryCompactor, count_tokens  # noqa: E402
+from llm_cache import LLMCache  # noqa: E402
+
+SUMMARY = " ".join(["The user is planning a two week trip to Yunnan."] * 15)
+
+
+def make_messages(turns: int) -> list:
+    return [
+        {
+            "sender": "user" if i % 2 else "bot",
+            "content": f"Turn {i}: " + "some detail about the trip plan " * 6,
+        }
+        for i in range(turns)
+    ]
+
+
+async def summarize(summary: str, history: str) -> str:
+    return SUMMARY
+
+
+async def run(turns_list: list, budget: int, repeat: int) -> list:
+    rows = []
+    for turns in turns_list:
+        messages = make_messages(turns)
+        full_text = "\n".join(f"{m['sender']}: {m['content']}" for m in messages)
+
+        compactor = HistoryCompactor(budget=budget, cache=LLMCache())
+        text = await compactor.compact("bench", messages, summarize)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await compactor.compact("bench", messages, summarize)
+        compact_ms = (time.perf_counter() - start) * 1000 / repeat
+
+        rows.append((turns, count_tokens(full_text), count_tokens(text), compact_ms))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--budget", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args.turns, args.budget, args.repeat))
+    if args.json:
+        keys = ("turns", "full_tokens", "compact_tokens", "compact_ms")
+        print(json.dumps([dict(zip(keys, row)) for row in rows], indent=2))
+        return
+
+    print(f"{'turns':>6} {'full tokens':>12} {'compact tokens':>15} {'compact ms':>11}")
+    for turns, full_tokens, compact_tokens, compact_ms in rows:
+        print(f"{turns:>6} {full_tokens:>12} {compact_tokens:>15} {compact_ms:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Compare /whiteboard/all query strategies on a large whiteboard table.
+
+    python benchmarks/bench_listing.py [--rows 100000] [--page-size 50]
+
+"all" is the previous handler: every live row with its JSON columns. The
+paged rows use Whiteboard.list_query with and without the composite
+(deleted_at, updated_at, id) index; "deep" starts from a cursor half way
+through the table.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Base, Whiteboard, encode_cursor  # noqa: E402
+
+LIST_FIELDS = ("id", "name", "updated_at")
+
+
+async def populate(engine, rows: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        base = datetime(2024, 1, 1)
+        batch = []
+        for i in range(rows):
+            batch.append(
+                {
+                    "id": f"wb{i:07d}",
+                    "name": f"{'Trip' if i % 10 == 0 else 'Board'} {i}",
+                    "extra_metadata": {"tags": ["a", "b", "c"], "owner": f"user{i}"},
+                    "ui_attributes": {"avatar": "x" * 64, "color": "#ffffff"},
+                    "created_at": base,
+                    "updated_at": base + timedelta(seconds=i),
+                    # One board in twenty is soft-deleted
+                    "deleted_at": base if i % 20 == 0 else None,
+                }
+            )
+            if len(batch) == 5000:
+                await conn.execute(insert(Whiteboard), batch)
+                batch = []
+        if batch:
+            await conn.execute(insert(Whiteboard), batch)
+
+
+async def timed(session_factory, repeat: int, func):
+    best = None
+    for _ in range(repeat):
+        async with session_factory() as session:
+            started = time.perf_counter()
+            size = await func(session)
+            elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, size
+
+
+async def run(rows: int, page_size: int, repeat: int) -> list:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp}/bench.db")
+        await populate(engine, rows)
+        session_factory = sessionmaker(
+            engine, class_=AsyncSession, expire_on_commit=False
+        )
+
+        async def list_all(session):
+            stmt = select(Whiteboard).where(Whiteboard.deleted_at == None)
+            whiteboards = (await session.execute(stmt)).scalars().all()
+            body = json.dumps({"whiteboards": [w.to_dict() for w in whiteboards]})
+            return len(body)
+
+        def list_page(cursor=None, name_prefix=None):
+            async def query(session):
+                stmt = Whiteboard.list_query(
+                    page_size, cursor, LIST_FIELDS, name_prefix
+                )
+                result = (await session.execute(stmt)).all()
+                page, next_cursor = Whiteboard.page_rows(result, page_size, LIST_FIELDS)
+                return len(json.dumps({"whiteboards": page, "next": next_cursor}))
+
+            return query
+
+        middle = datetime(2024, 1, 1) + timedelta(seconds=rows // 2)
+        deep_cursor = encode_cursor(middle, f"wb{rows // 2:07d}")
+        variants = [
+            ("all", list_all),
+            ("first page", list_page()),
+            ("deep page", list_page(deep_cursor)),
+            ("prefix page", list_page(name_prefix="Trip")),
+        ]
+
+        results = []
+        for indexed in (True, False):
+            if not indexed:
+                async with engine.begin() as conn:
+                    await conn.execute(
+                        text("DROP INDEX ix_whiteboard_deleted_at_updated_at")
+                    )
+            for name, func in variants:
+                if name == "all" and not indexed:
+                    continue
+                elapsed, size = await timed(session_factory, repeat, func)
+                results.append((name, indexed, elapsed, size))
+
+        await engine.dispose()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args.rows, args.page_size, args.repeat))
+    if args.json:
+        keys = ("query", "indexed", "ms", "bytes")
+        print(json.dumps([dict(zip(keys, row)) for row in rows], indent=2))
+        return
+
+    print(f"{'query':<12} {'indexed':>7} {'ms':>9} {'bytes':>10}")
+    for name, indexed, elapsed, size in rows:
+        print(f"{name:<12} {str(indexed):>7} {elapsed:>9.2f} {size:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""Load-test every /whiteboard route against local fake Azure OpenAI and Bing.
+
+    python benchmarks/bench_load.py [--concurrency 10] [--requests 50]
+        [--boards 10] [--nodes 50] [--routes answer search_streaming ...]
+        [--first-token-ms 300] [--tokens-per-second 50] [--search-ms 200]
+
+Needs no credentials: the app runs in a subprocess (with its own data folder
+and database in a temporary directory) pointed at benchmarks/fake_services.py,
+with AGENT_WARMUP=1; measuring starts once /ready answers.
+Requests to each route are spread over --boards boards of --nodes nodes and
+bypass the LLM cache unless --llm-cache is given. "ttft" is the time to the
+first body bytes, i.e. the first token or item for streaming routes.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices, add_arguments  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_graph(nodes: int) -> dict:
+    return {
+        "graph": {
+            "nodes": [
+                {
+                    "id": f"n{i}",
+                    "type": "text",
+                    "content": f"Message {i}: planning a week in Yunnan, "
+                    "trains between Kunming, Dali and Lijiang",
+                    "created_by": "user" if i % 2 == 0 else "bot",
+                    "ui_attributes": {"position": {"x": i % 20, "y": i // 20}},
+                }
+                for i in range(nodes)
+            ],
+            "edges": [
+                {"id": f"e{i}", "source": f"n{i}", "target": f"n{i + 1}"}
+                for i in range(nodes - 1)
+            ],
+        }
+    }
+
+
+def route_specs(boards: list, nodes: int) -> dict:
+    """``name -> (method, path, json body)`` factories, called per request."""
+    counter = itertools.count()
+    # Boards made by "create" are the ones removed by "delete"
+    created = itertools.count()
+    deleted = itertools.count()
+    board = lambda: boards[next(counter) % len(boards)]  # noqa: E731
+    data = make_graph(nodes)
+
+    def patch():
+        i = next(counter)
+        op = {"op": "move_node", "id": f"n{i % nodes}", "position": {"x": i, "y": 0}}
+        return "POST", f"/whiteboard/{board()}/patch", {"operations": [op]}
+
+    specs = {
+        "create": lambda: (
+            "POST",
+            "/whiteboard/create",
+            {"id": f"new{next(created)}", "name": "Bench"},
+        ),
+        "update": lambda: (
+            "POST",
+            f"/whiteboard/{board()}/update",
+            {"name": "Bench", "data": data},
+        ),
+        "patch": patch,
+        "get": lambda: ("GET", f"/whiteboard/{board()}", None),
+        "all": lambda: ("GET", "/whiteboard/all?limit=50", None),
+        "delete": lambda: ("POST", f"/whiteboard/new{next(deleted)}/delete", None),
+    }
+    for route in (
+        "questions",
+        "insights",
+        "questions_streaming",
+        "insights_streaming",
+        "suggestions",
+        "answer",
+        "answer_streaming",
+        "search",
+        "search_streaming",
+    ):
+        specs[route] = lambda route=route: (
+            "POST",
+            f"/whiteboard/{board()}/{route}",
+            {},
+        )
+    return specs
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_route(session, base, spec, requests, concurrency, headers) -> dict:
+    latencies = []
+    first_bytes = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, path, body = spec()
+            started = time.perf_counter()
+            first = None
+            try:
+                async with session.request(
+                    method, base + path, json=body, headers=headers
+                ) as resp:
+                    async for _ in resp.content.iter_any():
+                        if first is None:
+                            first = time.perf_counter() - started
+                    if resp.status >= 400:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            elapsed = time.perf_counter() - started
+            latencies.append(elapsed)
+            first_bytes.append(first if first is not None else elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    row = {"requests": requests, "errors": errors, "rps": requests / elapsed}
+    for name, values in (("latency", latencies), ("ttft", first_bytes)):
+        for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            value = percentile(values, fraction) * 1000 if values else None
+            row[f"{name}_{label}_ms"] = value
+    return row
+
+
+async def wait_until_ready(session, base, process, timeout=30):
+    # /ready waits for the agent warm-up, so no route measures client imports
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The app exited during startup")
+        try:
+            async with session.get(base + "/ready") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("The app did not become ready")
+
+
+async def run(args) -> list:
+    services = FakeServices(
+        args.first_token_ms, args.tokens_per_second, args.search_ms, args.results
+    )
+    await services.start()
+
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        **services.environ(),
+        "PYTHONPATH": ROOT,
+        "AGENT_WARMUP": "1",
+    }
+    command = [
+        sys.executable,
+        "-c",
+        "from app import app; app.run(host='127.0.0.1', "
+        f"port={port}, single_process=True, access_log=False)",
+    ]
+    headers = {} if args.llm_cache else {"Cache-Control": "no-cache"}
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        process = subprocess.Popen(
+            command,
+            cwd=tmp,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        connector = aiohttp.TCPConnector(limit=0)
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await wait_until_ready(session, base, process)
+
+                boards = [f"board{i}" for i in range(args.boards)]
+                data = make_graph(args.nodes)
+                for board in boards:
+                    await session.post(
+                        f"{base}/whiteboard/create", json={"id": board, "name": board}
+                    )
+                    await session.post(
+                        f"{base}/whiteboard/{board}/update", json={"data": data}
+                    )
+
+                specs = route_specs(boards, args.nodes)
+                for route in args.routes:
+                    row = await run_route(
+                        session,
+                        base,
+                        specs[route],
+                        args.requests,
+                        args.concurrency,
+                        headers,
+                    )
+                    rows.append({"route": route, **row})
+        finally:
+            process.terminate()
+            process.wait()
+            await services.stop()
+    return rows
+
+
+def main():
+    routes = list(route_specs(["b"], 1))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", nargs="+", default=routes, choices=routes)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=50, help="per route")
+    parser.add_argument("--boards", type=int, default=10)
+    parser.add_argument("--nodes", type=int, default=50, help="per board")
+    parser.add_argument("--llm-cache", action="store_true", help="allow cache hits")
+    add_arguments(parser)
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    def ms(value):
+        return f"{value:>8.1f}" if value is not None else f"{'-':>8}"
+
+    print(
+        f"{'route':<20} {'rps':>7} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'ttft p50':>8} {'ttft p95':>8}"
+    )
+    for row in rows:
+        print(
+            f"{row['route']:<20} {row['rps']:>7.1f} {row['errors']:>4} "
+            f"{ms(row['latency_p50_ms'])} {ms(row['latency_p95_ms'])} "
+            f"{ms(row['latency_p99_ms'])} {ms(row['ttft_p50_ms'])} "
+            f"{ms(row['ttft_p95_ms'])}"
+        )
+
+
+if __name__ == "__main__":
+    main()
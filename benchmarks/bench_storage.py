@@ -0,0 +1,129 @@
+"""Compare whiteboard_data load/save time and file size across formats.
+
+    python benchmarks/bench_storage.py [--sizes 100 1000 10000] [--repeat 5]
+
+"legacy" is the old indented json.dumps written in place; the other rows are
+the compact atomic format with each serializer that is installed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import aiofiles
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+def make_board(node_count: int) -> dict:
+    nodes = [
+        {
+            "id": f"node_{i}",
+            "type": "text",
+            "content": f"Message number {i} about planning a trip to Yunnan 云南",
+            "status": "inactive",
+            "created_by": "user" if i % 2 else "bot",
+            "created_at": "2024-01-01T00:00:00",
+            "updated_at": "2024-01-01T00:00:00",
+            "extra_metadata": {},
+            "ui_attributes": {"position": {"x": i * 10, "y": i * 5}},
+        }
+        for i in range(node_count)
+    ]
+    edges = [
+        {
+            "id": f"edge_{i}",
+            "source": f"node_{i}",
+            "target": f"node_{i + 1}",
+            "extra_metadata": {},
+            "ui_attributes": {},
+        }
+        for i in range(node_count - 1)
+    ]
+    return {"graph": {"nodes": nodes, "edges": edges}}
+
+
+async def legacy_save(path, data):
+    async with aiofiles.open(path, "w", encoding="utf-8") as f:
+        await f.write(json.dumps(data, indent=4, ensure_ascii=False))
+
+
+async def legacy_load(path):
+    async with aiofiles.open(path, "r", encoding="utf-8") as f:
+        return json.loads(await f.read())
+
+
+def serializer_variants():
+    variants = {"json": (None, None)}
+    if storage.msgspec is not None:
+        variants["msgspec"] = (None, storage.msgspec)
+    if storage.orjson is not None:
+        variants["orjson"] = (storage.orjson, None)
+    return variants
+
+
+async def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+async def run(sizes, repeat, fsync):
+    rows = []
+    variants = serializer_variants()
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            data = make_board(size)
+            path = os.path.join(tmp, f"board_{size}.json")
+
+            save_ms = await measure(lambda: legacy_save(path, data), repeat)
+            load_ms = await measure(lambda: legacy_load(path), repeat)
+            rows.append(("legacy", size, save_ms, load_ms, os.path.getsize(path)))
+
+            for name, (orjson, msgspec) in variants.items():
+                storage.orjson, storage.msgspec = orjson, msgspec
+
+                async def save():
+                    await storage.write_atomic(path, storage.dumps(data), fsync=fsync)
+
+                async def load():
+                    async with aiofiles.open(path, "rb") as f:
+                        return storage.loads(await f.read())
+
+                save_ms = await measure(save, repeat)
+                load_ms = await measure(load, repeat)
+                rows.append((name, size, save_ms, load_ms, os.path.getsize(path)))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fsync", action="store_true", help="fsync atomic writes")
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args.sizes, args.repeat, args.fsync))
+    if args.json:
+        keys = ("format", "nodes", "save_ms", "load_ms", "bytes")
+        print(json.dumps([dict(zip(keys, row)) for row in rows], indent=2))
+        return
+
+    print(f"{'format':<8} {'nodes':>6} {'save ms':>9} {'load ms':>9} {'bytes':>10}")
+    for name, size, save_ms, load_ms, file_size in rows:
+        print(f"{name:<8} {size:>6} {save_ms:>9.2f} {load_ms:>9.2f} {file_size:>10}")
+
+
+if __name__ == "__main__":
+    main()
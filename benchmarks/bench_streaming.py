@@ -0,0 +1,128 @@
+"""Measure per-token streaming overhead of /answer_streaming delivery.
+
+    python benchmarks/bench_streaming.py [--tokens 2000] [--repeat 5]
+
+"legacy" sends every token fragment with its own response.send, as the
+handler did before; "raw" and "sse" go through streaming.stream_text with
+coalescing. By default the token source yields instantly, so the numbers
+are pure server + transport overhead per token; --delay spaces tokens out
+like a model would, which shows the drop in writes ("reads" on the client).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+import aiohttp
+from sanic import Sanic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import stream_text  # noqa: E402
+
+TOKEN_COUNT = 2000
+TOKEN_DELAY = 0.0
+
+
+async def tokens():
+    for i in range(TOKEN_COUNT):
+        if TOKEN_DELAY:
+            await asyncio.sleep(TOKEN_DELAY)
+        yield f"tok{i % 10} "
+
+
+def make_app() -> Sanic:
+    app = Sanic("bench_streaming")
+
+    @app.post("/legacy")
+    async def legacy(request):
+        response = await request.respond(content_type="application/json")
+        async for chunk in tokens():
+            await response.send(chunk)
+        await response.eof()
+
+    @app.post("/coalesced")
+    async def coalesced(request):
+        await stream_text(request, tokens())
+
+    return app
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def measure(session, url, headers, repeat):
+    best = None
+    reads = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        async with session.post(url, headers=headers) as resp:
+            reads = 0
+            async for _ in resp.content.iter_any():
+                reads += 1
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, reads
+
+
+async def run(repeat: int) -> list:
+    app = make_app()
+    port = _free_port()
+    server = await app.create_server(
+        host="127.0.0.1", port=port, return_asyncio_server=True, debug=False
+    )
+    await server.startup()
+    await server.before_start()
+    await server.after_start()
+
+    base = f"http://127.0.0.1:{port}"
+    variants = [
+        ("legacy", "/legacy", {}),
+        ("raw", "/coalesced", {}),
+        ("sse", "/coalesced", {"Accept": "text/event-stream"}),
+    ]
+    rows = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            for name, path, headers in variants:
+                elapsed, reads = await measure(session, base + path, headers, repeat)
+                rows.append((name, elapsed * 1000, elapsed * 1e6 / TOKEN_COUNT, reads))
+    finally:
+        await server.before_stop()
+        await server.close()
+        await server.after_stop()
+    return rows
+
+
+def main():
+    global TOKEN_COUNT, TOKEN_DELAY
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=TOKEN_COUNT)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--delay", type=float, default=0, help="ms between tokens")
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+    TOKEN_COUNT = args.tokens
+    TOKEN_DELAY = args.delay / 1000
+
+    rows = asyncio.run(run(args.repeat))
+    if args.json:
+        keys = ("mode", "total_ms", "us_per_token", "client_reads")
+        print(json.dumps([dict(zip(keys, row)) for row in rows], indent=2))
+        return
+
+    print(f"{'mode':<7} {'total ms':>9} {'us/token':>9} {'reads':>6}")
+    for name, total_ms, per_token, reads in rows:
+        print(f"{name:<7} {total_ms:>9.2f} {per_token:>9.2f} {reads:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Measure whiteboard update throughput for the old and tuned database setup.
+
+    python benchmarks/bench_writes.py [--updates 2000] [--concurrency 10]
+
+"before" is the previous setup: an engine with echo=True and SQLite
+defaults (rollback journal, synchronous=FULL) and an update that opens a
+transaction per field. "after" uses db.create_engine (WAL, tuned pragmas,
+echo off) and one transaction per update, as update_whiteboard_handler
+did before versioning. The middle rows change one thing at a time, and
+"versioned" is the current handler: a fetch, then a conditional UPDATE
+claiming the next version (409 on a lost race). Every update sets
+name, ui_attributes and updated_at on one of --boards boards; echo output
+goes to /dev/null so only its formatting cost is counted.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import create_engine  # noqa: E402
+from models import Base, Whiteboard  # noqa: E402
+
+LEGACY_PRAGMAS = {}
+
+
+async def update_per_field(session_factory, whiteboard_id, i):
+    async with session_factory() as session:
+        async with session.begin():
+            whiteboard = await session.get(Whiteboard, whiteboard_id)
+            whiteboard.name = f"Board {i}"
+        async with session.begin():
+            whiteboard = await session.get(Whiteboard, whiteboard_id)
+            whiteboard.ui_attributes = {"color": f"#{i % 0xFFFFFF:06x}"}
+        async with session.begin():
+            whiteboard = await session.get(Whiteboard, whiteboard_id)
+            whiteboard.updated_at = datetime.now()
+
+
+async def update_once(session_factory, whiteboard_id, i):
+    async with session_factory() as session:
+        async with session.begin():
+            whiteboard = await session.get(Whiteboard, whiteboard_id)
+            whiteboard.name = f"Board {i}"
+            whiteboard.ui_attributes = {"color": f"#{i % 0xFFFFFF:06x}"}
+            whiteboard.updated_at = datetime.now()
+
+
+async def update_versioned(session_factory, whiteboard_id, i):
+    async with session_factory() as session:
+        async with session.begin():
+            whiteboard = await session.get(Whiteboard, whiteboard_id)
+            stmt = Whiteboard.bump_query(
+                whiteboard_id,
+                whiteboard.version,
+                name=f"Board {i}",
+                ui_attributes={"color": f"#{i % 0xFFFFFF:06x}"},
+            )
+            # None means another update got there first; the handler's 409
+            await session.execute(stmt)
+
+
+async def measure(path, echo, pragmas, update, updates, concurrency, boards):
+    engine = create_engine(f"sqlite+aiosqlite:///{path}", echo=echo, pragmas=pragmas)
+    if echo:
+        sql_logger = logging.getLogger("sqlalchemy.engine.Engine")
+        for handler in sql_logger.handlers:
+            handler.setStream(open(os.devnull, "w"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_factory() as session:
+        async with session.begin():
+            for b in range(boards):
+                session.add(Whiteboard(id=f"wb{b}", name=f"Board {b}"))
+
+    counter = iter(range(updates))
+
+    async def worker():
+        for i in counter:
+            await update(session_factory, f"wb{i % boards}", i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+    return updates / elapsed, elapsed * 1000 / updates
+
+
+async def run(updates: int, concurrency: int, boards: int) -> list:
+    variants = [
+        ("before", True, LEGACY_PRAGMAS, update_per_field),
+        ("echo off", False, LEGACY_PRAGMAS, update_per_field),
+        ("+ pragmas", False, None, update_per_field),
+        ("after", False, None, update_once),
+        ("versioned", False, None, update_versioned),
+    ]
+    rows = []
+    for name, echo, pragmas, update in variants:
+        with tempfile.TemporaryDirectory() as tmp:
+            per_second, ms = await measure(
+                f"{tmp}/bench.db", echo, pragmas, update, updates, concurrency, boards
+            )
+        rows.append((name, per_second, ms))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--boards", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args.updates, args.concurrency, args.boards))
+    if args.json:
+        keys = ("setup", "updates_per_s", "ms_per_update")
+        print(json.dumps([dict(zip(keys, row)) for row in rows], indent=2))
+        return
+
+    print(f"{'setup':<10} {'updates/s':>10} {'ms/update':>10}")
+    for name, per_second, ms in rows:
+        print(f"{name:<10} {per_second:>10.1f} {ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
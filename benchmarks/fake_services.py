@@ -0,0 +1,232 @@
+"""Local stand-ins for the Azure OpenAI chat completions and Bing v7 APIs.
+
+    python benchmarks/fake_services.py [--port 8100] [--first-token-ms 300]
+
+Point the app at them with the environment printed on startup. Replies are
+picked from the prompt so every agent function gets output it can parse:
+JSON lists for questions, insights and search keywords, prose otherwise.
+Latency is "first token" plus one token interval per generated token, for
+both streamed and non-streamed completions.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+ANSWER = (
+    "Day 1: arrive in Kunming and walk around Green Lake. Day 2: take the "
+    "train to Dali, rent bikes along Erhai Lake and try the local cheese. "
+    "Day 3: continue to Lijiang old town and book the Tiger Leaping Gorge "
+    "trek for the next morning. Budget about 600 CNY per day for two."
+)
+
+QUESTIONS = [
+    {"question": "When are you planning to travel?", "type": "text"},
+    {
+        "question": "What is your budget per day?",
+        "type": "multiple-choice",
+        "options": ["< 300 CNY", "300-800 CNY", "> 800 CNY"],
+    },
+    {"question": "Do you prefer trains or flights?", "type": "text"},
+]
+
+INSIGHTS = [
+    "Spring and autumn avoid both the rainy season and the holiday crowds.",
+    "Book high speed train tickets 15 days ahead when sales open.",
+    "Altitude in Lijiang and Shangri-La can cause headaches on day one.",
+    "Carry some cash for small guesthouses and markets.",
+]
+
+KEYWORDS = ["Yunnan itinerary 7 days", "Dali to Lijiang train", "Erhai bike rental"]
+
+
+def pick_reply(prompt: str) -> str:
+    if "most relevant questions" in prompt:
+        return json.dumps(QUESTIONS, indent=4)
+    if "insights and actionable suggestions" in prompt:
+        return json.dumps(INSIGHTS, indent=4)
+    if "search keywords" in prompt:
+        return json.dumps(KEYWORDS, indent=4)
+    return ANSWER
+
+
+def tokenize(text: str) -> list:
+    # Roughly one token per word, keeping whitespace so pieces join back up
+    pieces = text.split(" ")
+    return [piece + " " for piece in pieces[:-1]] + pieces[-1:]
+
+
+def search_response(query: str, results: int) -> dict:
+    return {
+        "_type": "SearchResponse",
+        "queryContext": {"originalQuery": query},
+        "webPages": {
+            "value": [
+                {
+                    "name": f"{query} - result {i}",
+                    "url": f"https://example.com/{i}?q={query}",
+                    "snippet": f"Everything about {query}, part {i}. " * 3,
+                }
+                for i in range(results)
+            ]
+        },
+        "videos": {
+            "value": [
+                {
+                    "name": f"{query} - video",
+                    "contentUrl": "https://example.com/video",
+                    "description": f"A short video about {query}.",
+                }
+            ]
+        },
+    }
+
+
+class FakeServices:
+    def __init__(
+        self,
+        first_token_ms: float = 300,
+        tokens_per_second: float = 50,
+        search_ms: float = 200,
+        search_results: int = 5,
+    ):
+        self.first_token = first_token_ms / 1000
+        self.token_interval = 1 / tokens_per_second if tokens_per_second else 0
+        self.search_latency = search_ms / 1000
+        self.search_results = search_results
+
+        self.chat_requests = 0
+        self.search_requests = 0
+        self._runner = None
+        self.port = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(
+            "/openai/deployments/{deployment}/chat/completions", self.chat
+        )
+        app.router.add_get("/v7.0/search", self.search)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def environ(self) -> dict:
+        base = f"http://127.0.0.1:{self.port}/"
+        return {
+            "AZURE_OPENAI_ENDPOINT": base,
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "fake",
+            "AZURE_OPENAI_API_VERSION": "2024-06-01",
+            "AZURE_OPENAI_API_KEY": "fake",
+            "AZURE_OPENAI_STREAM_USAGE": "true",
+            "BING_SEARCH_V7_ENDPOINT": base,
+            "BING_SEARCH_V7_SUBSCRIPTION_KEY": "fake",
+        }
+
+    @staticmethod
+    def _usage(prompt: str, tokens: list) -> dict:
+        prompt_tokens = len(prompt) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self.chat_requests += 1
+        body = await request.json()
+        prompt = "\n".join(str(m.get("content", "")) for m in body["messages"])
+        reply = pick_reply(prompt)
+        tokens = tokenize(reply)
+        created = int(time.time())
+        base = {"id": f"chatcmpl-{self.chat_requests}", "created": created}
+        base["model"] = "gpt-4o"
+
+        await asyncio.sleep(self.first_token)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_interval * (len(tokens) - 1))
+            return web.json_response(
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": self._usage(prompt, tokens),
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(choices, **extra):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": choices}
+            chunk.update(extra)
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self.token_interval)
+            delta = {"content": token}
+            if i == 0:
+                delta["role"] = "assistant"
+            await send([{"index": 0, "delta": delta, "finish_reason": None}])
+        await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send([], usage=self._usage(prompt, tokens))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.search_requests += 1
+        await asyncio.sleep(self.search_latency)
+        query = request.query.get("q", "")
+        return web.json_response(search_response(query, self.search_results))
+
+
+async def serve(args):
+    services = FakeServices(
+        args.first_token_ms, args.tokens_per_second, args.search_ms, args.results
+    )
+    await services.start(port=args.port)
+    for name, value in services.environ().items():
+        print(f"export {name}={value}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await services.stop()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--search-ms", type=float, default=200)
+    parser.add_argument("--results", type=int, default=5, help="per search")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8100)
+    add_arguments(parser)
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
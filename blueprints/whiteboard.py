@@ -1,4 +1,4 @@
-from datetime import datetime
+from contextlib import aclosing
 
 from sanic import Blueprint, response
 from sanic.log import logger
@@ -9,15 +9,81 @@ from agent import (
     get_related_questions,
     get_related_insights,
     get_answer,
-    get_answer_steaming,
+    stream_answer,
+    stream_search_results,
+    stream_search_results_summary,
     get_search_results,
     get_search_results_summary,
+    get_prompt_history,
+    get_suggestions,
+    stream_related_questions,
+    stream_related_insights,
+    SUGGESTION_SECTIONS,
 )
-from data_helper import WhiteboardData
+from data_helper import PatchError, WhiteboardData, check_ids
+from http_cache import etag_matches, make_etag, request_etags
 from models import Whiteboard
+from streaming import coalesce, stream_events, stream_items, stream_text
+from tracing import span
 
 bp = Blueprint("whiteboard", url_prefix="/whiteboard")
 
+MAX_PAGE_SIZE = 1000
+
+
+async def load_prompt_history(whiteboard_id: str) -> str:
+    """Chat history of a board, compacted for use in a prompt."""
+    with span("load"):
+        whiteboard_data = WhiteboardData(whiteboard_id)
+        chat_history = await whiteboard_data.load_as_chat_history()
+    with span("history"):
+        return await get_prompt_history(whiteboard_id, chat_history)
+
+
+def whiteboard_etag(
+    whiteboard_id: str, version: int, query_string: str = "", data_version: str = ""
+) -> str:
+    """ETag of ``GET /whiteboard/<id>``; every write bumps the version.
+
+    It starts with the version so ``If-Match`` can check it whichever page
+    or viewport the ETag was served with. ``data_version`` identifies the
+    stored data served (see ``WhiteboardData.data_version``).
+    """
+    digest = make_etag(whiteboard_id, version, query_string, data_version)
+    digest = digest.strip('"')
+    return f'"{version}.{digest}"'
+
+
+def if_match_passes(request, version: int) -> bool:
+    """Whether an ETag in ``If-Match`` names ``version`` of the whiteboard."""
+    for etag in request_etags(request, "if-match"):
+        if etag == "*" or etag.partition(".")[0] == str(version):
+            return True
+    return False
+
+
+async def current_etag(whiteboard_id: str, version: int) -> str:
+    """ETag a full ``GET`` of the whiteboard at ``version`` serves here now."""
+    data_version = await WhiteboardData(whiteboard_id).data_version()
+    return whiteboard_etag(whiteboard_id, version, data_version=data_version)
+
+
+async def written(whiteboard_id: str, version: int):
+    """Response to a write, with the version (and ETag) to send to the next one."""
+    return response.json(
+        {"id": whiteboard_id, "version": version},
+        headers={"ETag": await current_etag(whiteboard_id, version)},
+    )
+
+
+async def version_conflict(whiteboard_id: str, version: int):
+    logger.error(f"Whiteboard {whiteboard_id} has changed, now at version {version}")
+    return response.json(
+        {"error": "Whiteboard has been changed", "version": version},
+        status=409,
+        headers={"ETag": await current_etag(whiteboard_id, version)},
+    )
+
 
 # sample whiteboard data
 # data = {
@@ -61,34 +127,93 @@ async def create_whiteboard_handler(request):
 
     await WhiteboardData.create(wid)
 
-    return response.json({"id": whiteboard.id})
+    return await written(whiteboard.id, whiteboard.version)
 
 
 # Update a whiteboard
+# Optionally only if unchanged since the client read it: send the version it
+# got back as "version" in the body, or its ETag as If-Match; 409 otherwise
 @bp.route("/<whiteboard_id:str>/update", methods=["POST"])
 async def update_whiteboard_handler(request, whiteboard_id):
     name = request.json.get("name")
-    if name is not None:
-        async with request.ctx.session.begin():
-            whiteboard = await request.ctx.session.get(Whiteboard, whiteboard_id)
-            whiteboard.name = name
     ui_attributes = request.json.get("ui_attributes")
-
-    if ui_attributes is not None:
-        async with request.ctx.session.begin():
-            whiteboard = await request.ctx.session.get(Whiteboard, whiteboard_id)
-            whiteboard.ui_attributes = ui_attributes
-
     data = request.json.get("data")
+    version = request.json.get("version")
+    if version is not None and (type(version) is not int or version <= 0):
+        logger.error("Invalid version")
+        return response.json({"error": "Invalid version"}, status=400)
     if data is not None:
-        whiteboard_data = WhiteboardData(whiteboard_id)
-        await whiteboard_data.update(data)
+        try:
+            check_ids(data)
+        except PatchError as ex:
+            logger.error(f"Invalid data: {ex}")
+            return response.json({"error": str(ex)}, status=400)
 
-        async with request.ctx.session.begin():
-            whiteboard = await request.ctx.session.get(Whiteboard, whiteboard_id)
-            whiteboard.updated_at = datetime.now()
+    session = request.ctx.session
+    whiteboard_data = WhiteboardData(whiteboard_id)
+    # One transaction and one fetch for all of the fields. The board's lock
+    # is taken first, as flushes holding it wait for the database's
+    async with whiteboard_data.writing(), session.begin():
+        whiteboard = await session.get(Whiteboard, whiteboard_id)
+        if not whiteboard or whiteboard.deleted_at is not None:
+            return response.json({"error": "Whiteboard not found"}, status=404)
 
-    return response.json({"id": whiteboard.id})
+        current = whiteboard.version
+        if request.headers.get("if-match") is not None:
+            if not if_match_passes(request, current):
+                return await version_conflict(whiteboard_id, current)
+            version = current if version is None else version
+        if version is not None and version != current:
+            return await version_conflict(whiteboard_id, current)
+        if name is None and ui_attributes is None and data is None:
+            return await written(whiteboard_id, current)
+
+        values = {}
+        if name is not None:
+            values["name"] = name
+        if ui_attributes is not None:
+            values["ui_attributes"] = ui_attributes
+        # Claim the next version before writing the data, so a concurrent
+        # update that read the same version gets the 409 instead
+        stmt = Whiteboard.bump_query(whiteboard_id, version, **values)
+        new_version = (await session.execute(stmt)).scalar()
+        if new_version is None:
+            await session.refresh(whiteboard)
+            return await version_conflict(whiteboard_id, whiteboard.version)
+        if data is not None:
+            await whiteboard_data.update(data, session)
+
+    return await written(whiteboard_id, new_version)
+
+
+# Apply a batch of node/edge operations to a whiteboard
+# {"operations": [{"op": "move_node", "id": "uuid_1", "position": {"x": 0, "y": 0}}]}
+@bp.route("/<whiteboard_id:str>/patch", methods=["POST"])
+async def patch_whiteboard_handler(request, whiteboard_id):
+    operations = request.json.get("operations")
+    if not isinstance(operations, list):
+        logger.error("Operations are required")
+        return response.json({"error": "Operations are required"}, status=400)
+
+    session = request.ctx.session
+    whiteboard_data = WhiteboardData(whiteboard_id)
+    try:
+        # Claim the next version before patching, as updates do, so an update
+        # based on the previous version gets a 409 instead of undoing the patch.
+        # Patches merge with concurrent edits, so they don't check the version.
+        # The board's lock comes first, as in updates.
+        async with whiteboard_data.writing(), session.begin():
+            stmt = Whiteboard.bump_query(whiteboard_id)
+            version = (await session.execute(stmt)).scalar()
+            if version is None:
+                return response.json({"error": "Whiteboard not found"}, status=404)
+            await whiteboard_data.patch(operations, session)
+    except PatchError as ex:
+        # Raised inside the transaction, so the version bump is rolled back
+        logger.error(f"Invalid patch for whiteboard {whiteboard_id}: {ex}")
+        return response.json({"error": str(ex)}, status=400)
+
+    return await written(whiteboard_id, version)
 
 
 # Delete a whiteboard
@@ -98,12 +223,31 @@ async def delete_whiteboard_handler(request, whiteboard_id):
         whiteboard = await request.ctx.session.get(Whiteboard, whiteboard_id)
         await whiteboard.delete(request.ctx.session)
 
-    return response.json({"id": whiteboard.id})
+    return await written(whiteboard.id, whiteboard.version)
 
 
 # Get a whiteboard
 @bp.route("/<whiteboard_id:str>", methods=["GET"])
 async def get_whiteboard_handler(request, whiteboard_id):
+    # Optional paging: ?limit=100&cursor=...&viewport=x_min,y_min,x_max,y_max
+    cursor = request.args.get("cursor")
+    try:
+        limit = request.args.get("limit")
+        limit = int(limit) if limit is not None else None
+        if limit is not None and limit <= 0:
+            raise ValueError(limit)
+        # Cursors are node positions handed out by earlier pages
+        if cursor is not None and int(cursor) < 0:
+            raise ValueError(cursor)
+        viewport = request.args.get("viewport")
+        if viewport is not None:
+            viewport = tuple(float(value) for value in viewport.split(","))
+            if len(viewport) != 4:
+                raise ValueError(viewport)
+    except ValueError:
+        logger.error("Invalid limit, cursor or viewport")
+        return response.json({"error": "Invalid limit, cursor or viewport"}, status=400)
+
     async with request.ctx.session.begin():
         stmt = (
             select(Whiteboard)
@@ -116,75 +260,150 @@ async def get_whiteboard_handler(request, whiteboard_id):
         if not whiteboard:
             return response.json({"error": "Whiteboard not found"}, status=404)
 
-        whiteboard_dict = whiteboard.to_dict()
+        # Every change to the board or its data bumps the version, but the
+        # data may still be buffered in the worker that acknowledged it
         whiteboard_data = WhiteboardData(whiteboard_id)
-        whiteboard_dict["data"] = await whiteboard_data.load()
+        etag = whiteboard_etag(
+            whiteboard.id,
+            whiteboard.version,
+            request.query_string,
+            await whiteboard_data.data_version(),
+        )
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request, etag):
+            return response.empty(status=304, headers=headers)
+
+        whiteboard_dict = whiteboard.to_dict()
+        if limit is None and viewport is None:
+            whiteboard_dict["data"] = await whiteboard_data.load()
+        else:
+            data, next_cursor = await whiteboard_data.load_page(limit, cursor, viewport)
+            whiteboard_dict["data"] = data
+            whiteboard_dict["next_cursor"] = next_cursor
 
-    return response.json(whiteboard_dict)
+    return response.json(whiteboard_dict, headers=headers)
 
 
 # Get all whiteboards
+# Optional: ?limit=50&cursor=...&fields=id,name,updated_at&name_prefix=Trip
 @bp.route("/all", methods=["GET"])
 async def get_all_whiteboards_handler(request):
+    cursor = request.args.get("cursor")
+    name_prefix = request.args.get("name_prefix")
+    fields = request.args.get("fields")
+    fields = tuple(fields.split(",")) if fields else Whiteboard.FIELDS
+    if not set(fields) <= set(Whiteboard.FIELDS):
+        logger.error(f"Invalid fields {fields}")
+        return response.json(
+            {"error": f"fields must be a subset of {list(Whiteboard.FIELDS)}"},
+            status=400,
+        )
+    try:
+        limit = request.args.get("limit")
+        limit = int(limit) if limit is not None else None
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(limit)
+        stmt = Whiteboard.list_query(limit, cursor, fields, name_prefix)
+    except ValueError:
+        logger.error("Invalid limit or cursor")
+        return response.json({"error": "Invalid limit or cursor"}, status=400)
+
     async with request.ctx.session.begin():
-        stmt = select(Whiteboard).where(Whiteboard.deleted_at == None)
-        whiteboards = await request.ctx.session.execute(stmt)
-        whiteboards = whiteboards.scalars().all()
+        rows = (await request.ctx.session.execute(stmt)).all()
 
-    return response.json(
-        {"whiteboards": [whiteboard.to_dict() for whiteboard in whiteboards]}
-    )
+    whiteboards, next_cursor = Whiteboard.page_rows(rows, limit, fields)
+    result = {"whiteboards": whiteboards}
+    if limit is not None:
+        result["next_cursor"] = next_cursor
+    return response.json(result)
 
 
 # Get related questions about current whiteboard
 @bp.route("/<whiteboard_id:str>/questions", methods=["POST"])
 async def get_related_questions_handler(request, whiteboard_id):
-    whiteboard_data = WhiteboardData(whiteboard_id)
-    chat_history_text = await whiteboard_data.load_as_chat_history_text()
+    chat_history_text = await load_prompt_history(whiteboard_id)
 
-    related_questions = get_related_questions(chat_history_text)
+    related_questions = await get_related_questions(chat_history_text)
 
     return response.json({"related_questions": related_questions})
 
 
 @bp.route("/<whiteboard_id:str>/insights", methods=["POST"])
 async def get_related_insights_handler(request, whiteboard_id):
-    whiteboard_data = WhiteboardData(whiteboard_id)
-    chat_history_text = await whiteboard_data.load_as_chat_history_text()
+    chat_history_text = await load_prompt_history(whiteboard_id)
 
-    related_insights = get_related_insights(chat_history_text)
+    related_insights = await get_related_insights(chat_history_text)
 
     return response.json({"related_insights": related_insights})
 
 
+# Streamed variants send each item as soon as the model completes it, as
+# NDJSON or, with "Accept: text/event-stream", as Server-Sent Events
+@bp.route("/<whiteboard_id:str>/questions_streaming", methods=["POST"])
+async def get_related_questions_streaming_handler(request, whiteboard_id):
+    chat_history_text = await load_prompt_history(whiteboard_id)
+
+    await stream_items(request, stream_related_questions(chat_history_text))
+
+
+@bp.route("/<whiteboard_id:str>/insights_streaming", methods=["POST"])
+async def get_related_insights_streaming_handler(request, whiteboard_id):
+    chat_history_text = await load_prompt_history(whiteboard_id)
+
+    await stream_items(request, stream_related_insights(chat_history_text))
+
+
+# Questions, insights and search keywords from one history load, concurrently
+# {"sections": ["related_questions", "related_insights", "search_keywords"]}
+@bp.route("/<whiteboard_id:str>/suggestions", methods=["POST"])
+async def get_suggestions_handler(request, whiteboard_id):
+    sections = (request.json or {}).get("sections")
+    if sections is not None:
+        # Items are checked one by one: lists and dicts can't go in a set
+        if not isinstance(sections, list) or not all(
+            isinstance(section, str) and section in SUGGESTION_SECTIONS
+            for section in sections
+        ):
+            logger.error(f"Invalid sections {sections}")
+            return response.json(
+                {"error": f"sections must be a subset of {list(SUGGESTION_SECTIONS)}"},
+                status=400,
+            )
+        sections = list(dict.fromkeys(sections))
+
+    chat_history_text = await load_prompt_history(whiteboard_id)
+
+    suggestions = await get_suggestions(chat_history_text, sections)
+
+    return response.json(suggestions)
+
+
 @bp.route("/<whiteboard_id:str>/answer", methods=["POST"])
 async def answer_question_handler(request, whiteboard_id):
-    whiteboard_data = WhiteboardData(whiteboard_id)
-    chat_history_text = await whiteboard_data.load_as_chat_history_text()
+    chat_history_text = await load_prompt_history(whiteboard_id)
 
-    answer = get_answer(chat_history_text)
+    answer = await get_answer(chat_history_text)
 
     return response.json({"answer": answer})
 
 
 @bp.route("/<whiteboard_id:str>/answer_streaming", methods=["POST"])
 async def answer_question_streaming_handler(request, whiteboard_id):
-    whiteboard_data = WhiteboardData(whiteboard_id)
-    chat_history_text = await whiteboard_data.load_as_chat_history_text()
+    chat_history_text = await load_prompt_history(whiteboard_id)
 
-    response = await request.respond(content_type="application/json")
-
-    await get_answer_steaming(chat_history_text, response)
+    usage = {}
+    await stream_text(request, stream_answer(chat_history_text, usage), usage)
 
 
 @bp.route("/<whiteboard_id:str>/search", methods=["POST"])
 async def search_handler(request, whiteboard_id):
-    whiteboard_data = WhiteboardData(whiteboard_id)
-    chat_history_text = await whiteboard_data.load_as_chat_history_text()
+    chat_history_text = await load_prompt_history(whiteboard_id)
 
-    search_results = await get_search_results(chat_history_text, limit=5)
+    with span("search"):
+        search_results = await get_search_results(chat_history_text, limit=5)
 
-    search_results_summary = get_search_results_summary(search_results)
+    with span("summary"):
+        search_results_summary = await get_search_results_summary(search_results)
 
     return response.json(
         {
@@ -192,3 +411,25 @@ async def search_handler(request, whiteboard_id):
             "search_results_summary": search_results_summary,
         }
     )
+
+
+# Search results as soon as each query returns, then the summary as it is
+# generated: "result" events followed by "summary" {"content": ...} events
+@bp.route("/<whiteboard_id:str>/search_streaming", methods=["POST"])
+async def search_streaming_handler(request, whiteboard_id):
+    chat_history_text = await load_prompt_history(whiteboard_id)
+
+    async def events():
+        search_results = []
+        results = stream_search_results(chat_history_text, limit=5)
+        async with aclosing(results):
+            async for result in results:
+                search_results.append(result)
+                yield "result", result
+
+        summary = coalesce(stream_search_results_summary(search_results))
+        async with aclosing(summary):
+            async for piece in summary:
+                yield "summary", {"content": piece}
+
+    await stream_events(request, events())
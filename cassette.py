@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import aclosing
+
+from sanic.log import logger
+
+# "record" saves every model and search call, "replay" serves them back
+CASSETTE_MODE = os.environ.get("AGENT_CASSETTE_MODE", "off").lower()
+CASSETTE_DIR = os.environ.get("AGENT_CASSETTE_DIR", "cassettes")
+# "recorded" replays with the original latency and chunk timing
+CASSETTE_TIMING = os.environ.get("AGENT_CASSETTE_TIMING", "recorded").lower()
+
+
+class CassetteMiss(LookupError):
+    """Replay was asked for a call that was never recorded."""
+
+
+def _message_dicts(messages) -> list:
+    return [{"type": message.type, "content": message.content} for message in messages]
+
+
+class Cassette:
+    """Record model completions and search responses to files, or replay them.
+
+    Each call is one JSON file named after a hash of its request (the chat
+    messages or the search query), so replay is deterministic and
+    recordings from concurrent requests never clash. Streams are stored
+    chunk by chunk with the delay before each one. A stream the caller
+    stopped reading early is kept only if there is no complete recording,
+    and replaying past its end raises ``CassetteMiss``.
+    """
+
+    def __init__(self, mode: str, root: str, timing: str = "recorded"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode!r}")
+        self.mode = mode
+        self.root = root
+        self.instant = timing == "instant"
+
+    @classmethod
+    def from_env(cls):
+        if CASSETTE_MODE in ("", "off"):
+            return None
+        return cls(CASSETTE_MODE, CASSETTE_DIR, CASSETTE_TIMING)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def path(self, kind: str, request) -> str:
+        raw = json.dumps(request, ensure_ascii=False, sort_keys=True)
+        digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.root, f"{kind}-{digest}.json")
+
+    def _save(self, path: str, entry: dict):
+        os.makedirs(self.root, exist_ok=True)
+        # Unique per thread so concurrent recordings of one call don't clash
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+    def _save_partial(self, path: str, entry: dict):
+        try:
+            if self._load(path, None).get("complete"):
+                return
+        except (CassetteMiss, ValueError):
+            pass
+        self._save(path, entry)
+
+    def _load(self, path: str, request) -> dict:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise CassetteMiss(f"No recording at {path} for {request!r:.200}") from None
+
+    async def _wait(self, seconds: float):
+        if not self.instant and seconds > 0:
+            await asyncio.sleep(seconds)
+
+    @staticmethod
+    def _chat_entry(request, started: float, reply) -> dict:
+        return {
+            "request": request,
+            "elapsed": time.perf_counter() - started,
+            "content": reply.content,
+            "usage": getattr(reply, "usage_metadata", None),
+        }
+
+    @staticmethod
+    def _chat_reply(entry: dict):
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(content=entry["content"], usage_metadata=entry.get("usage"))
+
+    async def chat(self, messages: list, call):
+        """Return ``await call()`` for ``messages``, recorded or replayed."""
+        request = _message_dicts(messages)
+        path = self.path("chat", request)
+        if self.replaying:
+            entry = await asyncio.to_thread(self._load, path, request)
+            await self._wait(entry["elapsed"])
+            return self._chat_reply(entry)
+
+        started = time.perf_counter()
+        reply = await call()
+        entry = self._chat_entry(request, started, reply)
+        await asyncio.to_thread(self._save, path, entry)
+        return reply
+
+    def chat_sync(self, messages: list, call):
+        request = _message_dicts(messages)
+        path = self.path("chat", request)
+        if self.replaying:
+            entry = self._load(path, request)
+            if not self.instant:
+                time.sleep(entry["elapsed"])
+            return self._chat_reply(entry)
+
+        started = time.perf_counter()
+        reply = call()
+        self._save(path, self._chat_entry(request, started, reply))
+        return reply
+
+    async def stream(self, messages: list, call):
+        """Yield the chunks of ``call()`` for ``messages``, recorded or replayed."""
+        request = _message_dicts(messages)
+        path = self.path("stream", request)
+        if self.replaying:
+            from langchain_core.messages import AIMessageChunk
+
+            entry = await asyncio.to_thread(self._load, path, request)
+            for chunk in entry["chunks"]:
+                await self._wait(chunk["delay"])
+                yield AIMessageChunk(
+                    content=chunk["content"], usage_metadata=chunk.get("usage")
+                )
+            if not entry.get("complete", True):
+                raise CassetteMiss(
+                    f"Recording at {path} was cut off after "
+                    f"{len(entry['chunks'])} chunks"
+                )
+            return
+
+        chunks = []
+        complete = False
+        last = time.perf_counter()
+        try:
+            async with aclosing(call()) as upstream:
+                async for chunk in upstream:
+                    now = time.perf_counter()
+                    chunks.append(
+                        {
+                            "delay": now - last,
+                            "content": chunk.content,
+                            "usage": getattr(chunk, "usage_metadata", None),
+                        }
+                    )
+                    last = now
+                    yield chunk
+            complete = True
+        except (Exception, asyncio.CancelledError):
+            # Failed or abandoned calls are not recorded; replaying a cut-off
+            # stream would hide what the model really returned
+            chunks = None
+            raise
+        finally:
+            if chunks is not None:
+                entry = {"request": request, "complete": complete, "chunks": chunks}
+                save = self._save if complete else self._save_partial
+                await asyncio.to_thread(save, path, entry)
+
+    async def search(self, query: str, call):
+        path = self.path("search", query)
+        if self.replaying:
+            entry = await asyncio.to_thread(self._load, path, query)
+            await self._wait(entry["elapsed"])
+            return entry["response"]
+
+        started = time.perf_counter()
+        response = await call()
+        entry = {
+            "query": query,
+            "elapsed": time.perf_counter() - started,
+            "response": response,
+        }
+        await asyncio.to_thread(self._save, path, entry)
+        return response
+
+
+class CassetteChatModel:
+    """Stands in for the chat model, recording or replaying its calls.
+
+    When replaying, ``model`` may be None: nothing is sent to Azure.
+    """
+
+    def __init__(self, cassette: Cassette, model=None):
+        self.cassette = cassette
+        self.model = model
+        logger.info(f"Chat model calls use cassettes in {cassette.mode} mode")
+
+    async def ainvoke(self, messages):
+        return await self.cassette.chat(messages, lambda: self.model.ainvoke(messages))
+
+    def astream(self, messages):
+        return self.cassette.stream(messages, lambda: self.model.astream(messages))
+
+    def invoke(self, messages):
+        return self.cassette.chat_sync(messages, lambda: self.model.invoke(messages))
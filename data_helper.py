@@ -1,71 +1,480 @@
-import json
+import asyncio
+import os
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext
 
-import aiofiles
+from sanic.log import logger
+
+from graph import (
+    ChatHistory,
+    PatchError,
+    apply_operations,
+    check_ids,
+    diff_operations,
+    page_graph,
+)
+from metrics import storage_bytes, storage_duration
+from tracing import record
+from storage import StorageConflict, create_storage
+
+
+class CachedDocument:
+    def __init__(self, version, size: int, data: dict, history: ChatHistory = None):
+        self.version = version
+        self.size = size
+        self.data = data
+        self._history = history
+
+    @property
+    def history(self) -> ChatHistory:
+        if self._history is None:
+            self._history = ChatHistory.from_data(self.data)
+        return self._history
+
+    @property
+    def chat_history(self) -> list:
+        return self.history.messages
+
+    @property
+    def chat_history_text(self) -> str:
+        return self.history.text
+
+
+class DocumentCache:
+    """Bounded LRU of parsed whiteboard documents keyed by whiteboard id.
+
+    Entries are weighed by their (estimated) size and tagged with the storage
+    version they were read at, so writes from other worker processes are
+    noticed on the next lookup.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, whiteboard_id: str, version) -> CachedDocument:
+        entry = self._entries.get(whiteboard_id)
+        if entry is None or entry.version != version:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(whiteboard_id)
+        self.hits += 1
+        return entry
+
+    def put(self, whiteboard_id: str, version, size: int, data: dict, history=None):
+        self.invalidate(whiteboard_id)
+        if size > self.max_bytes:
+            return None
+
+        entry = CachedDocument(version, size, data, history)
+        self._entries[whiteboard_id] = entry
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+        return entry
+
+    def invalidate(self, whiteboard_id: str):
+        entry = self._entries.pop(whiteboard_id, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+
+document_cache = DocumentCache(
+    int(os.environ.get("WHITEBOARD_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+)
+# Chat history projections read without their board (entries have no data)
+history_cache = DocumentCache(
+    int(os.environ.get("WHITEBOARD_HISTORY_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+)
+
+
+def _observe(operation: str, started: float, size: int):
+    storage_duration.labels(operation).observe(time.perf_counter() - started)
+    storage_bytes.labels(operation).observe(size)
+    record(f"storage.{operation}", started)
+
+
+class PendingWrite:
+    """Unflushed state of a board held by the write-behind buffer."""
+
+    def __init__(self, entry: CachedDocument, base: CachedDocument = None):
+        self.entry = entry
+        # Stored state the buffered writes were made on top of; None for a
+        # board that did not exist yet
+        self.base = base
+        self.snapshot = False
+        self.operations = []
+        self.task = None
+
+    @property
+    def base_version(self):
+        return self.base.version if self.base is not None else None
+
+
+storage = create_storage()
+
+# Serializes writers of the same board within this process
+_locks = weakref.WeakValueDictionary()
+_pending = {}
+
+# Attempts to rebase a patch when another worker wins the race to write
+MAX_PATCH_RETRIES = 5
 
 
 class WhiteboardData:
     def __init__(self, whiteboard_id: str):
         self.whiteboard_id = whiteboard_id
-        self.path = f"whiteboard_data/{whiteboard_id}.json"
+        # Updates within this many seconds of each other share one write
+        self.flush_window = float(os.environ.get("WHITEBOARD_FLUSH_WINDOW", 0.5))
+        # Set while this instance holds the board's lock (see ``writing``)
+        self._writing = False
 
     @classmethod
     async def create(cls, whiteboard_id: str):
         data = {"graph": {"nodes": [], "edges": []}}
         whiteboard_data = cls(whiteboard_id)
         await whiteboard_data.update(data)
+        await whiteboard_data.flush()
         return whiteboard_data
 
-    async def load(self) -> dict:
-        async with aiofiles.open(self.path, "r", encoding="utf-8") as f:
-            return json.loads(await f.read())
+    @classmethod
+    async def flush_all(cls):
+        for whiteboard_id in list(_pending):
+            try:
+                await cls(whiteboard_id).flush()
+            except Exception:
+                logger.exception(f"Failed to flush whiteboard {whiteboard_id}")
 
-    async def update(self, data):
-        async with aiofiles.open(self.path, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(data, indent=4, ensure_ascii=False))
+    @property
+    def lock(self) -> asyncio.Lock:
+        lock = _locks.get(self.whiteboard_id)
+        if lock is None:
+            lock = _locks[self.whiteboard_id] = asyncio.Lock()
+        return lock
 
-    async def delete(self):
-        import os
+    @asynccontextmanager
+    async def writing(self):
+        """Hold the board's lock for a write spanning more than one call.
 
-        os.remove(self.path)
+        Take it before opening a database transaction that writes the board:
+        flushes hold this lock while they wait for the database's, so taking
+        them the other way round deadlocks. ``update`` and ``patch`` called
+        on this instance meanwhile don't take the lock again.
+        """
+        async with self.lock:
+            self._writing = True
+            try:
+                yield self
+            finally:
+                self._writing = False
+
+    def _locked(self):
+        return nullcontext() if self._writing else self.lock
+
+    async def _load_cached(self) -> CachedDocument:
+        pending = _pending.get(self.whiteboard_id)
+        if pending is not None:
+            return pending.entry
+
+        version = await storage.version(self.whiteboard_id)
+        entry = document_cache.get(self.whiteboard_id, version)
+        if entry is not None:
+            return entry
+
+        started = time.perf_counter()
+        version, data = await storage.read(self.whiteboard_id)
+        entry = self._remember(version, data)
+        _observe("read", started, entry.size)
+        return entry
+
+    def _remember(self, version, data: dict, history=None) -> CachedDocument:
+        size = storage.size(version, data)
+        entry = document_cache.put(self.whiteboard_id, version, size, data, history)
+        return entry or CachedDocument(version, size, data, history)
+
+    async def data_version(self) -> str:
+        """Identifies the data ``load`` returns now, e.g. for ETags.
+
+        The stored version, marked when this worker holds unflushed writes;
+        empty if the board has no data.
+        """
+        try:
+            version = await storage.version(self.whiteboard_id)
+        except FileNotFoundError:
+            return ""
+        return f"{version}+" if self.whiteboard_id in _pending else str(version)
+
+    async def load(self) -> dict:
+        # The returned dict is shared with the cache and must not be mutated
+        entry = await self._load_cached()
+        return entry.data
+
+    async def load_page(self, limit: int = None, cursor: str = None, viewport=None):
+        """Load one page of nodes (and the edges touching them).
+
+        See ``graph.page_graph``; storages with partial reads answer this with
+        an indexed query instead of loading the whole board.
+        """
+        if storage.partial_reads:
+            await self.flush()
+            return await storage.read_page(self.whiteboard_id, limit, cursor, viewport)
 
-    async def load_as_chat_history(self):
         data = await self.load()
-        nodes = data["graph"]["nodes"]
-
-        chat_history = []
-        for node in nodes:
-            if node["type"] == "text":
-                content = node["content"]
-                if isinstance(content, dict):
-                    question = content.get("question")
-                    if question:
-                        chat_history.append(
-                            {
-                                "content": question,
-                                "sender": "bot",
-                                "timestamp": node["updated_at"],
-                            }
-                        )
-                    answer = content.get("answer")
-                    if answer:
-                        chat_history.append(
-                            {
-                                "content": answer,
-                                "sender": "user",
-                                "timestamp": node["updated_at"],
-                            }
-                        )
+        return page_graph(data, limit, cursor, viewport)
+
+    def _buffer(self, entry: CachedDocument, base: CachedDocument) -> PendingWrite:
+        pending = _pending.get(self.whiteboard_id)
+        if pending is None:
+            pending = _pending[self.whiteboard_id] = PendingWrite(entry, base)
+            pending.task = asyncio.ensure_future(self._flush_later())
+        pending.entry = entry
+        return pending
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_window)
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception(
+                f"Failed to flush whiteboard {self.whiteboard_id}, "
+                f"retrying in {self.flush_window}s"
+            )
+
+    async def _flush_if_moved(self, session=None):
+        # Another worker wrote since the buffer started: flush first, so new
+        # operations that no longer apply fail their request instead of being
+        # acknowledged and then dropped
+        pending = _pending.get(self.whiteboard_id)
+        if pending is None or pending.base is None:
+            return
+        if await storage.version(self.whiteboard_id) != pending.base.version:
+            await self._flush_pending(session)
+
+    def _rebase(self, data: dict, operations: list, history: ChatHistory):
+        """Apply what still applies of already acknowledged ``operations``.
+
+        A concurrent write may have removed what some of them refer to; those
+        are skipped and logged. Returns the data and the operations applied.
+        """
+        applied = []
+        for operation in operations:
+            try:
+                data = apply_operations(data, [operation], history)
+            except PatchError as ex:
+                logger.error(
+                    f"Skipped {operation.get('op')} on whiteboard "
+                    f"{self.whiteboard_id}, which a concurrent write "
+                    f"conflicts with: {ex}"
+                )
+                continue
+            applied.append(operation)
+        return data, applied
+
+    async def _append(
+        self,
+        base_version,
+        operations: list,
+        entry: CachedDocument,
+        session=None,
+        rebase=False,
+    ):
+        """Append ``operations``, patched into ``entry``, to the stored board.
+
+        Conflicting operations fail with ``PatchError``; with ``rebase`` (for
+        buffered writes that were already acknowledged) they are skipped.
+        """
+        data, history = entry.data, entry.history
+        started = time.perf_counter()
+        # Rebase onto the stored version whenever another worker got there first
+        for _ in range(MAX_PATCH_RETRIES):
+            if not operations:
+                return self._remember(base_version, data, history)
+            try:
+                version = await storage.append(
+                    self.whiteboard_id,
+                    base_version,
+                    operations,
+                    data,
+                    history,
+                    session=session,
+                )
+                entry = self._remember(version, data, history)
+                _observe("append", started, entry.size)
+                return entry
+            except StorageConflict:
+                document_cache.invalidate(self.whiteboard_id)
+                base_version, stored = await storage.read(self.whiteboard_id)
+                history = ChatHistory.from_data(stored)
+                if rebase:
+                    data, operations = self._rebase(stored, operations, history)
                 else:
-                    chat_history.append(
-                        {
-                            "content": node["content"],
-                            "sender": node["created_by"],
-                            "timestamp": node["updated_at"],
-                        }
+                    data = apply_operations(stored, operations, history)
+        raise StorageConflict(self.whiteboard_id)
+
+    async def _write_snapshot(self, pending: PendingWrite, session=None):
+        data, history = pending.entry.data, pending.entry.history
+        base_version = pending.base_version
+        started = time.perf_counter()
+        for _ in range(MAX_PATCH_RETRIES):
+            try:
+                version = await storage.write(
+                    self.whiteboard_id,
+                    data,
+                    history,
+                    base_version=base_version,
+                    session=session,
+                )
+                entry = self._remember(version, data, history)
+                _observe("write", started, entry.size)
+                return entry
+            except StorageConflict:
+                # Replay the snapshot as a diff against what it replaced, so
+                # nodes and edges it left alone keep other workers' changes
+                document_cache.invalidate(self.whiteboard_id)
+                base_version, stored = await storage.read(self.whiteboard_id)
+                history = ChatHistory.from_data(stored)
+                merged, _ = self._rebase(
+                    stored,
+                    diff_operations(pending.base.data, pending.entry.data),
+                    history,
+                )
+                data = {**pending.entry.data, "graph": merged["graph"]}
+        raise StorageConflict(self.whiteboard_id)
+
+    async def flush(self):
+        async with self.lock:
+            await self._flush_pending()
+
+    async def _flush_pending(self, session=None):
+        pending = _pending.pop(self.whiteboard_id, None)
+        if pending is None:
+            return
+        if pending.task is not asyncio.current_task():
+            pending.task.cancel()
+
+        try:
+            async with storage.lock(self.whiteboard_id):
+                if pending.snapshot:
+                    await self._write_snapshot(pending, session)
+                else:
+                    await self._append(
+                        pending.base_version,
+                        pending.operations,
+                        pending.entry,
+                        session,
+                        rebase=True,
                     )
+        except FileNotFoundError:
+            if pending.snapshot:
+                raise
+            # Deleted by another worker; the operations have nothing to apply to
+            logger.warning(f"Whiteboard {self.whiteboard_id} was deleted, dropped")
+        except Exception:
+            # Already acknowledged: keep it buffered and try again later
+            _pending[self.whiteboard_id] = pending
+            pending.task = asyncio.ensure_future(self._flush_later())
+            raise
+
+    async def update(self, data, session=None):
+        """Replace the board's data.
+
+        ``session`` is the caller's open database transaction, if any: SQL
+        storage writes made now join it (see ``SqlStorage._transaction``);
+        open it inside ``writing``.
+        """
+        async with self._locked():
+            if self.flush_window > 0:
+                base = None
+                if self.whiteboard_id not in _pending:
+                    try:
+                        base = await self._load_cached()
+                    except FileNotFoundError:
+                        pass
+                pending = self._buffer(CachedDocument(None, 0, data), base)
+                pending.snapshot = True
+                pending.operations = []
+                return
+
+            async with storage.lock(self.whiteboard_id):
+                started = time.perf_counter()
+                history = ChatHistory.from_data(data)
+                version = await storage.write(
+                    self.whiteboard_id, data, history, session=session
+                )
+                entry = self._remember(version, data, history)
+                _observe("write", started, entry.size)
 
-        return chat_history
+    def _patched(self, entry: CachedDocument, operations: list) -> CachedDocument:
+        # Returns an uncached entry whose version is the one it was patched from
+        history = entry.history.copy()
+        data = apply_operations(entry.data, operations, history)
+        return CachedDocument(entry.version, 0, data, history)
+
+    async def patch(self, operations: list, session=None):
+        """Apply a batch of operations; ``session`` as for ``update``."""
+        async with self._locked():
+            if self.flush_window > 0:
+                await self._flush_if_moved(session)
+                base = await self._load_cached()
+                pending = self._buffer(self._patched(base, operations), base)
+                if not pending.snapshot:
+                    pending.operations.extend(operations)
+                return
+
+            async with storage.lock(self.whiteboard_id):
+                entry = self._patched(await self._load_cached(), operations)
+                await self._append(entry.version, operations, entry, session)
+
+    async def delete(self):
+        pending = _pending.pop(self.whiteboard_id, None)
+        if pending is not None:
+            pending.task.cancel()
+        document_cache.invalidate(self.whiteboard_id)
+        history_cache.invalidate(self.whiteboard_id)
+        await storage.delete(self.whiteboard_id)
+
+    async def _load_history(self) -> ChatHistory:
+        pending = _pending.get(self.whiteboard_id)
+        if pending is not None:
+            return pending.entry.history
+
+        version = await storage.version(self.whiteboard_id)
+        entry = document_cache.get(self.whiteboard_id, version)
+        if entry is None:
+            entry = history_cache.get(self.whiteboard_id, version)
+        if entry is None:
+            # The stored projection avoids reading and walking the whole graph
+            started = time.perf_counter()
+            history = await storage.read_history(self.whiteboard_id)
+            if history is not None:
+                storage_duration.labels("read_history").observe(
+                    time.perf_counter() - started
+                )
+                record("storage.read_history", started)
+                # At least as new as ``version``, which was read first
+                history_cache.put(
+                    self.whiteboard_id, version, len(history.text), None, history
+                )
+                return history
+            entry = await self._load_cached()
+        return entry.history
+
+    async def load_as_chat_history(self):
+        history = await self._load_history()
+        return history.messages
 
     async def load_as_chat_history_text(self):
-        chat_history = await self.load_as_chat_history()
-        return "\n".join([f"{msg['sender']}: {msg['content']}" for msg in chat_history])
\ No newline at end of file
+        history = await self._load_history()
+        return history.text
@@ -0,0 +1,61 @@
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///local.db")
+DATABASE_ECHO = os.environ.get("DATABASE_ECHO", "0") == "1"
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the
+# single writer, and with WAL "NORMAL" only skips the fsync on each commit.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    # Negative values are KiB rather than pages
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", -16000)),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "temp_store": "MEMORY",
+}
+
+
+def create_engine(url: str = None, echo: bool = None, pragmas: dict = None):
+    """Create the async engine for ``url`` (``DATABASE_URL`` by default).
+
+    SQLite connections get ``SQLITE_PRAGMAS`` (or ``pragmas``); other
+    backends only get the pool settings.
+    """
+    url = make_url(url or DATABASE_URL)
+    kwargs = {"echo": DATABASE_ECHO if echo is None else echo}
+
+    in_memory = url.get_backend_name() == "sqlite" and url.database in (
+        None,
+        "",
+        ":memory:",
+    )
+    if not in_memory:
+        kwargs["pool_size"] = DATABASE_POOL_SIZE
+        kwargs["max_overflow"] = DATABASE_MAX_OVERFLOW
+    if url.get_backend_name() != "sqlite":
+        kwargs["pool_pre_ping"] = True
+
+    engine = create_async_engine(url, **kwargs)
+
+    if url.get_backend_name() == "sqlite":
+        pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return engine
+
+
+bind = create_engine()
+async_session = sessionmaker(bind, class_=AsyncSession, expire_on_commit=False)
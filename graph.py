@@ -0,0 +1,245 @@
+import math
+
+
+def node_messages(node: dict) -> list:
+    """Chat messages contributed by one node; only text nodes have any."""
+    if not isinstance(node, dict) or node.get("type") != "text":
+        return []
+
+    content = node.get("content")
+    timestamp = node.get("updated_at")
+    if not isinstance(content, dict):
+        return [
+            {
+                "content": content,
+                "sender": node.get("created_by"),
+                "timestamp": timestamp,
+            }
+        ]
+
+    messages = []
+    question = content.get("question")
+    if question:
+        messages.append({"content": question, "sender": "bot", "timestamp": timestamp})
+    answer = content.get("answer")
+    if answer:
+        messages.append({"content": answer, "sender": "user", "timestamp": timestamp})
+    return messages
+
+
+def build_chat_history(nodes: list) -> list:
+    return [message for node in nodes for message in node_messages(node)]
+
+
+class ChatHistory:
+    """Chat history projection of a board, kept in step with its nodes.
+
+    ``per_node`` holds the messages of every node in node order, so a patch
+    only recomputes the nodes it touches and the flattened history and prompt
+    text are built at most once per version.
+    """
+
+    def __init__(self, per_node: list):
+        self.per_node = per_node
+        self._messages = None
+        self._text = None
+
+    @classmethod
+    def from_data(cls, data: dict):
+        nodes = data.get("graph", {}).get("nodes", [])
+        return cls([node_messages(node) for node in nodes])
+
+    def copy(self):
+        return ChatHistory(list(self.per_node))
+
+    @property
+    def messages(self) -> list:
+        if self._messages is None:
+            self._messages = [m for messages in self.per_node for m in messages]
+        return self._messages
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "\n".join(
+                [f"{msg['sender']}: {msg['content']}" for msg in self.messages]
+            )
+        return self._text
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _find(items: list, item_id, kind: str) -> int:
+    for index, item in enumerate(items):
+        if item.get("id") == item_id:
+            return index
+    raise PatchError(f"{kind} {item_id!r} not found")
+
+
+def apply_operations(data: dict, operations: list, history: ChatHistory = None):
+    """Return ``data`` with a batch of node/edge operations applied.
+
+    Supported ops: ``add_node``/``add_edge`` (``node``/``edge``),
+    ``update_node``/``update_edge`` (``id``, ``fields``), ``move_node``
+    (``id``, ``position``) and ``delete_node``/``delete_edge`` (``id``).
+    Deleting a node also drops the edges attached to it.
+
+    ``data`` itself is left untouched: the graph lists and every changed item
+    are copied, so a batch that fails halfway has no effect.
+
+    ``history``, if given, must be a fresh copy of the projection of ``data``;
+    it is updated in place to match the result.
+    """
+    data = dict(data)
+    graph = data["graph"] = dict(data.get("graph", {}))
+    nodes = graph["nodes"] = list(graph.get("nodes", []))
+    edges = graph["edges"] = list(graph.get("edges", []))
+
+    for operation in operations:
+        op = operation.get("op") if isinstance(operation, dict) else None
+        if op in ("add_node", "add_edge"):
+            kind, items = ("node", nodes) if op == "add_node" else ("edge", edges)
+            item = operation.get(kind)
+            if not isinstance(item, dict) or "id" not in item:
+                raise PatchError(f"{op} requires a {kind} with an id")
+            if any(existing.get("id") == item["id"] for existing in items):
+                raise PatchError(f"{kind} {item['id']!r} already exists")
+            items.append(item)
+            if history is not None and kind == "node":
+                history.per_node.append(node_messages(item))
+        elif op in ("update_node", "update_edge"):
+            kind, items = ("node", nodes) if op == "update_node" else ("edge", edges)
+            fields = operation.get("fields")
+            if not isinstance(fields, dict):
+                raise PatchError(f"{op} requires fields")
+            index = _find(items, operation.get("id"), kind)
+            items[index] = {
+                **items[index],
+                **{k: v for k, v in fields.items() if k != "id"},
+            }
+            if history is not None and kind == "node":
+                history.per_node[index] = node_messages(items[index])
+        elif op == "move_node":
+            position = operation.get("position")
+            if not isinstance(position, dict):
+                raise PatchError("move_node requires a position")
+            index = _find(nodes, operation.get("id"), "node")
+            node = nodes[index] = dict(nodes[index])
+            node["ui_attributes"] = {
+                **node.get("ui_attributes", {}),
+                "position": position,
+            }
+        elif op == "delete_node":
+            index = _find(nodes, operation.get("id"), "node")
+            node = nodes.pop(index)
+            if history is not None:
+                history.per_node.pop(index)
+            edges[:] = [
+                edge
+                for edge in edges
+                if node["id"] not in (edge.get("source"), edge.get("target"))
+            ]
+        elif op == "delete_edge":
+            edges.pop(_find(edges, operation.get("id"), "edge"))
+        else:
+            raise PatchError(f"Unknown operation {op!r}")
+
+    return data
+
+
+def check_ids(data: dict):
+    """Raise ``PatchError`` if two nodes, or two edges, of ``data`` share an id.
+
+    Ids are compared as strings, as SQL storage keys rows by them.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("graph", {}), dict):
+        raise PatchError("data must be an object")
+    for kind in ("node", "edge"):
+        seen = set()
+        for item in data.get("graph", {}).get(f"{kind}s", []):
+            if not isinstance(item, dict):
+                raise PatchError(f"every {kind} must be an object")
+            if item.get("id") is None:
+                continue
+            if str(item["id"]) in seen:
+                raise PatchError(f"{kind} {item['id']!r} appears more than once")
+            seen.add(str(item["id"]))
+
+
+def diff_operations(before: dict, after: dict) -> list:
+    """Operations that turn the graph of ``before`` into that of ``after``.
+
+    Nodes and edges are matched by id; a changed item becomes an update with
+    all of its fields. Items without an id are left out.
+    """
+    operations = []
+    for kind in ("node", "edge"):
+        old = {
+            item["id"]: item
+            for item in before.get("graph", {}).get(f"{kind}s", [])
+            if item.get("id") is not None
+        }
+        new = {
+            item["id"]: item
+            for item in after.get("graph", {}).get(f"{kind}s", [])
+            if item.get("id") is not None
+        }
+        for item_id in old:
+            if item_id not in new:
+                operations.append({"op": f"delete_{kind}", "id": item_id})
+        for item_id, item in new.items():
+            if item_id not in old:
+                operations.append({"op": f"add_{kind}", kind: item})
+            elif item != old[item_id]:
+                operations.append(
+                    {"op": f"update_{kind}", "id": item_id, "fields": item}
+                )
+    return operations
+
+
+def node_position(node: dict):
+    position = (node.get("ui_attributes") or {}).get("position") or {}
+    x, y = position.get("x"), position.get("y")
+    if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+        if math.isfinite(x) and math.isfinite(y):
+            return float(x), float(y)
+    return None, None
+
+
+def in_viewport(node: dict, viewport) -> bool:
+    x_min, y_min, x_max, y_max = viewport
+    x, y = node_position(node)
+    return x is not None and x_min <= x <= x_max and y_min <= y <= y_max
+
+
+def page_graph(data: dict, limit: int = None, cursor: str = None, viewport=None):
+    """Slice a full document into one page of nodes plus their edges.
+
+    ``cursor`` is the position after the last node of the previous page and
+    ``viewport`` an ``(x_min, y_min, x_max, y_max)`` box on node positions.
+    Returns the page and the cursor of the next one, or ``None`` at the end.
+    """
+    graph = data.get("graph", {})
+    all_nodes = graph.get("nodes", [])
+    start = int(cursor) if cursor else 0
+
+    nodes = []
+    next_cursor = None
+    for index in range(start, len(all_nodes)):
+        node = all_nodes[index]
+        if viewport is not None and not in_viewport(node, viewport):
+            continue
+        if limit is not None and len(nodes) == limit:
+            next_cursor = str(index)
+            break
+        nodes.append(node)
+
+    node_ids = {node.get("id") for node in nodes}
+    edges = [
+        edge
+        for edge in graph.get("edges", [])
+        if edge.get("source") in node_ids or edge.get("target") in node_ids
+    ]
+    return {"graph": {"nodes": nodes, "edges": edges}}, next_cursor
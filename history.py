@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import hashlib
+import os
+from typing import Awaitable, Callable, List, Tuple
+
+from sanic.log import logger
+
+from llm_cache import LLMCache, llm_cache
+from singleflight import SingleFlight, single_flight
+
+_encoding = None
+
+
+def _load_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding(
+                os.environ.get("HISTORY_TOKEN_ENCODING", "cl100k_base")
+            )
+        except Exception as ex:
+            # tiktoken fetches its vocabulary on first use and may be offline
+            logger.warning(f"Tokenizer unavailable, estimating tokens: {ex}")
+            _encoding = False
+    return _encoding
+
+
+async def load_encoding():
+    """Load the tokenizer in a thread; its first use may download a vocabulary."""
+    if _encoding is None:
+        await asyncio.to_thread(_load_encoding)
+
+
+# History lines repeat across requests, so their counts are memoized
+@functools.lru_cache(maxsize=65536)
+def count_tokens(text: str) -> int:
+    """Prompt tokens in ``text``, estimated when no tokenizer is available.
+
+    Loads the tokenizer if needed; from the event loop, ``await
+    load_encoding()`` first.
+    """
+    encoding = _load_encoding()
+    if encoding is False:
+        return (len(text.encode("utf-8")) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def format_message(message: dict) -> str:
+    return f"{message['sender']}: {message['content']}"
+
+
+def split_history(messages: List[dict], budget: int) -> Tuple[List[str], List[str]]:
+    """Split history lines into ``(older, recent)``.
+
+    ``recent`` is the longest tail of the conversation that fits in ``budget``
+    tokens, always keeping at least the last turn.
+    """
+    lines = [format_message(message) for message in messages]
+    used = 0
+    split = len(lines)
+    while split > 0:
+        # +1 for the newline joining the lines
+        tokens = count_tokens(lines[split - 1]) + 1
+        if used + tokens > budget and split < len(lines):
+            break
+        used += tokens
+        split -= 1
+    return lines[:split], lines[split:]
+
+
+def chunk_lines(lines: List[str], budget: int) -> List[List[str]]:
+    """Group ``lines`` into runs of at most ``budget`` tokens each.
+
+    A line over budget on its own is cut down to fit.
+    """
+    chunks = []
+    used = budget
+    for line in lines:
+        tokens = count_tokens(line) + 1
+        while tokens > budget and line:
+            # Token counts are roughly proportional to length
+            line = line[: len(line) * budget // tokens]
+            tokens = count_tokens(line) + 1
+        if used + tokens > budget:
+            chunks.append([])
+            used = 0
+        chunks[-1].append(line)
+        used += tokens
+    return chunks
+
+
+def _digest(lines: List[str]) -> str:
+    return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+class HistoryCompactor:
+    """Fit chat history into a token budget for prompts.
+
+    The most recent turns are kept verbatim; older ones are replaced by a
+    rolling summary. The summary is cached per whiteboard together with the
+    lines it covers, so later requests only summarize the turns that have
+    scrolled out of the window since. Turns are summarized at most
+    ``chunk_budget`` tokens at a time.
+    """
+
+    def __init__(
+        self, budget: int = None, cache: LLMCache = None, chunk_budget: int = None
+    ):
+        if budget is None:
+            budget = int(os.environ.get("HISTORY_TOKEN_BUDGET", 3000))
+        if chunk_budget is None:
+            chunk_budget = int(os.environ.get("HISTORY_SUMMARY_CHUNK_TOKENS", 4000))
+        self.budget = budget
+        self.chunk_budget = chunk_budget
+        self.cache = cache or llm_cache
+
+    async def compact(
+        self,
+        whiteboard_id: str,
+        messages: List[dict],
+        summarize: Callable[[str, str], Awaitable[str]],
+    ) -> str:
+        """Return the prompt text for ``messages``.
+
+        ``summarize(previous_summary, new_lines_text)`` extends a summary with
+        the turns that are no longer in the verbatim window.
+        """
+        await load_encoding()
+        older, recent = split_history(messages, self.budget)
+        if not older:
+            return "\n".join(recent)
+
+        key = LLMCache.make_key("history_summary", whiteboard_id)
+        cached = await self.cache.get(key)
+        covered = 0
+        summary = ""
+        if cached is not None and cached["covered"] <= len(older):
+            # Only extend the summary if the turns it covers are unchanged
+            if cached["digest"] == _digest(older[: cached["covered"]]):
+                covered = cached["covered"]
+                summary = cached["summary"]
+
+        if covered < len(older):
+            # Concurrent requests for the same board share one summarization
+            summary = await single_flight.do(
+                SingleFlight.make_key("history_summary", whiteboard_id, *older),
+                functools.partial(
+                    self._extend, key, summary, older, covered, summarize
+                ),
+            )
+
+        return "\n".join([f"summary: {summary}"] + recent)
+
+    async def _extend(self, key, summary, older, covered, summarize) -> str:
+        for chunk in chunk_lines(older[covered:], self.chunk_budget):
+            summary = await summarize(summary, "\n".join(chunk))
+            covered += len(chunk)
+            # Saved per chunk so a failure part way keeps the progress made
+            await self.cache.set(
+                key,
+                {
+                    "covered": covered,
+                    "digest": _digest(older[:covered]),
+                    "summary": summary,
+                },
+            )
+        return summary
+
+
+history_compactor = HistoryCompactor()
@@ -0,0 +1,123 @@
+import asyncio
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as is; compression would not pay off
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+# Larger bodies are compressed in a worker thread to keep the loop responsive
+COMPRESS_THREAD_BYTES = int(os.environ.get("COMPRESS_THREAD_BYTES", 256 * 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 5))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag for a representation identified by ``parts``."""
+    digest = hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8"))
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def _opaque(etag: str) -> str:
+    # Compressed variants carry an encoding suffix but are the same content
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    etag = etag.strip('"')
+    for encoding in ENCODINGS:
+        etag = etag.removesuffix(f"-{encoding}")
+    return etag
+
+
+def request_etags(request, header: str = "if-none-match") -> list:
+    """Entity tags listed in ``header``, unquoted; ``["*"]`` stands for any."""
+    value = request.headers.get(header)
+    if not value:
+        return []
+    if value.strip() == "*":
+        return ["*"]
+    return [_opaque(candidate) for candidate in value.split(",")]
+
+
+def etag_matches(request, etag: str) -> bool:
+    """Whether the request's ``If-None-Match`` covers ``etag``."""
+    candidates = request_etags(request)
+    return "*" in candidates or _opaque(etag) in candidates
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for item in header.split(","):
+        encoding, _, params = item.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def choose_encoding(accept_encoding: str):
+    accepted = _accepted_encodings(accept_encoding or "")
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def _gzip(body: bytes) -> bytes:
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _brotli(body: bytes) -> bytes:
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+
+
+# In order of preference; brotli is only offered when the module is installed
+ENCODINGS = {"br": _brotli} if brotli is not None else {}
+ENCODINGS["gzip"] = _gzip
+
+
+async def compress_response(request, response):
+    """Response middleware compressing large JSON and text bodies.
+
+    Streaming responses (which have no body here) and bodies under
+    ``COMPRESS_MIN_BYTES`` are left alone. Strong ETags get the encoding
+    appended so each variant has its own validator.
+    """
+    body = response.body
+    if body is None or len(body) < COMPRESS_MIN_BYTES:
+        return
+    if "content-encoding" in response.headers:
+        return
+    content_type = response.content_type or ""
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return
+
+    vary = response.headers.get("vary")
+    if vary is None:
+        response.headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = f"{vary}, Accept-Encoding"
+
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    if encoding is None:
+        return
+
+    if len(body) >= COMPRESS_THREAD_BYTES:
+        response.body = await asyncio.to_thread(ENCODINGS[encoding], body)
+    else:
+        response.body = ENCODINGS[encoding](body)
+    response.headers["Content-Encoding"] = encoding
+    etag = response.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        response.headers["ETag"] = f'"{_opaque(etag)}-{encoding}"'
@@ -0,0 +1,214 @@
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+import aiosqlite
+
+# Set per request by the app middleware when the client asks to skip the cache
+cache_bypass_ctx = ContextVar("llm_cache_bypass", default=False)
+
+
+class LLMCache:
+    """Content-addressed cache for LLM results.
+
+    Entries live in an in-memory LRU with a TTL. When ``sqlite_path`` is set,
+    they are also written through to a SQLite file so they survive restarts and
+    are shared between workers on the same host.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        sqlite_path: str = None,
+        enabled: bool = True,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.enabled = enabled
+
+        self._entries = OrderedDict()
+        self._db = None
+
+        self.hits = 0
+        self.misses = 0
+        self.sqlite_hits = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 1024)),
+            ttl=float(os.environ.get("LLM_CACHE_TTL", 3600)),
+            sqlite_path=os.environ.get("LLM_CACHE_SQLITE_PATH") or None,
+            enabled=os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true",
+        )
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        payload = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _connect(self):
+        if self._db is None:
+            self._db = await aiosqlite.connect(self.sqlite_path)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            await self._db.execute(
+                "DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),)
+            )
+            await self._db.commit()
+        return self._db
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str, default=None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        if self.sqlite_path:
+            db = await self._connect()
+            async with db.execute(
+                "SELECT value, expires_at FROM llm_cache "
+                "WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                self.hits += 1
+                self.sqlite_hits += 1
+                return value
+
+        self.misses += 1
+        return default
+
+    async def set(self, key: str, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+
+        if self.sqlite_path:
+            db = await self._connect()
+            await db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) "
+                "VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+            await db.commit()
+
+    async def clear(self):
+        self._entries.clear()
+        if self.sqlite_path:
+            db = await self._connect()
+            await db.execute("DELETE FROM llm_cache")
+            await db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "sqlite_hits": self.sqlite_hits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+llm_cache = LLMCache.from_env()
+
+
+def _cache_key(name: str, prompt_template: str, chat_history_text: str) -> str:
+    return LLMCache.make_key(
+        name,
+        prompt_template,
+        os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        chat_history_text,
+    )
+
+
+def cached(name: str, prompt_template: str):
+    """Cache an ``async (chat_history_text) -> result`` agent function.
+
+    The key covers the prompt template, the model deployment and the history,
+    so editing a prompt or switching deployments never serves stale results.
+    A bypassed request skips the lookup but still refreshes the entry.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(chat_history_text: str):
+            if not llm_cache.enabled:
+                return await func(chat_history_text)
+
+            key = _cache_key(name, prompt_template, chat_history_text)
+            if not cache_bypass_ctx.get():
+                result = await llm_cache.get(key)
+                if result is not None:
+                    return result
+
+            result = await func(chat_history_text)
+            await llm_cache.set(key, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def cached_stream(name: str, prompt_template: str):
+    """Like ``cached`` for an async generator of list items.
+
+    Shares entries with the ``cached`` function of the same name: a hit
+    replays the stored list, and a stream that runs to completion stores the
+    items it yielded. ``usage`` is passed through to ``func``; a hit leaves it
+    empty since no tokens were spent.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(chat_history_text: str, usage: dict = None):
+            if not llm_cache.enabled:
+                async for item in func(chat_history_text, usage=usage):
+                    yield item
+                return
+
+            key = _cache_key(name, prompt_template, chat_history_text)
+            if not cache_bypass_ctx.get():
+                result = await llm_cache.get(key)
+                if result is not None:
+                    for item in result:
+                        yield item
+                    return
+
+            result = []
+            async for item in func(chat_history_text, usage=usage):
+                result.append(item)
+                yield item
+            await llm_cache.set(key, result)
+
+        return wrapper
+
+    return decorator
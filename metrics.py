@@ -0,0 +1,276 @@
+"""Prometheus metrics, kept in memory by each worker process.
+
+Nothing is shared between workers: ``/metrics`` reports only the worker that
+answers it, and every sample carries that worker's pid as the ``worker``
+label. Scrape each worker separately (or run a single worker) and aggregate
+with ``sum without (worker)``; scraping through a shared port samples a
+different worker each time.
+"""
+
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Sequence, Tuple
+
+# Seconds; wide enough for both fast routes and long LLM streams
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+BYTE_BUCKETS = (1024, 8192, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self, const_labels: Dict[str, object] = None) -> str:
+        const_names = tuple(const_labels or ())
+        const_values = tuple((const_labels or {}).values())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self._samples():
+            labels = _format_labels(const_names + names, const_values + values)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield "_total", self.labelnames, values, child.value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # Counts are per bucket; the cumulative "le" counts are built on render
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._le = tuple(_format_value(float(b)) for b in self.buckets) + ("+Inf",)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        names = self.labelnames + ("le",)
+        for values, child in self._children.items():
+            cumulative = 0
+            for le, count in zip(self._le, child.counts):
+                cumulative += count
+                yield "_bucket", names, values + (le,), cumulative
+            yield "_sum", self.labelnames, values, child.sum
+            yield "_count", self.labelnames, values, child.count
+
+
+class FunctionMetric(_Metric):
+    """Metric whose samples are read from ``function`` at scrape time.
+
+    ``function`` returns ``{label_values: value}``; use it to expose counters
+    that other modules already keep (cache hits and the like) for free.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        labels: Sequence[str],
+        function: Callable[[], Dict[tuple, float]],
+    ):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.function = function
+
+    def _samples(self):
+        suffix = "_total" if self.type == "counter" else ""
+        for values, value in self.function().items():
+            yield suffix, self.labelnames, values, value
+
+
+class Registry:
+    """``const_labels()`` gives labels added to every sample on render."""
+
+    def __init__(self, const_labels: Callable[[], Dict[str, object]] = None):
+        self.const_labels = const_labels
+        self._metrics = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        const_labels = self.const_labels() if self.const_labels else None
+        return (
+            "\n".join(metric.render(const_labels) for metric in self._metrics.values())
+            + "\n"
+        )
+
+
+# Read on every render: workers are forked after this module is imported
+metrics_registry = Registry(lambda: {"worker": os.getpid()})
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+request_duration = metrics_registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time until the response headers are sent, per route",
+        ("route", "method", "status"),
+    )
+)
+
+llm_duration = metrics_registry.register(
+    Histogram(
+        "llm_request_duration_seconds",
+        "Duration of LLM calls, to the last token for streams",
+        ("function", "mode"),
+        LLM_BUCKETS,
+    )
+)
+llm_first_token = metrics_registry.register(
+    Histogram(
+        "llm_time_to_first_token_seconds",
+        "Time until a streamed LLM call yields its first text",
+        ("function",),
+        LLM_BUCKETS,
+    )
+)
+llm_tokens = metrics_registry.register(
+    Counter(
+        "llm_tokens",
+        "Tokens reported by the model, by direction",
+        ("function", "direction"),
+    )
+)
+llm_errors = metrics_registry.register(
+    Counter("llm_errors", "LLM calls that raised", ("function",))
+)
+
+search_duration = metrics_registry.register(
+    Histogram(
+        "search_request_duration_seconds",
+        "Duration of Bing web search requests",
+        ("outcome",),
+    )
+)
+search_requests = metrics_registry.register(
+    Counter(
+        "search_requests",
+        "Bing web search requests by outcome (ok, error or cancelled)",
+        ("outcome",),
+    )
+)
+
+storage_duration = metrics_registry.register(
+    Histogram(
+        "whiteboard_storage_duration_seconds",
+        "Duration of whiteboard data reads and writes that reach storage",
+        ("operation",),
+    )
+)
+storage_bytes = metrics_registry.register(
+    Histogram(
+        "whiteboard_storage_bytes",
+        "Size of whiteboard documents read from or written to storage",
+        ("operation",),
+        BYTE_BUCKETS,
+    )
+)
+
+
+def start_request_timer(request):
+    request.ctx.metrics_started = time.perf_counter()
+
+
+def observe_request(request, response):
+    """Response middleware recording the latency of the matched route.
+
+    Streaming responses are observed when their headers go out.
+    """
+    started = getattr(request.ctx, "metrics_started", None)
+    if started is None or response is None:
+        return
+    # The route template keeps the label set bounded
+    route = request.route.path if request.route is not None else "unmatched"
+    request_duration.labels(route, request.method, response.status).observe(
+        time.perf_counter() - started
+    )
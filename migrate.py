@@ -0,0 +1,53 @@
+"""Copy whiteboard_data/*.json boards into the node/edge tables.
+
+    python3 migrate.py [--data-dir whiteboard_data] [--overwrite]
+
+Run it once before switching a deployment to ``WHITEBOARD_STORAGE=sql``.
+Boards already present in the database are skipped unless ``--overwrite``.
+"""
+
+import argparse
+import asyncio
+
+from db import bind
+from models import create_schema
+from storage import FileStorage, SqlStorage
+
+
+async def migrate(source: FileStorage, target: SqlStorage, overwrite: bool = False):
+    migrated = []
+    for whiteboard_id in source.list_ids():
+        if not overwrite:
+            try:
+                await target.version(whiteboard_id)
+                continue
+            except FileNotFoundError:
+                pass
+
+        _, data = await source.read(whiteboard_id)
+        await target.write(whiteboard_id, data)
+        migrated.append(whiteboard_id)
+    return migrated
+
+
+async def run(data_dir: str, overwrite: bool):
+    async with bind.begin() as conn:
+        await conn.run_sync(create_schema)
+    try:
+        return await migrate(FileStorage(data_dir), SqlStorage(), overwrite)
+    finally:
+        await bind.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", default="whiteboard_data")
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    migrated = asyncio.run(run(args.data_dir, args.overwrite))
+    print(f"Migrated {len(migrated)} whiteboards")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
+import base64
+import json
 from datetime import datetime
 
-from sqlalchemy import Column, String, DateTime, JSON
+from sqlalchemy import Column, String, DateTime, JSON, Integer, Float, Index
+from sqlalchemy import inspect, select, text, tuple_, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import declarative_base, declared_attr
 
 Base = declarative_base()
 
@@ -15,17 +20,118 @@ class BaseModels(Base):
     updated_at = Column(DateTime, nullable=False)
     deleted_at = Column(DateTime, nullable=True)
 
+    @declared_attr.directive
+    def __table_args__(cls):
+        # Live-row listings filter on deleted_at and page by (updated_at, id)
+        return (
+            Index(
+                f"ix_{cls.__tablename__}_deleted_at_updated_at",
+                "deleted_at",
+                "updated_at",
+                "id",
+            ),
+        )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.created_at = datetime.now()
         self.updated_at = datetime.now()
 
 
+def encode_cursor(updated_at: datetime, id: str) -> str:
+    raw = json.dumps([updated_at.isoformat(), id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    """Inverse of ``encode_cursor``; raises ``ValueError`` on bad input."""
+    try:
+        updated_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(updated_at), str(id)
+    except (TypeError, ValueError, UnicodeError) as ex:
+        raise ValueError(f"Invalid cursor {cursor!r}") from ex
+
+
 class Whiteboard(BaseModels):
     __tablename__ = "whiteboard"
     name = Column(String(255), nullable=False)
     extra_metadata = Column(JSON, nullable=False, default={})
     ui_attributes = Column(JSON, nullable=False, default={})
+    # Bumped by every write; updates can require the version they last saw
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    FIELDS = (
+        "id",
+        "name",
+        "extra_metadata",
+        "ui_attributes",
+        "version",
+        "created_at",
+        "updated_at",
+        "deleted_at",
+    )
+
+    @classmethod
+    def list_query(
+        cls,
+        limit: int = None,
+        cursor: str = None,
+        fields=FIELDS,
+        name_prefix: str = None,
+    ):
+        """Live whiteboards, newest first, as ``(id, updated_at, *fields)`` rows.
+
+        Keyset pagination on ``(updated_at, id)``: ``cursor`` is the value
+        returned for the last row of the previous page (see ``page_rows``).
+        """
+        stmt = select(
+            cls.id, cls.updated_at, *[getattr(cls, field) for field in fields]
+        ).where(cls.deleted_at == None)
+        if name_prefix:
+            stmt = stmt.where(cls.name.startswith(name_prefix, autoescape=True))
+        if cursor:
+            updated_at, id = decode_cursor(cursor)
+            stmt = stmt.where(tuple_(cls.updated_at, cls.id) < tuple_(updated_at, id))
+        stmt = stmt.order_by(cls.updated_at.desc(), cls.id.desc())
+        if limit is not None:
+            stmt = stmt.limit(limit + 1)
+        return stmt
+
+    @classmethod
+    def bump_query(cls, id: str, expected_version: int = None, **values):
+        """UPDATE of a live whiteboard that bumps its version and ``updated_at``.
+
+        With ``expected_version`` it only matches while the board is still at
+        that version; it returns the new version, or no row if nothing matched.
+        The row stays locked until the transaction ends, so concurrent writers
+        cannot both pass the check.
+        """
+        stmt = update(cls).where(cls.id == id).where(cls.deleted_at == None)
+        if expected_version is not None:
+            stmt = stmt.where(cls.version == expected_version)
+        return (
+            stmt.values(version=cls.version + 1, updated_at=datetime.now(), **values)
+            .returning(cls.version)
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def page_rows(rows, limit: int = None, fields=FIELDS):
+        """Turn ``list_query`` rows into ``(dicts, next_cursor)``."""
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+
+        whiteboards = []
+        for row in rows:
+            whiteboard = {}
+            for field, value in zip(fields, row[2:]):
+                if isinstance(value, datetime):
+                    value = value.isoformat()
+                whiteboard[field] = value
+            whiteboards.append(whiteboard)
+        return whiteboards, next_cursor
 
     def to_dict(self):
         return {
@@ -33,6 +139,7 @@ class Whiteboard(BaseModels):
             "name": self.name,
             "extra_metadata": self.extra_metadata,
             "ui_attributes": self.ui_attributes,
+            "version": self.version,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
             "deleted_at": self.deleted_at.isoformat() if self.deleted_at else None,
@@ -44,6 +151,99 @@ class Whiteboard(BaseModels):
     async def delete(self, session: AsyncSession):
         self.deleted_at = datetime.now()
         self.updated_at = datetime.now()
+        self.version += 1
 
         session.add(self)
         await session.commit()
+
+
+class WhiteboardGraph(Base):
+    """Per-board header for graphs stored as node/edge rows.
+
+    ``version`` is bumped by every write so readers can tell whether a cached
+    copy of the graph is still current.
+    """
+
+    __tablename__ = "whiteboard_graph"
+    whiteboard_id = Column(String(255), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # Top-level document keys other than "graph"
+    attributes = Column(JSON, nullable=False, default={})
+    updated_at = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class WhiteboardNode(Base):
+    __tablename__ = "whiteboard_node"
+    whiteboard_id = Column(String(255), primary_key=True)
+    id = Column(String(255), primary_key=True)
+    # Position in the document's node list
+    seq = Column(Integer, nullable=False)
+    type = Column(String(64), nullable=True)
+    x = Column(Float, nullable=True)
+    y = Column(Float, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.now)
+    data = Column(JSON, nullable=False)
+    # The node's chat history messages (see graph.ChatHistory); NULL in rows
+    # written before the projection was stored
+    messages = Column(JSON, nullable=True)
+
+    __table_args__ = (
+        Index("ix_whiteboard_node_seq", "whiteboard_id", "seq"),
+        Index("ix_whiteboard_node_type", "whiteboard_id", "type", "seq"),
+        Index("ix_whiteboard_node_updated_at", "whiteboard_id", "updated_at"),
+        Index("ix_whiteboard_node_position", "whiteboard_id", "x", "y"),
+    )
+
+
+class WhiteboardEdge(Base):
+    __tablename__ = "whiteboard_edge"
+    whiteboard_id = Column(String(255), primary_key=True)
+    id = Column(String(255), primary_key=True)
+    seq = Column(Integer, nullable=False)
+    source = Column(String(255), nullable=True)
+    target = Column(String(255), nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.now)
+    data = Column(JSON, nullable=False)
+
+    __table_args__ = (
+        Index("ix_whiteboard_edge_seq", "whiteboard_id", "seq"),
+        Index("ix_whiteboard_edge_source", "whiteboard_id", "source"),
+        Index("ix_whiteboard_edge_target", "whiteboard_id", "target"),
+        Index("ix_whiteboard_edge_updated_at", "whiteboard_id", "updated_at"),
+    )
+
+
+# Columns added after their table was first created, as DDL for ADD COLUMN;
+# create_all leaves existing tables as they are
+ADDED_COLUMNS = {
+    "whiteboard": {"version": "INTEGER NOT NULL DEFAULT 1"},
+    "whiteboard_node": {"messages": "JSON"},
+}
+
+
+def _column_names(connection, table: str) -> set:
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+def create_schema(connection):
+    """``create_all`` plus what it leaves out of existing tables.
+
+    Columns in ``ADDED_COLUMNS`` and any missing indexes are added. Run
+    with ``AsyncConnection.run_sync`` at startup; safe to run from several
+    workers at once.
+    """
+    Base.metadata.create_all(connection)
+    for table, columns in ADDED_COLUMNS.items():
+        existing = _column_names(connection, table)
+        for name, ddl in columns.items():
+            if name in existing:
+                continue
+            try:
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            except DBAPIError:
+                # Another worker added it first
+                if name not in _column_names(connection, table):
+                    raise
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
@@ -0,0 +1,174 @@
+import asyncio
+import functools
+import hashlib
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _Broadcast:
+    """Items of one in-flight stream, replayed to every subscriber."""
+
+    def __init__(self):
+        self.items = []
+        self.usage = {}
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = None
+
+    def notify(self):
+        if self._changed is not None and not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = None
+
+    async def changed(self):
+        if self._changed is None:
+            self._changed = asyncio.get_running_loop().create_future()
+        # Shielded: one subscriber going away must not cancel the others' wait
+        await asyncio.shield(self._changed)
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key.
+
+    Unlike the LLM cache this only covers bursts: a key is forgotten as soon
+    as its call finishes. The shared call is cancelled once every caller
+    waiting on it has gone away.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+
+        self.calls = 0
+        self.shared = 0
+
+    @staticmethod
+    def make_key(name: str, *parts: str) -> str:
+        digest = hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+        return f"{name}:{digest}"
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        call = self._calls.get(key)
+        if call is None or call.task.cancelling():
+            self.calls += 1
+            call = self._calls[key] = _Call(asyncio.ensure_future(func()))
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    async def stream(
+        self, key: str, func: Callable[[dict], AsyncIterator], usage: dict = None
+    ):
+        """Yield the items of ``func(usage)``, shared with concurrent callers.
+
+        Late subscribers first get the items produced so far. ``usage`` is
+        updated with whatever the producer put in its own once it finishes.
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is None or broadcast.task.cancelling():
+            self.calls += 1
+            broadcast = self._streams[key] = _Broadcast()
+            broadcast.task = asyncio.ensure_future(self._produce(broadcast, func))
+            broadcast.task.add_done_callback(
+                lambda _: self._forget(self._streams, key, broadcast)
+            )
+        else:
+            self.shared += 1
+
+        broadcast.subscribers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(broadcast.items):
+                    yield broadcast.items[index]
+                    index += 1
+                if broadcast.done:
+                    break
+                await broadcast.changed()
+            if broadcast.error is not None:
+                raise broadcast.error
+            if usage is not None:
+                usage.update(broadcast.usage)
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.task.done():
+                broadcast.task.cancel()
+
+    @staticmethod
+    async def _produce(broadcast: _Broadcast, func):
+        items = func(broadcast.usage)
+        try:
+            async with aclosing(items):
+                async for item in items:
+                    broadcast.items.append(item)
+                    broadcast.notify()
+        except Exception as ex:
+            broadcast.error = ex
+        finally:
+            broadcast.done = True
+            broadcast.notify()
+
+    @staticmethod
+    def _forget(calls: dict, key: str, call):
+        if calls.get(key) is call:
+            del calls[key]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared}
+
+
+single_flight = SingleFlight()
+
+
+def coalesced(name: str):
+    """Share concurrent ``async (chat_history_text) -> result`` calls."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(chat_history_text: str):
+            key = SingleFlight.make_key(name, chat_history_text)
+            return await single_flight.do(key, lambda: func(chat_history_text))
+
+        return wrapper
+
+    return decorator
+
+
+def coalesced_stream(name: str):
+    """Fan one ``(chat_history_text, usage=None)`` async generator out to
+    every concurrent caller with the same history.
+
+    Each caller's ``usage`` dict is filled from the shared stream's when it
+    completes.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(chat_history_text: str, usage: dict = None):
+            key = SingleFlight.make_key(name, chat_history_text)
+            items = single_flight.stream(
+                key, lambda shared: func(chat_history_text, usage=shared), usage
+            )
+            async with aclosing(items):
+                async for item in items:
+                    yield item
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,632 @@
+import asyncio
+import fcntl
+import json
+import os
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime
+
+import aiofiles
+from sqlalchemy import delete, func, or_, select, update
+
+from graph import ChatHistory, apply_operations, node_messages, node_position
+from models import WhiteboardEdge, WhiteboardGraph, WhiteboardNode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def dumps(data) -> bytes:
+    """Compact UTF-8 JSON, using the fastest serializer available."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    if msgspec is not None:
+        return msgspec.json.encode(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(raw: bytes):
+    # Also reads the indented files written before the compact format
+    if orjson is not None:
+        return orjson.loads(raw)
+    if msgspec is not None:
+        return msgspec.json.decode(raw)
+    return json.loads(raw)
+
+
+async def write_atomic(path: str, raw: bytes, fsync: bool = True):
+    """Replace ``path`` with ``raw`` so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            await f.write(raw)
+            if fsync:
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class StorageConflict(Exception):
+    """The board changed since the version a write was based on."""
+
+
+class FileStorage:
+    """One JSON snapshot per board plus an append-only patch log.
+
+    Patches are appended to ``<id>.log`` and folded into the snapshot once the
+    log outgrows it; each log line records the snapshot version it applies
+    to. Writers in different processes are serialized with ``flock``. The chat
+    history projection is kept in ``<id>.history``, tagged with the version it
+    matches.
+    """
+
+    partial_reads = False
+
+    def __init__(self, root: str = "whiteboard_data"):
+        self.root = root
+        self.log_max_bytes = int(
+            os.environ.get("WHITEBOARD_PATCH_LOG_MAX_BYTES", 1024 * 1024)
+        )
+        self.fsync = os.environ.get("WHITEBOARD_FSYNC", "true").lower() == "true"
+
+    def path(self, whiteboard_id: str, suffix: str = "json") -> str:
+        return f"{self.root}/{whiteboard_id}.{suffix}"
+
+    @asynccontextmanager
+    async def lock(self, whiteboard_id: str):
+        # Serializes writers across worker processes without blocking the loop
+        fd = os.open(self.path(whiteboard_id, "lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.005)
+            yield
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 0, 0
+        return stat.st_mtime_ns, stat.st_size
+
+    async def version(self, whiteboard_id: str):
+        path = self.path(whiteboard_id)
+        snapshot_version = self._stat(path)
+        if snapshot_version == (0, 0):
+            raise FileNotFoundError(path)
+        return snapshot_version + self._stat(self.path(whiteboard_id, "log"))
+
+    @staticmethod
+    def size(version, data: dict) -> int:
+        return version[1] + version[3]
+
+    async def read(self, whiteboard_id: str):
+        version = await self.version(whiteboard_id)
+        async with aiofiles.open(self.path(whiteboard_id), "rb") as f:
+            data = loads(await f.read())
+
+        if version[3]:
+            base = list(version[:2])
+            async with aiofiles.open(self.path(whiteboard_id, "log"), "rb") as f:
+                for line in (await f.read()).splitlines():
+                    try:
+                        record = loads(line)
+                    except Exception:
+                        # Torn line from a worker that died mid-append
+                        continue
+                    if record["base"] == base:
+                        data = apply_operations(data, record["operations"])
+
+        return version, data
+
+    async def read_history(self, whiteboard_id: str):
+        """The snapshot's projection plus the changes logged since, if stored."""
+        version = await self.version(whiteboard_id)
+        try:
+            async with aiofiles.open(self.path(whiteboard_id, "history"), "rb") as f:
+                record = loads(await f.read())
+        except FileNotFoundError:
+            return None
+        if record["version"] != list(version[:2]):
+            return None
+        if not version[3]:
+            return ChatHistory(record["messages"])
+        if record.get("ids") is None:
+            return None
+
+        per_node = dict(zip(record["ids"], record["messages"]))
+        async with aiofiles.open(self.path(whiteboard_id, "log"), "rb") as f:
+            for line in (await f.read()).splitlines():
+                try:
+                    record = loads(line)
+                except Exception:
+                    continue
+                if record["base"] != list(version[:2]):
+                    continue
+                if "history" not in record:
+                    return None
+                for node_id, messages in record["history"]:
+                    if messages is None:
+                        per_node.pop(node_id, None)
+                    else:
+                        per_node[node_id] = messages
+        return ChatHistory(list(per_node.values()))
+
+    async def _write_history(self, whiteboard_id: str, version, data, history):
+        # Node ids key the changes appended to the log; boards with missing or
+        # repeated ids only get the projection until their next patch
+        ids = [node.get("id") for node in data.get("graph", {}).get("nodes", [])]
+        if None in ids or len(set(ids)) != len(ids):
+            ids = None
+        record = {
+            "version": list(version[:2]),
+            "ids": ids,
+            "messages": history.per_node,
+        }
+        # Derived data: a lost update is rebuilt from the board, so skip fsync
+        await write_atomic(self.path(whiteboard_id, "history"), dumps(record), False)
+
+    async def write(
+        self,
+        whiteboard_id: str,
+        data: dict,
+        history=None,
+        base_version=None,
+        session=None,
+    ):
+        # ``session`` is for SqlStorage; files are not part of a DB transaction
+        if base_version is not None and await self.version(whiteboard_id) != tuple(
+            base_version
+        ):
+            raise StorageConflict(whiteboard_id)
+        await write_atomic(self.path(whiteboard_id), dumps(data), fsync=self.fsync)
+
+        log_path = self.path(whiteboard_id, "log")
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        version = await self.version(whiteboard_id)
+        await self._write_history(
+            whiteboard_id, version, data, history or ChatHistory.from_data(data)
+        )
+        return version
+
+    async def append(
+        self,
+        whiteboard_id: str,
+        base_version,
+        operations,
+        data,
+        history=None,
+        session=None,
+    ):
+        version = await self.version(whiteboard_id)
+        if version != base_version:
+            raise StorageConflict(whiteboard_id)
+
+        record = {
+            "base": list(version[:2]),
+            "operations": operations,
+            "history": _history_changes(operations, data),
+        }
+        log_path = self.path(whiteboard_id, "log")
+        if version[3]:
+            self._drop_torn_line(log_path)
+        async with aiofiles.open(log_path, "ab") as f:
+            await f.write(dumps(record) + b"\n")
+
+        version = await self.version(whiteboard_id)
+        if version[3] > max(self.log_max_bytes, version[1]):
+            return await self.write(whiteboard_id, data, history)
+        return version
+
+    @staticmethod
+    def _drop_torn_line(log_path: str):
+        """Cut a partial last line off the log so the next record starts clean."""
+        with open(log_path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            f.truncate(f.read().rfind(b"\n") + 1)
+
+    async def delete(self, whiteboard_id: str):
+        os.remove(self.path(whiteboard_id))
+        for suffix in ("log", "history", "lock"):
+            path = self.path(whiteboard_id, suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def list_ids(self) -> list:
+        return sorted(
+            name[: -len(".json")]
+            for name in os.listdir(self.root)
+            if name.endswith(".json")
+        )
+
+
+def _history_changes(operations: list, data: dict) -> list:
+    """``[node_id, messages]`` pairs for the nodes ``operations`` changed.
+
+    ``messages`` is None for a deleted node; replaying the pairs in order on
+    the projection keyed by node id gives the projection of ``data``.
+    """
+    nodes = {node.get("id"): node for node in data["graph"]["nodes"]}
+    changes = []
+    for operation in operations:
+        op = operation["op"]
+        if not op.endswith("_node"):
+            continue
+        node_id = operation["node"]["id"] if op == "add_node" else operation["id"]
+        if op == "delete_node":
+            changes.append([node_id, None])
+        elif node_id in nodes:
+            changes.append([node_id, node_messages(nodes[node_id])])
+    return changes
+
+
+def _node_values(node: dict, now: datetime, messages: list = None) -> dict:
+    x, y = node_position(node)
+    return {
+        "type": node.get("type"),
+        "x": x,
+        "y": y,
+        "updated_at": now,
+        "data": node,
+        "messages": node_messages(node) if messages is None else messages,
+    }
+
+
+def _edge_values(edge: dict, now: datetime) -> dict:
+    return {
+        "source": edge.get("source"),
+        "target": edge.get("target"),
+        "updated_at": now,
+        "data": edge,
+    }
+
+
+def _item_id(item: dict, seq: int) -> str:
+    # Edges in older boards carry no id; key them by their position instead
+    return str(item["id"]) if item.get("id") is not None else f"_{seq}"
+
+
+class SqlStorage:
+    """Graphs stored as indexed node/edge rows next to the ``whiteboard`` table.
+
+    Readers can page through nodes or select only some of them without loading
+    the whole board. Writes are compare-and-swap on ``WhiteboardGraph.version``.
+    """
+
+    partial_reads = True
+
+    def __init__(self, sessionmaker=None):
+        if sessionmaker is None:
+            from db import async_session as sessionmaker
+
+        self.sessionmaker = sessionmaker
+
+    def lock(self, whiteboard_id: str):
+        # Writers are serialized by the version check instead
+        return nullcontext()
+
+    @asynccontextmanager
+    async def _transaction(self, session=None):
+        """A new transaction, or the caller's open ``session`` which it commits.
+
+        Joining the caller's transaction lets a board's data commit together
+        with its ``whiteboard`` row, and keeps SQLite from waiting on the
+        write lock that transaction already holds.
+        """
+        if session is not None:
+            yield session
+            return
+        async with self.sessionmaker() as session, session.begin():
+            yield session
+
+    @staticmethod
+    def size(version, data: dict) -> int:
+        # Rough estimate; serializing the graph just to weigh it costs too much
+        graph = data.get("graph", {})
+        return 512 * (len(graph.get("nodes", [])) + len(graph.get("edges", [])) + 1)
+
+    async def _version(self, session, whiteboard_id: str) -> int:
+        version = await session.scalar(
+            select(WhiteboardGraph.version).where(
+                WhiteboardGraph.whiteboard_id == whiteboard_id
+            )
+        )
+        if version is None:
+            raise FileNotFoundError(f"whiteboard {whiteboard_id}")
+        return version
+
+    async def version(self, whiteboard_id: str) -> int:
+        async with self.sessionmaker() as session:
+            return await self._version(session, whiteboard_id)
+
+    async def read(self, whiteboard_id: str):
+        async with self.sessionmaker() as session, session.begin():
+            graph = await session.get(WhiteboardGraph, whiteboard_id)
+            if graph is None:
+                raise FileNotFoundError(f"whiteboard {whiteboard_id}")
+
+            nodes = await session.scalars(
+                select(WhiteboardNode.data)
+                .where(WhiteboardNode.whiteboard_id == whiteboard_id)
+                .order_by(WhiteboardNode.seq)
+            )
+            edges = await session.scalars(
+                select(WhiteboardEdge.data)
+                .where(WhiteboardEdge.whiteboard_id == whiteboard_id)
+                .order_by(WhiteboardEdge.seq)
+            )
+            data = dict(graph.attributes or {})
+            data["graph"] = {"nodes": list(nodes), "edges": list(edges)}
+            return graph.version, data
+
+    async def read_page(
+        self, whiteboard_id: str, limit: int = None, cursor: str = None, viewport=None
+    ):
+        async with self.sessionmaker() as session, session.begin():
+            await self._version(session, whiteboard_id)
+
+            stmt = select(WhiteboardNode.seq, WhiteboardNode.data).where(
+                WhiteboardNode.whiteboard_id == whiteboard_id
+            )
+            if cursor:
+                stmt = stmt.where(WhiteboardNode.seq >= int(cursor))
+            if viewport is not None:
+                x_min, y_min, x_max, y_max = viewport
+                stmt = stmt.where(
+                    WhiteboardNode.x.between(x_min, x_max),
+                    WhiteboardNode.y.between(y_min, y_max),
+                )
+            stmt = stmt.order_by(WhiteboardNode.seq)
+            if limit is not None:
+                stmt = stmt.limit(limit + 1)
+            rows = (await session.execute(stmt)).all()
+
+            next_cursor = None
+            if limit is not None and len(rows) > limit:
+                next_cursor = str(rows[limit].seq)
+                rows = rows[:limit]
+            nodes = [row.data for row in rows]
+
+            node_ids = [node.get("id") for node in nodes]
+            edges = []
+            if node_ids:
+                edges = await session.scalars(
+                    select(WhiteboardEdge.data)
+                    .where(
+                        WhiteboardEdge.whiteboard_id == whiteboard_id,
+                        or_(
+                            WhiteboardEdge.source.in_(node_ids),
+                            WhiteboardEdge.target.in_(node_ids),
+                        ),
+                    )
+                    .order_by(WhiteboardEdge.seq)
+                )
+            return {"graph": {"nodes": nodes, "edges": list(edges)}}, next_cursor
+
+    async def read_history(self, whiteboard_id: str):
+        """The chat history projection of the board's text nodes.
+
+        Other nodes have no messages, so only text rows are selected (through
+        ``ix_whiteboard_node_type``). The result lines up with the text nodes
+        alone and must not be patched.
+        """
+        async with self.sessionmaker() as session, session.begin():
+            await self._version(session, whiteboard_id)
+            messages = list(
+                await session.scalars(
+                    select(WhiteboardNode.messages)
+                    .where(
+                        WhiteboardNode.whiteboard_id == whiteboard_id,
+                        WhiteboardNode.type == "text",
+                    )
+                    .order_by(WhiteboardNode.seq)
+                )
+            )
+        if None not in messages:
+            return ChatHistory(messages)
+
+        # Boards stored before the projection existed
+        _, nodes = await self.read_nodes_by_type(whiteboard_id, "text")
+        return ChatHistory([node_messages(node) for node in nodes])
+
+    async def read_nodes_by_type(self, whiteboard_id: str, node_type: str):
+        async with self.sessionmaker() as session, session.begin():
+            version = await self._version(session, whiteboard_id)
+            nodes = await session.scalars(
+                select(WhiteboardNode.data)
+                .where(
+                    WhiteboardNode.whiteboard_id == whiteboard_id,
+                    WhiteboardNode.type == node_type,
+                )
+                .order_by(WhiteboardNode.seq)
+            )
+            return version, list(nodes)
+
+    async def write(
+        self,
+        whiteboard_id: str,
+        data: dict,
+        history=None,
+        base_version=None,
+        session=None,
+    ) -> int:
+        """Replace the board; with ``base_version``, only if it is still current."""
+        now = datetime.now()
+        history = history or ChatHistory.from_data(data)
+        graph = data.get("graph", {})
+        values = dict(
+            attributes={k: v for k, v in data.items() if k != "graph"},
+            updated_at=now,
+        )
+        async with self._transaction(session) as session:
+            query = update(WhiteboardGraph).where(
+                WhiteboardGraph.whiteboard_id == whiteboard_id
+            )
+            if base_version is not None:
+                query = query.where(WhiteboardGraph.version == base_version)
+            version = await session.scalar(
+                query.values(version=WhiteboardGraph.version + 1, **values)
+                .returning(WhiteboardGraph.version)
+                .execution_options(synchronize_session=False)
+            )
+            if version is None:
+                if base_version is not None:
+                    raise StorageConflict(whiteboard_id)
+                version = 1
+                session.add(
+                    WhiteboardGraph(whiteboard_id=whiteboard_id, version=1, **values)
+                )
+
+            await session.execute(
+                delete(WhiteboardNode).where(
+                    WhiteboardNode.whiteboard_id == whiteboard_id
+                )
+            )
+            await session.execute(
+                delete(WhiteboardEdge).where(
+                    WhiteboardEdge.whiteboard_id == whiteboard_id
+                )
+            )
+            session.add_all(
+                WhiteboardNode(
+                    whiteboard_id=whiteboard_id,
+                    id=_item_id(node, seq),
+                    seq=seq,
+                    **_node_values(node, now, messages),
+                )
+                for seq, (node, messages) in enumerate(
+                    zip(graph.get("nodes", []), history.per_node)
+                )
+            )
+            session.add_all(
+                WhiteboardEdge(
+                    whiteboard_id=whiteboard_id,
+                    id=_item_id(edge, seq),
+                    seq=seq,
+                    **_edge_values(edge, now),
+                )
+                for seq, edge in enumerate(graph.get("edges", []))
+            )
+            return version
+
+    async def append(
+        self,
+        whiteboard_id: str,
+        base_version,
+        operations,
+        data,
+        history=None,
+        session=None,
+    ):
+        """Apply ``operations`` as row changes; ``data`` is the patched graph.
+
+        Each changed node row carries its own chat history messages, so the
+        projection is updated along with it.
+        """
+        now = datetime.now()
+        graph = data["graph"]
+        nodes = {node.get("id"): node for node in graph["nodes"]}
+        edges = {edge.get("id"): edge for edge in graph["edges"]}
+
+        async with self._transaction(session) as session:
+            result = await session.execute(
+                update(WhiteboardGraph)
+                .where(
+                    WhiteboardGraph.whiteboard_id == whiteboard_id,
+                    WhiteboardGraph.version == base_version,
+                )
+                .values(version=base_version + 1, updated_at=now)
+            )
+            if result.rowcount != 1:
+                raise StorageConflict(whiteboard_id)
+
+            for operation in operations:
+                op = operation["op"]
+                if op.endswith("_node"):
+                    kind, model, items, values = (
+                        "node",
+                        WhiteboardNode,
+                        nodes,
+                        _node_values,
+                    )
+                else:
+                    kind, model, items, values = (
+                        "edge",
+                        WhiteboardEdge,
+                        edges,
+                        _edge_values,
+                    )
+                item_id = operation.get(kind, operation).get("id")
+                key = (model.whiteboard_id == whiteboard_id, model.id == str(item_id))
+
+                if op.startswith("add_"):
+                    seq = await session.scalar(
+                        select(func.coalesce(func.max(model.seq) + 1, 0)).where(
+                            model.whiteboard_id == whiteboard_id
+                        )
+                    )
+                    # The item may be gone from ``data`` if the batch deletes it
+                    item = items.get(item_id, operation.get(kind))
+                    session.add(
+                        model(
+                            whiteboard_id=whiteboard_id,
+                            id=str(item_id),
+                            seq=seq,
+                            **values(item, now),
+                        )
+                    )
+                elif op.startswith("delete_"):
+                    await session.execute(delete(model).where(*key))
+                    if model is WhiteboardNode:
+                        await session.execute(
+                            delete(WhiteboardEdge).where(
+                                WhiteboardEdge.whiteboard_id == whiteboard_id,
+                                or_(
+                                    WhiteboardEdge.source == item_id,
+                                    WhiteboardEdge.target == item_id,
+                                ),
+                            )
+                        )
+                elif item_id in items:
+                    await session.execute(
+                        update(model).where(*key).values(**values(items[item_id], now))
+                    )
+                # Flush so later operations in the batch see this one
+                await session.flush()
+
+            return base_version + 1
+
+    async def delete(self, whiteboard_id: str):
+        async with self.sessionmaker() as session, session.begin():
+            for model in (WhiteboardNode, WhiteboardEdge, WhiteboardGraph):
+                await session.execute(
+                    delete(model).where(model.whiteboard_id == whiteboard_id)
+                )
+
+
+def create_storage():
+    backend = os.environ.get("WHITEBOARD_STORAGE", "file").lower()
+    if backend == "sql":
+        return SqlStorage()
+    return FileStorage()
@@ -0,0 +1,264 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, List
+
+from sanic.log import logger
+
+# Token fragments are held back until this many characters or milliseconds
+STREAM_COALESCE_CHARS = int(os.environ.get("STREAM_COALESCE_CHARS", 64))
+STREAM_COALESCE_MS = float(os.environ.get("STREAM_COALESCE_MS", 50))
+
+
+class JSONArrayParser:
+    """Incrementally parse the items of a JSON array from streamed text.
+
+    Anything before the opening ``[`` (such as a code fence) is skipped. Each
+    top-level item is decoded as soon as the ``,`` or ``]`` after it arrives,
+    so callers can forward items while the model is still generating.
+    """
+
+    def __init__(self):
+        self.done = False
+        self._buffer = ""
+        self._pos = 0
+        # Start of the current item in the buffer, or None before the "["
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> List:
+        if self.done:
+            return []
+
+        items = []
+        self._buffer += text
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            pos += 1
+            if self._start is None:
+                if char == "[":
+                    self._start = pos
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}" and self._depth > 0:
+                self._depth -= 1
+            elif char in ",]" and self._depth == 0:
+                item = buffer[self._start : pos - 1].strip()
+                if item:
+                    items.append(json.loads(item))
+                self._start = pos
+                if char == "]":
+                    self.done = True
+                    break
+
+        # Drop what has been consumed so the buffer only holds the open item
+        if self._start is not None:
+            self._buffer = buffer[self._start :]
+            pos -= self._start
+            self._start = 0
+        else:
+            self._buffer = ""
+            pos = 0
+        self._pos = pos
+        return items
+
+
+def encode_item(item, sse: bool = False) -> str:
+    data = json.dumps(item, ensure_ascii=False)
+    if sse:
+        return f"data: {data}\n\n"
+    return data + "\n"
+
+
+def _wants_sse(request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+async def _send_stream(
+    request,
+    source: AsyncIterator,
+    encode: Callable[[object], str],
+    content_type: str,
+    headers: dict = None,
+    end: Callable[[], str] = None,
+):
+    """Respond with ``encode(item)`` for each item of ``source``.
+
+    Stops as soon as the client disconnects. ``source`` (an async generator)
+    is closed either way, which stops the generation behind it. ``end()``,
+    if given, is the last message of a stream that ran to completion.
+    """
+    response = await request.respond(content_type=content_type, headers=headers)
+    async with aclosing(source):
+        async for item in source:
+            if request.transport.is_closing():
+                logger.info("Client disconnected, stopping stream")
+                return
+            await response.send(encode(item))
+
+    if end is not None:
+        await response.send(end())
+    await response.eof()
+
+
+async def stream_items(request, items: AsyncIterator):
+    """Send ``items`` as Server-Sent Events or NDJSON, one per item.
+
+    SSE is used when the client accepts ``text/event-stream``; the stream then
+    ends with an ``end`` event so clients can tell completion from a drop.
+    """
+    sse = _wants_sse(request)
+    await _send_stream(
+        request,
+        items,
+        lambda item: encode_item(item, sse),
+        "text/event-stream" if sse else "application/x-ndjson",
+        {"Cache-Control": "no-cache"},
+        (lambda: "event: end\ndata: {}\n\n") if sse else None,
+    )
+
+
+async def coalesce(
+    chunks: AsyncIterator[str],
+    min_chars: int = STREAM_COALESCE_CHARS,
+    max_delay: float = STREAM_COALESCE_MS / 1000,
+):
+    """Merge small text chunks until ``min_chars`` or ``max_delay`` is reached.
+
+    The delay is measured from the first held-back chunk, so a stalled model
+    never delays text it has already produced by more than ``max_delay``.
+    ``chunks`` is read by a helper task and closed when this generator is.
+    """
+    loop = asyncio.get_running_loop()
+    buffer = []
+    ready = []
+    state = {"size": 0, "timer": None, "wakeup": None}
+
+    def flush():
+        if state["timer"] is not None:
+            state["timer"].cancel()
+            state["timer"] = None
+        if buffer:
+            ready.append("".join(buffer))
+            buffer.clear()
+            state["size"] = 0
+        wakeup = state["wakeup"]
+        if wakeup is not None and not wakeup.done():
+            wakeup.set_result(None)
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                buffer.append(chunk)
+                state["size"] += len(chunk)
+                if state["size"] >= min_chars:
+                    flush()
+                elif state["timer"] is None:
+                    state["timer"] = loop.call_later(max_delay, flush)
+        finally:
+            await chunks.aclose()
+            flush()
+
+    task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            if not ready:
+                if task.done():
+                    break
+                state["wakeup"] = loop.create_future()
+                await asyncio.wait(
+                    {state["wakeup"], task}, return_when=asyncio.FIRST_COMPLETED
+                )
+                continue
+            pieces = ready[:]
+            ready.clear()
+            for piece in pieces:
+                yield piece
+        # Surface errors from the source
+        task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+
+
+def encode_event(data, event: str = None) -> str:
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_text(request, chunks: AsyncIterator[str], usage: dict = None):
+    """Stream generated text to the client, coalescing token fragments.
+
+    With ``Accept: text/event-stream`` each piece is a ``{"content": ...}``
+    event and the stream ends with a ``done`` event carrying ``usage`` (when
+    the model reported it) and delivery counters. Otherwise the raw text is
+    written as before. Generation stops as soon as the client disconnects.
+    """
+    sse = _wants_sse(request)
+    started = time.perf_counter()
+    sent = {"events": 0, "chars": 0}
+
+    def encode(piece: str) -> str:
+        sent["events"] += 1
+        sent["chars"] += len(piece)
+        return encode_event({"content": piece}) if sse else piece
+
+    def done() -> str:
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        return encode_event(
+            {"usage": usage or None, **sent, "elapsed_ms": elapsed_ms}, event="done"
+        )
+
+    await _send_stream(
+        request,
+        coalesce(chunks),
+        encode,
+        "text/event-stream" if sse else "application/json",
+        {"Cache-Control": "no-cache"} if sse else None,
+        done if sse else None,
+    )
+
+
+async def stream_events(request, events: AsyncIterator):
+    """Send ``(event, data)`` pairs as Server-Sent Events or NDJSON.
+
+    SSE clients get named events followed by a final ``done`` event; NDJSON
+    lines are ``{"event": ..., "data": ...}`` objects.
+    """
+    sse = _wants_sse(request)
+
+    def encode(pair) -> str:
+        event, data = pair
+        if sse:
+            return encode_event(data, event=event)
+        return encode_item({"event": event, "data": data})
+
+    await _send_stream(
+        request,
+        events,
+        encode,
+        "text/event-stream" if sse else "application/x-ndjson",
+        {"Cache-Control": "no-cache"},
+        (lambda: encode_event({}, event="done")) if sse else None,
+    )
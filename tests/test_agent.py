@@ -1,6 +1,20 @@
+import asyncio
+import time
+
 import pytest
 
-from agent import ChatGPTAgent, get_related_questions
+import agent as agent_module
+from agent import AgentRegistry, ChatGPTAgent, get_related_questions
+
+
+@pytest.fixture
+def fake_env(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_OPENAI_DEPLOYMENT_NAME", "test")
+    monkeypatch.setenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "test")
+    monkeypatch.setenv("BING_SEARCH_V7_SUBSCRIPTION_KEY", "test")
+    monkeypatch.setenv("BING_SEARCH_V7_ENDPOINT", "https://example.com/")
 
 
 @pytest.mark.asyncio
@@ -28,5 +42,57 @@ async def test_get_related_questions():
     chat_history_text = """user: 我想要去旅游
 bot: 你想去哪里？
 user: 云南"""
-    result = get_related_questions(chat_history_text)
+    result = await get_related_questions(chat_history_text)
     assert result != ""
+
+
+@pytest.mark.asyncio
+async def test_registry_reuses_chatgpt_agent(fake_env):
+    registry = AgentRegistry()
+    agent = await registry.get_chatgpt_agent()
+    assert await registry.get_chatgpt_agent() is agent
+    assert agent.model.http_async_client is registry.http_async_client
+
+    await registry.close()
+    assert registry.chatgpt_agent is None
+    assert registry.http_async_client is None
+
+
+@pytest.mark.asyncio
+async def test_failed_warm_up_is_not_ready(monkeypatch):
+    monkeypatch.delenv("AZURE_OPENAI_ENDPOINT", raising=False)
+    registry = AgentRegistry()
+    await registry.warm_up()
+    assert not registry.warm
+    assert registry.chatgpt_agent is None
+
+
+@pytest.mark.asyncio
+async def test_search_fan_out_returns_early(fake_env, monkeypatch):
+    delays = {"fast": 0.05, "medium": 0.1, "slow": 5}
+    cancelled = []
+
+    async def fake_search(self, query):
+        try:
+            await asyncio.sleep(delays[query])
+        except asyncio.CancelledError:
+            cancelled.append(query)
+            raise
+        page = {"name": query, "url": f"https://{query}", "snippet": query}
+        return {"webPages": {"value": [page]}}
+
+    async def fake_keywords(chat_history_text):
+        return list(delays)
+
+    monkeypatch.setattr(agent_module.SearchAgent, "search", fake_search)
+    monkeypatch.setattr(agent_module, "get_search_keywords", fake_keywords)
+    monkeypatch.setattr(agent_module, "registry", AgentRegistry())
+
+    started = time.perf_counter()
+    results = await agent_module.get_search_results("user: hi", limit=2)
+    assert time.perf_counter() - started < 1
+    assert [r["name"] for r in results] == ["fast", "medium"]
+
+    await asyncio.sleep(0.01)
+    assert cancelled == ["slow"]
+    await agent_module.registry.close()
@@ -0,0 +1,106 @@
+import time
+from contextlib import aclosing
+
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+
+from cassette import Cassette, CassetteChatModel, CassetteMiss
+
+MESSAGES = [HumanMessage(content="Plan a trip to Yunnan")]
+USAGE = {"input_tokens": 5, "output_tokens": 3, "total_tokens": 8}
+
+
+class FakeModel:
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        return AIMessage(content="Go to Dali", usage_metadata=USAGE)
+
+    def invoke(self, messages):
+        self.calls += 1
+        return AIMessage(content="Go to Dali", usage_metadata=USAGE)
+
+    async def astream(self, messages):
+        self.calls += 1
+        for piece in ("Go ", "to ", "Dali"):
+            yield AIMessageChunk(content=piece)
+        yield AIMessageChunk(content="", usage_metadata=USAGE)
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+@pytest.mark.asyncio
+async def test_replays_recorded_calls_without_the_model(tmp_path):
+    model = FakeModel()
+    recorder = CassetteChatModel(Cassette("record", str(tmp_path)), model)
+    reply = await recorder.ainvoke(MESSAGES)
+    chunks = await collect(recorder.astream(MESSAGES))
+    assert model.calls == 2
+
+    player = CassetteChatModel(Cassette("replay", str(tmp_path), "instant"))
+    replayed = await player.ainvoke(MESSAGES)
+    assert replayed.content == reply.content
+    assert replayed.usage_metadata == USAGE
+    replayed_chunks = await collect(player.astream(MESSAGES))
+    assert [c.content for c in replayed_chunks] == [c.content for c in chunks]
+    assert replayed_chunks[-1].usage_metadata == USAGE
+    assert player.invoke(MESSAGES).content == "Go to Dali"
+
+    with pytest.raises(CassetteMiss):
+        await player.ainvoke([HumanMessage(content="Something else")])
+
+
+@pytest.mark.asyncio
+async def test_replay_at_recorded_speed(tmp_path):
+    recorder = Cassette("record", str(tmp_path))
+
+    async def slow_search():
+        time.sleep(0.05)
+        return {"webPages": {"value": []}}
+
+    response = await recorder.search("yunnan", slow_search)
+
+    for timing, slow in (("recorded", True), ("instant", False)):
+        player = Cassette("replay", str(tmp_path), timing)
+        started = time.perf_counter()
+        assert await player.search("yunnan", None) == response
+        assert (time.perf_counter() - started >= 0.05) == slow
+
+
+@pytest.mark.asyncio
+async def test_failed_streams_are_not_recorded(tmp_path):
+    async def failing():
+        yield AIMessageChunk(content="Go ")
+        raise RuntimeError("upstream failed")
+
+    cassette = Cassette("record", str(tmp_path))
+    with pytest.raises(RuntimeError):
+        await collect(cassette.stream(MESSAGES, failing))
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_streams_read_early_do_not_replace_full_recordings(tmp_path):
+    async def read_first(stream):
+        async with aclosing(stream):
+            async for chunk in stream:
+                return chunk
+
+    model = FakeModel()
+    recorder = CassetteChatModel(Cassette("record", str(tmp_path)), model)
+    await read_first(recorder.astream(MESSAGES))
+
+    # A cut-off recording replays as far as it goes, then misses
+    player = CassetteChatModel(Cassette("replay", str(tmp_path), "instant"))
+    assert (await read_first(player.astream(MESSAGES))).content == "Go "
+    with pytest.raises(CassetteMiss):
+        await collect(player.astream(MESSAGES))
+
+    chunks = await collect(recorder.astream(MESSAGES))
+    await read_first(recorder.astream(MESSAGES))
+    replayed = await collect(player.astream(MESSAGES))
+    assert [c.content for c in replayed] == [c.content for c in chunks]
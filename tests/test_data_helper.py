@@ -0,0 +1,486 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import data_helper
+import storage
+from data_helper import (
+    DocumentCache,
+    PatchError,
+    WhiteboardData,
+    document_cache,
+    history_cache,
+)
+from graph import ChatHistory, apply_operations
+
+
+def make_node(node_id, content, created_by="user"):
+    return {
+        "id": node_id,
+        "type": "text",
+        "content": content,
+        "created_by": created_by,
+        "updated_at": "2024-01-01T00:00:00",
+    }
+
+
+@pytest.fixture
+def whiteboard_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "0")
+    (tmp_path / "whiteboard_data").mkdir()
+    monkeypatch.setattr(data_helper, "storage", storage.FileStorage())
+    document_cache.clear()
+    history_cache.clear()
+    yield tmp_path
+    document_cache.clear()
+    history_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_chat_history_from_nodes(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(
+        {
+            "graph": {
+                "nodes": [
+                    make_node("n1", "I want to travel"),
+                    make_node("n2", {"question": "Where?", "answer": "Yunnan"}),
+                    {"id": "n3", "type": "image", "content": "x.png"},
+                ],
+                "edges": [],
+            }
+        }
+    )
+
+    assert await whiteboard_data.load_as_chat_history_text() == (
+        "user: I want to travel\nbot: Where?\nuser: Yunnan"
+    )
+
+
+@pytest.mark.asyncio
+async def test_hot_board_is_served_from_cache(whiteboard_dir, monkeypatch):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await WhiteboardData("wb").load()
+
+    def fail_open(*args, **kwargs):
+        raise AssertionError("cache miss")
+
+    monkeypatch.setattr(storage.aiofiles, "open", fail_open)
+    assert await whiteboard_data.load() == {"graph": {"nodes": [], "edges": []}}
+    assert await whiteboard_data.load_as_chat_history() == []
+
+
+@pytest.mark.asyncio
+async def test_external_write_invalidates_cache(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    assert await whiteboard_data.load_as_chat_history() == []
+
+    # Simulate another worker process rewriting the board
+    path = whiteboard_dir / "whiteboard_data" / "wb.json"
+    path.write_text(json.dumps({"graph": {"nodes": [make_node("n1", "Hi")]}}))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert await whiteboard_data.load_as_chat_history_text() == "user: Hi"
+
+
+def test_document_cache_evicts_by_size():
+    cache = DocumentCache(max_bytes=100)
+    cache.put("a", (1, 60), 60, {})
+    cache.put("b", (1, 30), 30, {})
+    assert cache.get("a", (1, 60)) is not None
+
+    cache.put("c", (1, 40), 40, {})
+    assert cache.get("b", (1, 30)) is None
+    assert cache.get("a", (1, 60)) is not None
+    assert cache.total_bytes == 100
+
+    assert cache.put("d", (1, 200), 200, {}) is None
+    assert cache.get("d", (1, 200)) is None
+
+
+@pytest.mark.asyncio
+async def test_patch_appends_to_log_and_replays(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(
+        {"graph": {"nodes": [make_node("n1", "Hi")] * 50, "edges": []}}
+    )
+    snapshot = (whiteboard_dir / "whiteboard_data" / "wb.json").read_text()
+
+    await whiteboard_data.patch(
+        [
+            {"op": "add_node", "node": make_node("n2", "Yunnan")},
+            {"op": "move_node", "id": "n2", "position": {"x": 1, "y": 2}},
+            {"op": "update_node", "id": "n2", "fields": {"content": "Tibet"}},
+        ]
+    )
+    assert (whiteboard_dir / "whiteboard_data" / "wb.json").read_text() == snapshot
+
+    document_cache.clear()
+    data = await whiteboard_data.load()
+    node = data["graph"]["nodes"][-1]
+    assert node["content"] == "Tibet"
+    assert node["ui_attributes"] == {"position": {"x": 1, "y": 2}}
+
+
+@pytest.mark.asyncio
+async def test_patch_log_is_compacted(whiteboard_dir, monkeypatch):
+    monkeypatch.setattr(data_helper.storage, "log_max_bytes", 0)
+    whiteboard_data = await WhiteboardData.create("wb")
+    for i in range(5):
+        await whiteboard_data.patch(
+            [{"op": "add_node", "node": make_node(f"n{i}", f"message {i}")}]
+        )
+    await whiteboard_data.patch([{"op": "delete_node", "id": "n0"}])
+
+    assert (whiteboard_dir / "whiteboard_data" / "wb.log").stat().st_size < (
+        whiteboard_dir / "whiteboard_data" / "wb.json"
+    ).stat().st_size
+
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == "\n".join(
+        f"user: message {i}" for i in range(1, 5)
+    )
+
+
+@pytest.mark.asyncio
+async def test_invalid_patch_is_rejected(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    with pytest.raises(PatchError):
+        await whiteboard_data.patch(
+            [
+                {"op": "add_node", "node": make_node("n1", "Hi")},
+                {"op": "delete_node", "id": "missing"},
+            ]
+        )
+
+    assert await whiteboard_data.load() == {"graph": {"nodes": [], "edges": []}}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_patches_are_serialized(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await asyncio.gather(
+        *[
+            WhiteboardData("wb").patch(
+                [{"op": "add_node", "node": make_node(f"n{i}", str(i))}]
+            )
+            for i in range(20)
+        ]
+    )
+
+    document_cache.clear()
+    data = await whiteboard_data.load()
+    assert sorted(node["id"] for node in data["graph"]["nodes"]) == sorted(
+        f"n{i}" for i in range(20)
+    )
+
+
+@pytest.mark.asyncio
+async def test_reads_legacy_format_and_writes_compact(whiteboard_dir):
+    path = whiteboard_dir / "whiteboard_data" / "wb.json"
+    legacy = {"graph": {"nodes": [make_node("n1", "你好")], "edges": []}}
+    path.write_text(json.dumps(legacy, indent=4, ensure_ascii=False))
+
+    whiteboard_data = WhiteboardData("wb")
+    assert await whiteboard_data.load() == legacy
+
+    await whiteboard_data.update(legacy)
+    raw = path.read_bytes()
+    assert b"\n" not in raw and b"    " not in raw
+    assert json.loads(raw) == legacy
+    assert sorted(os.listdir(whiteboard_dir / "whiteboard_data")) == [
+        "wb.history",
+        "wb.json",
+        "wb.lock",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_failed_write_keeps_previous_board(whiteboard_dir, monkeypatch):
+    whiteboard_data = await WhiteboardData.create("wb")
+
+    def fail_dumps(data):
+        raise TypeError("not serializable")
+
+    monkeypatch.setattr(storage, "dumps", fail_dumps)
+    with pytest.raises(TypeError):
+        await whiteboard_data.update({"graph": {"nodes": [object()], "edges": []}})
+
+    document_cache.clear()
+    assert await whiteboard_data.load() == {"graph": {"nodes": [], "edges": []}}
+
+
+@pytest.mark.asyncio
+async def test_torn_log_line_is_ignored(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "Hi")}])
+    with open(whiteboard_dir / "whiteboard_data" / "wb.log", "ab") as f:
+        f.write(b'{"base": [1, 2], "operat')
+
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == "user: Hi"
+
+
+@pytest.mark.asyncio
+async def test_append_after_torn_log_line_is_kept(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "Hi")}])
+    log_path = whiteboard_dir / "whiteboard_data" / "wb.log"
+    with open(log_path, "ab") as f:
+        f.write(b'{"base": [1, 2], "operat')
+
+    document_cache.clear()
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n2", "Yo")}])
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n3", "!")}])
+    assert b'"base": [1, 2]' not in log_path.read_bytes()
+
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == (
+        "user: Hi\nuser: Yo\nuser: !"
+    )
+
+
+@pytest.mark.asyncio
+async def test_rapid_updates_are_coalesced(whiteboard_dir, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "0.05")
+    whiteboard_data = await WhiteboardData.create("wb")
+    path = whiteboard_dir / "whiteboard_data" / "wb.json"
+
+    writes = []
+    write_atomic = storage.write_atomic
+
+    async def counting_write_atomic(*args, **kwargs):
+        writes.append(args[0])
+        await write_atomic(*args, **kwargs)
+
+    monkeypatch.setattr(storage, "write_atomic", counting_write_atomic)
+    for i in range(10):
+        nodes = [make_node(f"n{j}", str(j)) for j in range(i + 1)]
+        await whiteboard_data.update({"graph": {"nodes": nodes, "edges": []}})
+    await whiteboard_data.patch([{"op": "delete_node", "id": "n0"}])
+
+    # Reads see the buffered state before anything reaches the disk
+    assert len((await whiteboard_data.load())["graph"]["nodes"]) == 9
+    assert json.loads(path.read_text())["graph"]["nodes"] == []
+
+    await asyncio.sleep(0.1)
+    assert writes == ["whiteboard_data/wb.json", "whiteboard_data/wb.history"]
+    assert len(json.loads(path.read_text())["graph"]["nodes"]) == 9
+
+
+@pytest.mark.asyncio
+async def test_buffered_patches_flush_as_one_log_record(whiteboard_dir, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    for i in range(3):
+        await whiteboard_data.patch(
+            [{"op": "add_node", "node": make_node(f"n{i}", str(i))}]
+        )
+
+    log_path = whiteboard_dir / "whiteboard_data" / "wb.log"
+    assert not log_path.exists()
+
+    await WhiteboardData.flush_all()
+    assert len(log_path.read_text().splitlines()) == 1
+
+    document_cache.clear()
+    assert (
+        await whiteboard_data.load_as_chat_history_text() == "user: 0\nuser: 1\nuser: 2"
+    )
+
+
+@pytest.mark.asyncio
+async def test_buffered_patch_is_rebased_on_external_write(whiteboard_dir, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "1")}])
+
+    # Another worker process saves the board while our patch is buffered
+    path = whiteboard_dir / "whiteboard_data" / "wb.json"
+    path.write_text(json.dumps({"graph": {"nodes": [make_node("n0", "0")]}}))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    await WhiteboardData.flush_all()
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == "user: 0\nuser: 1"
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_kept_and_retried(whiteboard_dir, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "1")}])
+
+    append = storage.FileStorage.append
+
+    async def failing_append(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(storage.FileStorage, "append", failing_append)
+    await WhiteboardData.flush_all()
+    assert "wb" in data_helper._pending
+
+    monkeypatch.setattr(storage.FileStorage, "append", append)
+    await WhiteboardData.flush_all()
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == "user: 1"
+
+
+@pytest.mark.asyncio
+async def test_buffered_update_keeps_concurrent_patch(whiteboard_dir, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n0", "0")}])
+    await WhiteboardData.flush_all()
+    await whiteboard_data.update(
+        {"graph": {"nodes": [make_node("n0", "zero"), make_node("n2", "2")]}}
+    )
+
+    # Another worker process patches the board while the update is buffered
+    other = storage.FileStorage()
+    operations = [{"op": "add_node", "node": make_node("n1", "1")}]
+    version, data = await other.read("wb")
+    await other.append("wb", version, operations, apply_operations(data, operations))
+
+    await WhiteboardData.flush_all()
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == (
+        "user: zero\nuser: 1\nuser: 2"
+    )
+
+
+@pytest.mark.asyncio
+async def test_buffered_patch_conflicting_with_external_write_fails(
+    whiteboard_dir, monkeypatch
+):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "1")}])
+    await WhiteboardData.flush_all()
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n2", "2")}])
+
+    # Another worker deletes n1 while our patch is buffered
+    other = storage.FileStorage()
+    operations = [{"op": "delete_node", "id": "n1"}]
+    version, data = await other.read("wb")
+    await other.append("wb", version, operations, apply_operations(data, operations))
+
+    with pytest.raises(PatchError):
+        await whiteboard_data.patch(
+            [{"op": "update_node", "id": "n1", "fields": {"content": "one"}}]
+        )
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == "user: 2"
+
+
+@pytest.mark.asyncio
+async def test_data_version_changes_when_buffered_data_is_flushed(
+    whiteboard_dir, monkeypatch
+):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    stored = await whiteboard_data.data_version()
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "1")}])
+
+    # Other workers still serve the stored data, this one the buffered data
+    buffered = await whiteboard_data.data_version()
+    await WhiteboardData.flush_all()
+    flushed = await whiteboard_data.data_version()
+    assert len({stored, buffered, flushed}) == 3
+    assert await WhiteboardData("missing").data_version() == ""
+
+
+@pytest.mark.asyncio
+async def test_chat_history_projection_follows_patches(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(
+        {"graph": {"nodes": [make_node("n0", "0"), make_node("n1", "1")]}}
+    )
+    await whiteboard_data.patch(
+        [
+            {"op": "add_node", "node": make_node("n2", {"question": "Where?"})},
+            {"op": "update_node", "id": "n1", "fields": {"content": "one"}},
+            {"op": "delete_node", "id": "n0"},
+            {"op": "add_node", "node": {"id": "img", "type": "image"}},
+        ]
+    )
+
+    entry = await whiteboard_data._load_cached()
+    assert entry.history.per_node == ChatHistory.from_data(entry.data).per_node
+    assert await whiteboard_data.load_as_chat_history_text() == (
+        "user: one\nbot: Where?"
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_history_is_read_without_the_board(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "Hi")}])
+    document_cache.clear()
+
+    async def fail_read(whiteboard_id):
+        raise AssertionError("board read")
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(data_helper.storage, "read", fail_read)
+        assert await whiteboard_data.load_as_chat_history_text() == "user: Hi"
+
+    # A stale projection is ignored once the board changes underneath it
+    path = whiteboard_dir / "whiteboard_data" / "wb.json"
+    path.write_text(json.dumps({"graph": {"nodes": [make_node("n0", "0")]}}))
+    assert await whiteboard_data.load_as_chat_history_text() == "user: 0"
+
+
+@pytest.mark.asyncio
+async def test_patch_logs_only_the_changed_projection(whiteboard_dir):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(
+        {"graph": {"nodes": [make_node("n0", "0"), make_node("n1", "1")]}}
+    )
+    history_path = whiteboard_dir / "whiteboard_data" / "wb.history"
+    projection = history_path.read_bytes()
+
+    await whiteboard_data.patch(
+        [
+            {"op": "delete_node", "id": "n0"},
+            {"op": "add_node", "node": make_node("n0", "zero")},
+            {"op": "update_node", "id": "n1", "fields": {"content": "one"}},
+        ]
+    )
+    assert history_path.read_bytes() == projection
+
+    document_cache.clear()
+    history = await data_helper.storage.read_history("wb")
+    assert history.text == "user: one\nuser: zero"
+
+
+@pytest.mark.asyncio
+async def test_stored_chat_history_is_cached_by_version(whiteboard_dir, monkeypatch):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n1", "Hi")}])
+    document_cache.clear()
+
+    reads = []
+    read_history = data_helper.storage.read_history
+
+    async def counting_read_history(whiteboard_id):
+        reads.append(whiteboard_id)
+        return await read_history(whiteboard_id)
+
+    monkeypatch.setattr(data_helper.storage, "read_history", counting_read_history)
+    for _ in range(5):
+        assert await whiteboard_data.load_as_chat_history_text() == "user: Hi"
+    assert reads == ["wb"]
+
+    # Another worker's write is noticed
+    other = storage.FileStorage()
+    operations = [{"op": "add_node", "node": make_node("n2", "Yo")}]
+    version, data = await other.read("wb")
+    await other.append("wb", version, operations, apply_operations(data, operations))
+    assert await whiteboard_data.load_as_chat_history_text() == "user: Hi\nuser: Yo"
+    assert reads == ["wb", "wb"]
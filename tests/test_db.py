@@ -0,0 +1,29 @@
+import pytest
+from sqlalchemy import text
+
+from db import create_engine
+
+
+@pytest.mark.asyncio
+async def test_sqlite_engine_applies_pragmas(tmp_path):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    try:
+        async with engine.connect() as conn:
+            journal_mode = (await conn.execute(text("PRAGMA journal_mode"))).scalar()
+            synchronous = (await conn.execute(text("PRAGMA synchronous"))).scalar()
+        assert journal_mode == "wal"
+        # NORMAL
+        assert synchronous == 1
+        assert engine.echo is False
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_in_memory_engine_has_no_pool_sizing():
+    engine = create_engine("sqlite+aiosqlite://", pragmas={})
+    try:
+        async with engine.connect() as conn:
+            assert (await conn.execute(text("SELECT 1"))).scalar() == 1
+    finally:
+        await engine.dispose()
@@ -0,0 +1,127 @@
+import threading
+
+import pytest
+
+import history
+from history import HistoryCompactor, chunk_lines, count_tokens, split_history
+from llm_cache import LLMCache
+
+
+def make_messages(count):
+    return [
+        {"sender": "user" if i % 2 else "bot", "content": f"message {i}"}
+        for i in range(count)
+    ]
+
+
+def test_split_history_keeps_recent_turns_within_budget():
+    messages = make_messages(50)
+    older, recent = split_history(messages, budget=40)
+
+    assert older + recent == [f"{m['sender']}: {m['content']}" for m in messages]
+    assert recent[-1] == "user: message 49"
+    assert sum(count_tokens(line) + 1 for line in recent) <= 40
+    assert older
+
+    # The last turn is kept even if it alone is over budget
+    assert split_history(messages, budget=0) == (older + recent[:-1], recent[-1:])
+
+
+@pytest.mark.asyncio
+async def test_summary_is_extended_with_new_turns_only():
+    compactor = HistoryCompactor(budget=40, cache=LLMCache())
+    calls = []
+
+    async def summarize(summary, history):
+        calls.append((summary, history))
+        return f"summary of {len(calls)}"
+
+    messages = make_messages(30)
+    text = await compactor.compact("wb", messages, summarize)
+    assert text.startswith("summary: summary of 1\n")
+    assert text.endswith("user: message 29")
+    assert calls[0][0] == ""
+
+    # Unchanged history reuses the cached summary
+    assert await compactor.compact("wb", messages, summarize) == text
+    assert len(calls) == 1
+
+    # New turns push old ones out of the window; only those are summarized
+    await compactor.compact("wb", make_messages(40), summarize)
+    assert calls[1][0] == "summary of 1"
+    assert calls[1][1].startswith("bot: message ")
+    assert "message 0\n" not in calls[1][1]
+
+
+@pytest.mark.asyncio
+async def test_summary_is_rebuilt_when_old_turns_change():
+    compactor = HistoryCompactor(budget=40, cache=LLMCache())
+    calls = []
+
+    async def summarize(summary, history):
+        calls.append((summary, history))
+        return "summary"
+
+    messages = make_messages(30)
+    await compactor.compact("wb", messages, summarize)
+    messages[0] = {"sender": "bot", "content": "edited"}
+    await compactor.compact("wb", messages, summarize)
+
+    assert calls[1][0] == ""
+    assert calls[1][1].startswith("bot: edited")
+
+
+@pytest.mark.asyncio
+async def test_short_history_is_returned_verbatim():
+    compactor = HistoryCompactor(budget=1000, cache=LLMCache())
+
+    async def summarize(summary, history):
+        raise AssertionError("summarized")
+
+    text = await compactor.compact("wb", make_messages(3), summarize)
+    assert text == "bot: message 0\nuser: message 1\nbot: message 2"
+
+
+def test_chunk_lines_stays_within_budget():
+    lines = [f"user: message {i}" for i in range(30)] + ["bot: " + "long " * 100]
+    chunks = chunk_lines(lines, budget=20)
+
+    assert [line for chunk in chunks for line in chunk][:30] == lines[:30]
+    assert chunks[-1][0].startswith("bot: long")
+    for chunk in chunks:
+        assert sum(count_tokens(line) + 1 for line in chunk) <= 20
+
+
+@pytest.mark.asyncio
+async def test_long_history_is_summarized_in_chunks():
+    compactor = HistoryCompactor(budget=40, cache=LLMCache(), chunk_budget=30)
+    calls = []
+
+    async def summarize(summary, history):
+        calls.append((summary, history))
+        return f"summary of {len(calls)}"
+
+    text = await compactor.compact("wb", make_messages(30), summarize)
+    assert len(calls) > 1
+    assert [summary for summary, _ in calls[1:]] == [
+        f"summary of {i}" for i in range(1, len(calls))
+    ]
+    assert all(count_tokens(history) <= 30 for _, history in calls)
+    assert text.startswith(f"summary: summary of {len(calls)}\n")
+
+
+@pytest.mark.asyncio
+async def test_tokenizer_is_loaded_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def load():
+        threads.append(threading.current_thread())
+        history._encoding = False
+        return False
+
+    monkeypatch.setattr(history, "_encoding", None)
+    monkeypatch.setattr(history, "_load_encoding", load)
+    await history.load_encoding()
+    await history.load_encoding()
+    assert threads and threads[0] is not threading.main_thread()
+    assert len(threads) == 1
@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+from http_cache import choose_encoding, etag_matches, make_etag
+
+
+def test_etag_matches_ignores_encoding_suffix_and_weakness():
+    etag = make_etag("wb", "2024-01-01T00:00:00")
+    gzip_etag = f'"{etag.strip(chr(34))}-gzip"'
+
+    def request(header):
+        return SimpleNamespace(headers={"if-none-match": header})
+
+    assert etag_matches(request(etag), etag)
+    assert etag_matches(request(f'"other", W/{gzip_etag}'), etag)
+    assert etag_matches(request("*"), etag)
+    assert not etag_matches(request('"other"'), etag)
+    assert not etag_matches(SimpleNamespace(headers={}), etag)
+    assert make_etag("wb", "2024-01-02T00:00:00") != etag
+
+
+def test_choose_encoding_respects_quality():
+    assert choose_encoding("gzip, deflate") == "gzip"
+    assert choose_encoding("gzip;q=0, deflate") is None
+    assert choose_encoding("identity") is None
+    assert choose_encoding(None) is None
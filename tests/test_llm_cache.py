@@ -0,0 +1,70 @@
+import pytest
+
+import llm_cache as llm_cache_module
+from llm_cache import LLMCache, cache_bypass_ctx, cached
+
+
+@pytest.mark.asyncio
+async def test_lru_evicts_least_recently_used():
+    cache = LLMCache(max_entries=2)
+    await cache.set("a", 1)
+    await cache.set("b", 2)
+    assert await cache.get("a") == 1
+    await cache.set("c", 3)
+
+    assert await cache.get("b") is None
+    assert await cache.get("a") == 1
+    assert await cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_after_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(llm_cache_module.time, "time", lambda: now)
+    cache = LLMCache(ttl=10)
+    await cache.set("a", ["x"])
+
+    now += 9
+    assert await cache.get("a") == ["x"]
+    now += 2
+    assert await cache.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_sqlite_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "llm_cache.db")
+    cache = LLMCache(sqlite_path=path)
+    await cache.set("a", [{"question": "Where?"}])
+    await cache.close()
+
+    cache = LLMCache(sqlite_path=path)
+    assert await cache.get("a") == [{"question": "Where?"}]
+    assert cache.stats()["sqlite_hits"] == 1
+    await cache.close()
+
+
+@pytest.mark.asyncio
+async def test_cached_keys_on_template_and_honours_bypass(monkeypatch):
+    monkeypatch.setattr(llm_cache_module, "llm_cache", LLMCache())
+    calls = []
+
+    async def generate(chat_history_text):
+        calls.append(chat_history_text)
+        return len(calls)
+
+    first = cached("questions", "template v1 {0}")(generate)
+    second = cached("questions", "template v2 {0}")(generate)
+
+    assert await first("user: hi") == 1
+    assert await first("user: hi") == 1
+    assert await first("user: bye") == 2
+    assert await second("user: hi") == 3
+
+    token = cache_bypass_ctx.set(True)
+    try:
+        assert await first("user: hi") == 4
+    finally:
+        cache_bypass_ctx.reset(token)
+    assert await first("user: hi") == 4
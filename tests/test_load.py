@@ -0,0 +1,520 @@
+import asyncio
+import json
+import os
+import socket
+import time
+
+import aiohttp
+import langchain_openai
+import pytest
+import pytest_asyncio
+from langchain_core.messages import AIMessage, AIMessageChunk
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import agent
+import app as app_module
+from app import app
+from llm_cache import llm_cache
+import tracing
+
+LLM_DELAY = 0.5
+CONCURRENT_REQUESTS = 10
+STREAM_CHUNKS = ('[{"question": "Where?"}', ', {"question": "When?"}', "]")
+
+
+class FakeAzureChatOpenAI:
+    streams_open = 0
+    calls = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    async def ainvoke(self, messages):
+        FakeAzureChatOpenAI.calls += 1
+        await asyncio.sleep(LLM_DELAY)
+        return AIMessage(content='[{"question": "Where?", "type": "text"}]')
+
+    async def astream(self, messages):
+        FakeAzureChatOpenAI.streams_open += 1
+        try:
+            for chunk in STREAM_CHUNKS:
+                yield AIMessageChunk(content=chunk)
+                await asyncio.sleep(LLM_DELAY)
+        finally:
+            FakeAzureChatOpenAI.streams_open -= 1
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def whiteboard_id(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("load")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path)
+        mp.setenv("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1")
+        mp.setenv("AZURE_OPENAI_DEPLOYMENT_NAME", "test")
+        mp.setenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+        # agent.py imports it on first use, so patch it at the source
+        mp.setattr(langchain_openai, "AzureChatOpenAI", FakeAzureChatOpenAI)
+        mp.setattr(llm_cache, "enabled", False)
+
+        bind = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/local.db")
+        mp.setattr(app_module, "bind", bind)
+        mp.setattr(
+            app_module,
+            "async_session",
+            sessionmaker(bind, class_=AsyncSession, expire_on_commit=False),
+        )
+
+        (tmp_path / "whiteboard_data").mkdir()
+        graph = {
+            "graph": {
+                "nodes": [
+                    {
+                        "id": "n1",
+                        "type": "text",
+                        "content": "I want to travel",
+                        "created_by": "user",
+                        "updated_at": "2024-01-01",
+                    }
+                ],
+                "edges": [],
+            }
+        }
+        (tmp_path / "whiteboard_data" / "wb.json").write_text(json.dumps(graph))
+        yield "wb"
+
+
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def server_url(whiteboard_id):
+    port = _free_port()
+    server = await app.create_server(
+        host="127.0.0.1", port=port, return_asyncio_server=True
+    )
+    await server.startup()
+    await server.before_start()
+    await server.after_start()
+    yield f"http://127.0.0.1:{port}"
+    await server.before_stop()
+    await server.close()
+    await server.after_stop()
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_concurrent_questions_overlap(server_url, whiteboard_id):
+    async with aiohttp.ClientSession() as session:
+
+        async def ask():
+            async with session.post(
+                f"{server_url}/whiteboard/{whiteboard_id}/questions"
+            ) as resp:
+                assert resp.status == 200
+                return await resp.json()
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[ask() for _ in range(CONCURRENT_REQUESTS)])
+        elapsed = time.perf_counter() - started
+
+    assert all(r["related_questions"][0]["question"] == "Where?" for r in results)
+    # Serialized completions would take CONCURRENT_REQUESTS * LLM_DELAY.
+    assert elapsed < LLM_DELAY * CONCURRENT_REQUESTS / 2
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_health_not_blocked_by_completion(server_url, whiteboard_id):
+    async with aiohttp.ClientSession() as session:
+        pending = asyncio.ensure_future(
+            session.post(f"{server_url}/whiteboard/{whiteboard_id}/questions")
+        )
+        await asyncio.sleep(LLM_DELAY / 5)
+
+        started = time.perf_counter()
+        async with session.get(f"{server_url}/health") as resp:
+            assert resp.status == 200
+        assert time.perf_counter() - started < LLM_DELAY / 2
+
+        resp = await pending
+        assert resp.status == 200
+        resp.release()
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_suggestions_run_concurrently(server_url, whiteboard_id):
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/suggestions"
+        ) as resp:
+            assert resp.status == 200
+            result = await resp.json()
+        elapsed = time.perf_counter() - started
+
+        async with session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/suggestions",
+            json={"sections": ["related_insights"]},
+        ) as resp:
+            assert list(await resp.json()) == ["related_insights"]
+
+        for sections in (["weather"], [["related_insights"]], [{}], "related"):
+            async with session.post(
+                f"{server_url}/whiteboard/{whiteboard_id}/suggestions",
+                json={"sections": sections},
+            ) as resp:
+                assert resp.status == 400
+
+    assert set(result) == {"related_questions", "related_insights", "search_keywords"}
+    # Three sequential completions would take 3 * LLM_DELAY
+    assert elapsed < LLM_DELAY * 2
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_streamed_questions_arrive_before_completion(server_url, whiteboard_id):
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/questions_streaming",
+            headers={"Accept": "text/event-stream"},
+        ) as resp:
+            assert resp.headers["Content-Type"] == "text/event-stream"
+            first = await resp.content.readuntil(b"\n\n")
+            first_elapsed = time.perf_counter() - started
+            rest = await resp.read()
+
+    assert json.loads(first[len(b"data: ") :]) == {"question": "Where?"}
+    assert first_elapsed < LLM_DELAY * 1.5
+    assert rest.endswith(b"event: end\ndata: {}\n\n")
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_answer_streaming_sse(server_url, whiteboard_id):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/answer_streaming",
+            headers={"Accept": "text/event-stream"},
+        ) as resp:
+            assert resp.headers["Content-Type"] == "text/event-stream"
+            body = (await resp.read()).decode()
+
+    events = [event.splitlines() for event in body.strip().split("\n\n")]
+    content = "".join(json.loads(lines[0][6:])["content"] for lines in events[:-1])
+    assert content == "".join(STREAM_CHUNKS)
+    assert events[-1][0] == "event: done"
+    assert json.loads(events[-1][1][6:])["events"] == len(events) - 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_answer_streaming_stops_when_client_disconnects(
+    server_url, whiteboard_id
+):
+    async with aiohttp.ClientSession() as session:
+        resp = await session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/answer_streaming"
+        )
+        assert await resp.content.readany() == STREAM_CHUNKS[0].encode()
+        assert FakeAzureChatOpenAI.streams_open == 1
+        resp.close()
+
+    await asyncio.sleep(LLM_DELAY / 5)
+    assert FakeAzureChatOpenAI.streams_open == 0
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_search_streaming_sends_results_before_summary(
+    server_url, whiteboard_id, monkeypatch
+):
+    async def fake_search(self, query):
+        await asyncio.sleep(LLM_DELAY / 5)
+        page = {"name": "Yunnan", "url": "https://example.com", "snippet": "..."}
+        return {"webPages": {"value": [page]}}
+
+    monkeypatch.setenv("BING_SEARCH_V7_SUBSCRIPTION_KEY", "test")
+    monkeypatch.setenv("BING_SEARCH_V7_ENDPOINT", "https://example.com/")
+    monkeypatch.setattr(agent.SearchAgent, "search", fake_search)
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/search_streaming",
+        ) as resp:
+            assert resp.headers["Content-Type"] == "application/x-ndjson"
+            first = json.loads(await resp.content.readline())
+            first_elapsed = time.perf_counter() - started
+            rest = [json.loads(line) for line in (await resp.read()).splitlines()]
+
+    assert first == {"event": "result", "data": {**first["data"], "name": "Yunnan"}}
+    # Keywords (one completion) plus one search, not the whole pipeline
+    assert first_elapsed < LLM_DELAY * 2
+    events = [line["event"] for line in rest]
+    assert events == sorted(events, key=["result", "summary"].index)
+    assert "".join(
+        line["data"]["content"] for line in rest if line["event"] == "summary"
+    ) == "".join(STREAM_CHUNKS)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_identical_concurrent_requests_share_one_completion(
+    server_url, whiteboard_id
+):
+    async with aiohttp.ClientSession() as session:
+
+        async def ask(endpoint):
+            async with session.post(
+                f"{server_url}/whiteboard/{whiteboard_id}/{endpoint}"
+            ) as resp:
+                assert resp.status == 200
+                return await resp.read()
+
+        calls = FakeAzureChatOpenAI.calls
+        await asyncio.gather(*[ask("insights") for _ in range(CONCURRENT_REQUESTS)])
+        assert FakeAzureChatOpenAI.calls == calls + 1
+
+        # Streamed answers fan out from one upstream stream
+        bodies = await asyncio.gather(*[ask("answer_streaming") for _ in range(3)])
+        assert all(body == "".join(STREAM_CHUNKS).encode() for body in bodies)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_update_sets_all_fields(server_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{server_url}/whiteboard/create", json={"id": "upd", "name": "Old"}
+        ) as resp:
+            assert resp.status == 200
+
+        body = {"name": "New", "ui_attributes": {"color": "#000000"}, "data": {}}
+        async with session.post(
+            f"{server_url}/whiteboard/upd/update", json=body
+        ) as resp:
+            assert resp.status == 200
+        async with session.get(f"{server_url}/whiteboard/all") as resp:
+            (whiteboard,) = [
+                w for w in (await resp.json())["whiteboards"] if w["id"] == "upd"
+            ]
+        assert whiteboard["name"] == "New"
+        assert whiteboard["ui_attributes"] == {"color": "#000000"}
+
+        async with session.post(
+            f"{server_url}/whiteboard/missing/update", json=body
+        ) as resp:
+            assert resp.status == 404
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_update_checks_version(server_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{server_url}/whiteboard/create", json={"id": "ver", "name": "One"}
+        ) as resp:
+            assert (await resp.json())["version"] == 1
+
+        async with session.post(
+            f"{server_url}/whiteboard/ver/update", json={"name": "Two", "version": 1}
+        ) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["version"] == 2
+            etag = resp.headers["ETag"]
+
+        # A client still holding version 1 gets a conflict, by body or If-Match
+        async with session.post(
+            f"{server_url}/whiteboard/ver/update", json={"name": "Lost", "version": 1}
+        ) as resp:
+            assert resp.status == 409
+            assert (await resp.json())["version"] == 2
+        async with session.post(
+            f"{server_url}/whiteboard/ver/update",
+            json={"name": "Lost"},
+            headers={"If-Match": '"stale"'},
+        ) as resp:
+            assert resp.status == 409
+
+        async with session.get(f"{server_url}/whiteboard/ver") as resp:
+            assert resp.headers["ETag"] == etag
+            whiteboard = await resp.json()
+        assert (whiteboard["name"], whiteboard["version"]) == ("Two", 2)
+
+        async with session.post(
+            f"{server_url}/whiteboard/ver/update",
+            json={"data": {"graph": {"nodes": [], "edges": []}}},
+            headers={"If-Match": etag},
+        ) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["version"] == 3
+
+        # ETags of paged reads name the version too
+        async with session.get(f"{server_url}/whiteboard/ver?limit=1") as resp:
+            paged_etag = resp.headers["ETag"]
+        async with session.post(
+            f"{server_url}/whiteboard/ver/update",
+            json={"name": "Four"},
+            headers={"If-Match": paged_etag},
+        ) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["version"] == 4
+
+        async with session.post(
+            f"{server_url}/whiteboard/ver/update", json={"version": "2"}
+        ) as resp:
+            assert resp.status == 400
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_patch_bumps_version_only_when_applied(server_url):
+    async with aiohttp.ClientSession() as session:
+        await session.post(
+            f"{server_url}/whiteboard/create", json={"id": "patched", "name": "P"}
+        )
+        node = {"id": "n1", "type": "text", "content": "Hi"}
+        operations = [{"op": "add_node", "node": node}]
+        async with session.post(
+            f"{server_url}/whiteboard/patched/patch", json={"operations": operations}
+        ) as resp:
+            assert (await resp.json())["version"] == 2
+
+        # Rejected patches roll back the version they claimed
+        operations = [{"op": "delete_node", "id": "missing"}]
+        async with session.post(
+            f"{server_url}/whiteboard/patched/patch", json={"operations": operations}
+        ) as resp:
+            assert resp.status == 400
+        async with session.get(f"{server_url}/whiteboard/patched") as resp:
+            whiteboard = await resp.json()
+        assert whiteboard["version"] == 2
+        assert whiteboard["data"]["graph"]["nodes"] == [node]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_malformed_cursor_and_duplicate_ids_are_rejected(server_url):
+    async with aiohttp.ClientSession() as session:
+        await session.post(
+            f"{server_url}/whiteboard/create", json={"id": "invalid", "name": "I"}
+        )
+        for cursor in ("abc", "-1", "1.5"):
+            async with session.get(
+                f"{server_url}/whiteboard/invalid?limit=2&cursor={cursor}"
+            ) as resp:
+                assert resp.status == 400
+
+        node = {"id": "n1", "type": "text", "content": "Hi"}
+        async with session.post(
+            f"{server_url}/whiteboard/invalid/update",
+            json={"data": {"graph": {"nodes": [node, node], "edges": []}}},
+        ) as resp:
+            assert resp.status == 400
+        async with session.get(f"{server_url}/whiteboard/invalid") as resp:
+            whiteboard = await resp.json()
+        assert whiteboard["version"] == 1
+        assert whiteboard["data"]["graph"]["nodes"] == []
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_get_whiteboard_etag_and_compression(server_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{server_url}/whiteboard/create", json={"id": "etag", "name": "Big"}
+        ) as resp:
+            assert resp.status == 200
+        nodes = [{"id": f"n{i}", "content": "x" * 100} for i in range(50)]
+        body = {"data": {"graph": {"nodes": nodes, "edges": []}}}
+        async with session.post(
+            f"{server_url}/whiteboard/etag/update", json=body
+        ) as resp:
+            assert resp.status == 200
+
+        async with session.get(
+            f"{server_url}/whiteboard/etag", headers={"Accept-Encoding": "gzip"}
+        ) as resp:
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert int(resp.headers["Content-Length"]) < 5000
+            assert len((await resp.json())["data"]["graph"]["nodes"]) == 50
+            etag = resp.headers["ETag"]
+
+        async with session.get(
+            f"{server_url}/whiteboard/etag", headers={"If-None-Match": etag}
+        ) as resp:
+            assert resp.status == 304
+            assert await resp.read() == b""
+
+        async with session.post(
+            f"{server_url}/whiteboard/etag/update", json={"name": "Renamed"}
+        ) as resp:
+            assert resp.status == 200
+        async with session.get(
+            f"{server_url}/whiteboard/etag", headers={"If-None-Match": etag}
+        ) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["name"] == "Renamed"
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_metrics_endpoint(server_url, whiteboard_id):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{server_url}/whiteboard/{whiteboard_id}/answer_streaming"
+        ) as resp:
+            await resp.read()
+        async with session.get(f"{server_url}/metrics") as resp:
+            assert resp.status == 200
+            assert resp.content_type == "text/plain"
+            text = await resp.text()
+
+    # The server runs in this process
+    worker = f'worker="{os.getpid()}"'
+    assert (
+        f"http_request_duration_seconds_count{{{worker},"
+        'route="whiteboard/<whiteboard_id:str>/answer_streaming",'
+        'method="POST",status="200"}'
+    ) in text
+    assert (
+        f'llm_time_to_first_token_seconds_count{{{worker},function="stream_answer"}}'
+    ) in text
+    assert (
+        f"llm_request_duration_seconds_count{{{worker},"
+        'function="get_related_insights"'
+    ) in text
+    assert f'cache_lookups_total{{{worker},cache="single_flight",result="hit"}}' in text
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_server_timing_when_tracing_enabled(server_url, whiteboard_id):
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(tracing, "TRACING_ENABLED", True)
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                f"{server_url}/whiteboard/{whiteboard_id}/answer",
+                headers={"Cache-Control": "no-cache"},
+            ) as resp:
+                assert resp.status == 200
+                timing = resp.headers["Server-Timing"]
+
+    names = [entry.split(";")[0] for entry in timing.split(", ")]
+    assert names[:2] == ["load", "history"]
+    assert "llm.get_answer" in names
+    assert names[-1] == "total"
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_ready_after_warm_up(server_url, monkeypatch):
+    connected = []
+
+    async def connect(self):
+        connected.append(True)
+
+    monkeypatch.setattr(app_module, "AGENT_WARMUP", True)
+    monkeypatch.setattr(agent.registry, "warm", False)
+    monkeypatch.setattr(agent.AgentRegistry, "_connect_azure", connect)
+    monkeypatch.setattr(agent.AgentRegistry, "_connect_search", connect)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{server_url}/ready") as resp:
+            assert resp.status == 503
+        async with session.get(f"{server_url}/health") as resp:
+            assert resp.status == 200
+
+        await agent.registry.warm_up()
+        assert len(connected) == 2
+        assert agent.registry.chatgpt_agent is not None
+        async with session.get(f"{server_url}/ready") as resp:
+            assert resp.status == 200
@@ -0,0 +1,55 @@
+import pytest
+
+from metrics import Counter, FunctionMetric, Histogram, Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), (0.1, 1))
+    child = histogram.labels('/a"b')
+    for value in (0.05, 0.1, 0.5, 5):
+        child.observe(value)
+
+    lines = histogram.render().splitlines()
+    assert lines[:2] == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+    ]
+    assert lines[2:] == [
+        'latency_seconds_bucket{route="/a\\"b",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a\\"b",le="1.0"} 3',
+        'latency_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a\\"b"} 5.65',
+        'latency_seconds_count{route="/a\\"b"} 4',
+    ]
+
+
+def test_registry_renders_counters_and_functions():
+    registry = Registry()
+    counter = registry.register(Counter("errors", "Errors", ("kind",)))
+    counter.labels("timeout").inc()
+    counter.labels("timeout").inc(2)
+    registry.register(
+        FunctionMetric(
+            "hit_ratio", "Hits", "gauge", ("cache",), lambda: {("llm",): 0.5}
+        )
+    )
+
+    text = registry.render()
+    assert 'errors_total{kind="timeout"} 3' in text
+    assert 'hit_ratio{cache="llm"} 0.5' in text
+    assert text.endswith("\n")
+
+    with pytest.raises(ValueError):
+        registry.register(Counter("errors", "Again"))
+    with pytest.raises(ValueError):
+        counter.labels("a", "b")
+
+
+def test_registry_adds_const_labels_to_every_sample():
+    registry = Registry(lambda: {"worker": 42})
+    registry.register(Counter("errors", "Errors", ("kind",))).labels("io").inc()
+    registry.register(Counter("restarts", "Restarts")).inc()
+
+    text = registry.render()
+    assert 'errors_total{worker="42",kind="io"} 1' in text
+    assert 'restarts_total{worker="42"} 1' in text
@@ -1,10 +1,13 @@
+from datetime import datetime, timedelta
+
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
 from models import (
     Base,
     Whiteboard,
+    create_schema,
 )
 
 
@@ -79,3 +82,95 @@ async def test_delete_whiteboard(db_session, sample_whiteboard):
         .one_or_none()
     )
     assert whiteboard_from_db is None
+
+
+def test_list_query_pages_by_updated_at(db_session):
+    base = datetime(2024, 1, 1)
+    for i in range(7):
+        whiteboard = Whiteboard(id=f"wb{i}", name=f"Trip {i}" if i % 2 else f"Work {i}")
+        whiteboard.updated_at = base + timedelta(hours=i // 2)
+        db_session.add(whiteboard)
+    deleted = Whiteboard(id="gone", name="Trip gone")
+    deleted.deleted_at = base
+    db_session.add(deleted)
+    db_session.flush()
+
+    ids = []
+    cursor = None
+    while True:
+        rows = db_session.execute(Whiteboard.list_query(3, cursor)).all()
+        page, cursor = Whiteboard.page_rows(rows, 3)
+        ids.extend(whiteboard["id"] for whiteboard in page)
+        if cursor is None:
+            break
+    assert ids == ["wb6", "wb5", "wb4", "wb3", "wb2", "wb1", "wb0"]
+
+    fields = ("id", "name")
+    rows = db_session.execute(
+        Whiteboard.list_query(fields=fields, name_prefix="Trip")
+    ).all()
+    assert Whiteboard.page_rows(rows, fields=fields) == (
+        [{"id": f"wb{i}", "name": f"Trip {i}"} for i in (5, 3, 1)],
+        None,
+    )
+
+
+def test_list_query_rejects_bad_cursor():
+    with pytest.raises(ValueError):
+        Whiteboard.list_query(10, "not a cursor")
+
+
+def test_bump_query_checks_the_expected_version(db_session):
+    db_session.add(Whiteboard(id="versioned", name="Trip"))
+    db_session.flush()
+
+    stmt = Whiteboard.bump_query("versioned", 1, name="Renamed")
+    assert db_session.execute(stmt).scalar() == 2
+    # A second writer that also read version 1 loses
+    stmt = Whiteboard.bump_query("versioned", 1, name="Lost")
+    assert db_session.execute(stmt).scalar() is None
+    assert db_session.execute(Whiteboard.bump_query("versioned")).scalar() == 3
+
+    db_session.expire_all()
+    whiteboard = db_session.get(Whiteboard, "versioned")
+    assert (whiteboard.name, whiteboard.version) == ("Renamed", 3)
+
+
+def test_create_schema_adds_new_columns_to_old_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE whiteboard (id VARCHAR(255) PRIMARY KEY, "
+                "created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL, "
+                "deleted_at DATETIME, name VARCHAR(255) NOT NULL, "
+                "extra_metadata JSON NOT NULL, ui_attributes JSON NOT NULL)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO whiteboard VALUES ('old', '2024-01-01 00:00:00', "
+                "'2024-01-01 00:00:00', NULL, 'Old', '{}', '{}')"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE whiteboard_node (whiteboard_id VARCHAR(255), "
+                "id VARCHAR(255), seq INTEGER NOT NULL, type VARCHAR(64), "
+                "x FLOAT, y FLOAT, updated_at DATETIME NOT NULL, "
+                "data JSON NOT NULL, PRIMARY KEY (whiteboard_id, id))"
+            )
+        )
+
+    for _ in range(2):
+        with engine.begin() as connection:
+            create_schema(connection)
+
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        assert session.get(Whiteboard, "old").version == 1
+    columns = inspect(engine).get_columns("whiteboard_node")
+    assert "messages" in [column["name"] for column in columns]
+    indexes = [index["name"] for index in inspect(engine).get_indexes("whiteboard")]
+    assert "ix_whiteboard_deleted_at_updated_at" in indexes
+    engine.dispose()
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    results = await asyncio.gather(*[flight.do("key", work) for _ in range(5)])
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 1, "shared": 4}
+
+    # Finished calls are forgotten: this is not a cache
+    await asyncio.sleep(0)
+    assert await flight.do("key", work) == "result"
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_call_is_cancelled_when_every_waiter_leaves():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    waiters = [asyncio.ensure_future(flight.do("key", work)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    waiters[0].cancel()
+    await asyncio.sleep(0.01)
+    assert not cancelled
+
+    waiters[1].cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
+    await asyncio.sleep(0.01)
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_to_late_subscribers():
+    flight = SingleFlight()
+    started = []
+
+    async def produce(usage):
+        started.append(1)
+        for item in "abc":
+            await asyncio.sleep(0.01)
+            yield item
+        usage["total_tokens"] = 3
+
+    async def consume(delay):
+        await asyncio.sleep(delay)
+        usage = {}
+        items = [item async for item in flight.stream("key", produce, usage)]
+        return items, usage
+
+    results = await asyncio.gather(consume(0), consume(0.015))
+    assert results == [(list("abc"), {"total_tokens": 3})] * 2
+    assert len(started) == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_errors_reach_every_subscriber():
+    flight = SingleFlight()
+
+    async def produce(usage):
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def consume():
+        return [item async for item in flight.stream("key", produce)]
+
+    results = await asyncio.gather(consume(), consume(), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_subscriber_does_not_affect_the_others():
+    flight = SingleFlight()
+
+    async def produce(usage):
+        for item in "abc":
+            await asyncio.sleep(0.01)
+            yield item
+
+    async def consume():
+        return [item async for item in flight.stream("key", produce)]
+
+    leaving = asyncio.ensure_future(consume())
+    staying = asyncio.ensure_future(consume())
+    await asyncio.sleep(0.015)
+    leaving.cancel()
+    assert await staying == list("abc")
+    assert leaving.cancelled()
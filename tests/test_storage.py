@@ -0,0 +1,213 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import data_helper
+from data_helper import WhiteboardData, document_cache, history_cache
+from graph import page_graph
+from migrate import migrate
+from models import Base, Whiteboard
+from storage import FileStorage, SqlStorage, StorageConflict
+
+
+def make_node(node_id, content, x=0, y=0, node_type="text"):
+    return {
+        "id": node_id,
+        "type": node_type,
+        "content": content,
+        "created_by": "user",
+        "updated_at": "2024-01-01T00:00:00",
+        "ui_attributes": {"position": {"x": x, "y": y}},
+    }
+
+
+def make_board(count=10):
+    nodes = [make_node(f"n{i}", str(i), x=i * 10, y=i * 10) for i in range(count)]
+    edges = [
+        {"id": f"e{i}", "source": f"n{i}", "target": f"n{i + 1}"}
+        for i in range(count - 1)
+    ]
+    return {"name": "board", "graph": {"nodes": nodes, "edges": edges}}
+
+
+@pytest_asyncio.fixture
+async def sql_storage(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield SqlStorage(sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+    await engine.dispose()
+
+
+@pytest.fixture
+def sql_whiteboard(sql_storage, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "0")
+    monkeypatch.setattr(data_helper, "storage", sql_storage)
+    document_cache.clear()
+    history_cache.clear()
+    yield sql_storage
+    document_cache.clear()
+    history_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_sql_write_and_read(sql_storage):
+    board = make_board()
+    version = await sql_storage.write("wb", board)
+    assert await sql_storage.read("wb") == (version, board)
+
+    with pytest.raises(FileNotFoundError):
+        await sql_storage.read("missing")
+
+
+@pytest.mark.asyncio
+async def test_sql_write_joins_the_callers_transaction(sql_storage):
+    async with sql_storage.sessionmaker() as session:
+        async with session.begin():
+            await session.execute(
+                Whiteboard.__table__.insert().values(
+                    id="wb",
+                    name="Board",
+                    extra_metadata={},
+                    ui_attributes={},
+                    created_at=datetime.now(),
+                    updated_at=datetime.now(),
+                )
+            )
+            # SQLite would wait on the lock this transaction holds otherwise
+            await sql_storage.write("wb", make_board(2), session=session)
+            await session.rollback()
+
+    with pytest.raises(FileNotFoundError):
+        await sql_storage.version("wb")
+
+
+@pytest.mark.asyncio
+async def test_patch_in_a_transaction_during_a_flush(sql_whiteboard, monkeypatch):
+    monkeypatch.setenv("WHITEBOARD_FLUSH_WINDOW", "60")
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.patch([{"op": "add_node", "node": make_node("n0", "0")}])
+
+    # Hold the flush inside storage, with the board's lock taken
+    entered, release = asyncio.Event(), asyncio.Event()
+    append = sql_whiteboard.append
+
+    async def held_append(*args, **kwargs):
+        entered.set()
+        await release.wait()
+        return await append(*args, **kwargs)
+
+    monkeypatch.setattr(sql_whiteboard, "append", held_append)
+    flush = asyncio.ensure_future(whiteboard_data.flush())
+    await entered.wait()
+
+    async def handler():
+        # As the patch handler does: the board's lock, then the database's
+        whiteboard_data = WhiteboardData("wb")
+        async with sql_whiteboard.sessionmaker() as session:
+            async with whiteboard_data.writing(), session.begin():
+                await session.execute(
+                    Whiteboard.__table__.insert().values(
+                        id="wb",
+                        name="Board",
+                        extra_metadata={},
+                        ui_attributes={},
+                        created_at=datetime.now(),
+                        updated_at=datetime.now(),
+                    )
+                )
+                await whiteboard_data.patch(
+                    [{"op": "add_node", "node": make_node("n1", "1")}], session
+                )
+
+    request = asyncio.ensure_future(handler())
+    await asyncio.sleep(0.05)
+    release.set()
+    # SQLite's busy timeout is 5 s; a lock-order deadlock would wait it out
+    await asyncio.wait_for(asyncio.gather(flush, request), 2)
+
+    await whiteboard_data.flush()
+    _, data = await sql_whiteboard.read("wb")
+    assert [node["id"] for node in data["graph"]["nodes"]] == ["n0", "n1"]
+
+
+@pytest.mark.asyncio
+async def test_sql_append_is_compare_and_swap(sql_whiteboard):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(make_board(3))
+    await whiteboard_data.patch(
+        [
+            {"op": "add_node", "node": make_node("n3", "3")},
+            {"op": "move_node", "id": "n0", "position": {"x": 5, "y": 6}},
+            {"op": "delete_node", "id": "n1"},
+        ]
+    )
+
+    version, data = await sql_whiteboard.read("wb")
+    assert data == await whiteboard_data.load()
+    assert [node["id"] for node in data["graph"]["nodes"]] == ["n0", "n2", "n3"]
+    assert data["graph"]["edges"] == []
+
+    with pytest.raises(StorageConflict):
+        await sql_whiteboard.append("wb", version - 1, [], data)
+
+
+@pytest.mark.asyncio
+async def test_sql_page_matches_file_page(sql_storage):
+    board = make_board(10)
+    await sql_storage.write("wb", board)
+
+    for viewport in (None, (15, 15, 75, 75)):
+        cursor, file_cursor = None, None
+        while True:
+            page, cursor = await sql_storage.read_page("wb", 3, cursor, viewport)
+            expected, file_cursor = page_graph(board, 3, file_cursor, viewport)
+            assert page == expected
+            if cursor is None:
+                assert file_cursor is None
+                break
+
+
+@pytest.mark.asyncio
+async def test_sql_chat_history_selects_text_nodes(sql_whiteboard):
+    board = make_board(2)
+    board["graph"]["nodes"].append(make_node("img", "x.png", node_type="image"))
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(board)
+
+    document_cache.clear()
+    assert await whiteboard_data.load_as_chat_history_text() == "user: 0\nuser: 1"
+
+
+@pytest.mark.asyncio
+async def test_sql_chat_history_follows_patched_rows(sql_whiteboard):
+    whiteboard_data = await WhiteboardData.create("wb")
+    await whiteboard_data.update(make_board(3))
+    await whiteboard_data.patch(
+        [
+            {"op": "delete_node", "id": "n0"},
+            {"op": "update_node", "id": "n1", "fields": {"content": "one"}},
+            {"op": "add_node", "node": make_node("n3", "3")},
+            {"op": "add_node", "node": make_node("img", "x.png", node_type="image")},
+        ]
+    )
+
+    history = await sql_whiteboard.read_history("wb")
+    assert history.text == "user: one\nuser: 2\nuser: 3"
+
+
+@pytest.mark.asyncio
+async def test_migrate_copies_file_boards(tmp_path, sql_storage, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "whiteboard_data").mkdir()
+    source = FileStorage()
+    board = make_board(5)
+    await source.write("wb", board)
+
+    assert await migrate(source, sql_storage) == ["wb"]
+    assert (await sql_storage.read("wb"))[1] == board
+    assert await migrate(source, sql_storage) == []
@@ -0,0 +1,167 @@
+import asyncio
+import json
+
+import pytest
+
+from llm_cache import LLMCache, cached_stream
+from streaming import JSONArrayParser, coalesce, encode_item, stream_items
+
+COMPLETION = """```json
+[
+    {"question": "Where [to]?", "type": "text"},
+    {"question": "Say \\"hi\\", {ok}", "options": ["a", "b"]},
+    "plain",
+    42
+]
+```"""
+
+
+def test_parser_yields_items_as_they_complete():
+    expected = json.loads(COMPLETION.strip("`json\n"))
+    for size in (1, 2, 7, len(COMPLETION)):
+        parser = JSONArrayParser()
+        items = []
+        for i in range(0, len(COMPLETION), size):
+            items.extend(parser.feed(COMPLETION[i : i + size]))
+        assert items == expected
+        assert parser.done
+
+
+def test_parser_emits_first_item_before_the_array_closes():
+    parser = JSONArrayParser()
+    assert parser.feed('[{"question": "Where?"}') == []
+    assert parser.feed(', {"quest') == [{"question": "Where?"}]
+    assert not parser.done
+
+
+def test_encode_item():
+    assert encode_item({"a": "云"}) == '{"a": "云"}\n'
+    assert encode_item("x", sse=True) == 'data: "x"\n\n'
+
+
+@pytest.mark.asyncio
+async def test_cached_stream_replays_completed_streams(monkeypatch):
+    cache = LLMCache()
+    monkeypatch.setattr("llm_cache.llm_cache", cache)
+    calls = []
+
+    @cached_stream("items", "template")
+    async def stream(chat_history_text, usage=None):
+        calls.append(chat_history_text)
+        if usage is not None:
+            usage["output_tokens"] = 2
+        for item in ("a", "b"):
+            yield item
+
+    # An abandoned stream is not cached
+    async for item in stream("history"):
+        break
+    assert [item async for item in stream("history")] == ["a", "b"]
+    assert [item async for item in stream("history")] == ["a", "b"]
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_stream_passes_usage_through(monkeypatch):
+    cache = LLMCache()
+    monkeypatch.setattr("llm_cache.llm_cache", cache)
+
+    @cached_stream("items", "template")
+    async def stream(chat_history_text, usage=None):
+        usage["output_tokens"] = 1
+        yield "a"
+
+    usage = {}
+    assert [item async for item in stream("history", usage)] == ["a"]
+    assert usage == {"output_tokens": 1}
+    # A replay spends no tokens
+    usage = {}
+    assert [item async for item in stream("history", usage)] == ["a"]
+    assert usage == {}
+
+
+async def token_stream(tokens, delay=0.0, closed=None):
+    try:
+        for token in tokens:
+            if delay:
+                await asyncio.sleep(delay)
+            yield token
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_merges_small_chunks_by_size():
+    tokens = [f"t{i} " for i in range(100)]
+    pieces = [p async for p in coalesce(token_stream(tokens), min_chars=32)]
+
+    assert "".join(pieces) == "".join(tokens)
+    assert all(len(piece) >= 32 for piece in pieces[:-1])
+    assert len(pieces) < len(tokens) / 5
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_after_max_delay():
+    started = asyncio.get_running_loop().time()
+    stream = coalesce(token_stream(["a", "b"], delay=0.2), max_delay=0.02)
+
+    assert await anext(stream) == "a"
+    # Sent once the delay expired, not when the next token arrived
+    assert asyncio.get_running_loop().time() - started < 0.35
+    assert [p async for p in stream] == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_closes_source_mid_await():
+    closed = []
+    stream = coalesce(token_stream(["a"] * 10, delay=1, closed=closed), max_delay=0)
+    task = asyncio.ensure_future(anext(stream))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await stream.aclose()
+    assert closed == [True]
+
+
+class FakeRequest:
+    """Just enough of a Sanic request to stream a response to."""
+
+    def __init__(self, accept="", disconnect_after=None):
+        self.headers = {"accept": accept}
+        self.transport = self
+        self.disconnect_after = disconnect_after
+        self.sent = []
+
+    def is_closing(self):
+        return len(self.sent) == self.disconnect_after
+
+    async def respond(self, content_type=None, headers=None):
+        self.content_type = content_type
+        return self
+
+    async def send(self, data):
+        self.sent.append(data)
+
+    async def eof(self):
+        self.sent.append(None)
+
+
+@pytest.mark.asyncio
+async def test_stream_items_stops_and_closes_source_on_disconnect():
+    closed = []
+    request = FakeRequest(disconnect_after=2)
+    await stream_items(request, token_stream(range(10), closed=closed))
+    assert request.content_type == "application/x-ndjson"
+    assert request.sent == ["0\n", "1\n"]
+    assert closed == [True]
+
+    request = FakeRequest("text/event-stream")
+    await stream_items(request, token_stream(range(2)))
+    assert request.sent == [
+        "data: 0\n\n",
+        "data: 1\n\n",
+        "event: end\ndata: {}\n\n",
+        None,
+    ]
@@ -0,0 +1,74 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import tracing
+from tracing import SamplingProfiler, Trace, record, span
+
+
+def test_spans_are_ignored_without_a_trace():
+    with span("load"):
+        pass
+    record("bing", time.perf_counter())
+    assert tracing._current_trace.get() is None
+
+
+def test_server_timing_totals_spans_by_name():
+    trace = Trace("POST /whiteboard/wb/search")
+    token = tracing._current_trace.set(trace)
+    try:
+        with span("load"):
+            pass
+        record("bing", time.perf_counter() - 0.010)
+        record("bing", time.perf_counter() - 0.020)
+    finally:
+        tracing._current_trace.reset(token)
+
+    assert [name for name, _, _ in trace.spans] == ["load", "bing", "bing"]
+    assert trace.totals()["bing"][1] == 2
+    entries = trace.server_timing().split(", ")
+    assert [entry.split(";")[0] for entry in entries] == ["load", "bing", "total"]
+    assert float(entries[1].split("dur=")[1]) >= 30
+    assert trace.to_dict()["spans"][0]["name"] == "load"
+
+
+def _busy_wait(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_sampling_profiler_writes_collapsed_stacks():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    _busy_wait(0.1)
+    profiler.stop()
+
+    lines = profiler.collapsed().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any("_busy_wait (test_tracing.py" in line for line in lines)
+
+
+@pytest.mark.asyncio
+async def test_sampled_request_dumps_profile(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(tracing, "PROFILE_DIR", str(tmp_path))
+    request = SimpleNamespace(
+        method="GET", path="/health", id="req1", ctx=SimpleNamespace()
+    )
+
+    tracing.start_trace(request)
+    with span("load"):
+        _busy_wait(0.02)
+    response = SimpleNamespace(headers={})
+    tracing.add_server_timing(request, response)
+    await tracing.finish_trace(request)
+
+    assert response.headers["Server-Timing"].startswith("load;dur=")
+    (profile,) = tmp_path.iterdir()
+    assert profile.name.endswith("-req1.folded")
+    assert profile.read_text()
+    tracing._current_trace.set(None)
@@ -0,0 +1,174 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiofiles
+from sanic.log import logger
+
+# Trace every request (Server-Timing header plus one timing log line each)
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "0") == "1"
+# Fraction of requests run under the sampling profiler; they are traced too
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+_current_trace = ContextVar("trace", default=None)
+
+
+class Trace:
+    """Spans recorded while handling one request."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        # (name, start offset, duration) in seconds
+        self.spans = []
+
+    def add(self, name: str, started: float, duration: float):
+        self.spans.append((name, started - self.started, duration))
+
+    def totals(self) -> dict:
+        """Total duration and count per span name, in first-seen order."""
+        totals = {}
+        for name, _, duration in self.spans:
+            total, count = totals.get(name, (0.0, 0))
+            totals[name] = (total + duration, count + 1)
+        return totals
+
+    def server_timing(self) -> str:
+        entries = [
+            f"{name};dur={total * 1000:.1f}"
+            for name, (total, _) in self.totals().items()
+        ]
+        elapsed = time.perf_counter() - self.started
+        entries.append(f"total;dur={elapsed * 1000:.1f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> dict:
+        return {
+            "request": self.name,
+            "elapsed_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round(offset * 1000, 2),
+                    "duration_ms": round(duration * 1000, 2),
+                }
+                for name, offset, duration in self.spans
+            ],
+        }
+
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block as ``name`` in the current request's trace."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started)
+
+
+def record(name: str, started: float):
+    """Add a span for code that already measured its own start time."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, started, time.perf_counter() - started)
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Sample the stack of one thread from a background thread.
+
+    The result is in the "collapsed stacks" format read by flamegraph.pl and
+    speedscope. The event loop thread is shared, so samples include whatever
+    other requests were running at the same time.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+def start_trace(request):
+    """Request middleware starting a trace (and maybe a profile) if enabled."""
+    profile = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if not (TRACING_ENABLED or profile):
+        # Keep-alive requests share a task; don't inherit the previous trace
+        _current_trace.set(None)
+        return
+
+    trace = Trace(f"{request.method} {request.path}")
+    request.ctx.trace = trace
+    _current_trace.set(trace)
+    if profile:
+        request.ctx.profiler = SamplingProfiler()
+        request.ctx.profiler.start()
+
+
+def add_server_timing(request, response):
+    """Response middleware; streamed responses only show spans up to here."""
+    trace = getattr(request.ctx, "trace", None)
+    if trace is not None and response is not None:
+        response.headers["Server-Timing"] = trace.server_timing()
+
+
+async def finish_trace(request):
+    """Log the trace and write out the profile once the response is done."""
+    trace = getattr(request.ctx, "trace", None)
+    if trace is None:
+        return
+    logger.info(f"Trace {json.dumps(trace.to_dict())}")
+
+    profiler = getattr(request.ctx, "profiler", None)
+    if profiler is None:
+        return
+    profiler.stop()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.id}.folded"
+    path = os.path.join(PROFILE_DIR, name)
+    async with aiofiles.open(path, "w") as f:
+        await f.write(profiler.collapsed())
+    logger.info(f"Profile of {trace.name} written to {path}")